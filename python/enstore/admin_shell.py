@@ -0,0 +1,252 @@
+#!/bin/env python
+"""
+dCache admin door client shared by migration, stage, pin and
+reprm scripts.
+
+Each process keeps one long lived GSSAPI SSH connection per admin door
+and runs admin commands as channels multiplexed over it, instead of
+connecting for every worker / command. Several commands can be
+pipelined over the same connection with execute_many. Command output
+is read in full before exec_command returns, so that if connection
+drops or Kerberos ticket expires while sending the command or reading
+its output, kinit is called (holding caller's kinit lock), connection
+re-established and command retried once. Same is done when the first
+connect in get_shell fails.
+
+Usage:
+
+    import admin_shell
+
+    ssh = admin_shell.get_shell(host, port, user, kinit, kinitLock)
+    stdin, stdout, stderr = ssh.exec_command("\\sn cacheinfoof " + pnfsid)
+    results = ssh.execute_many(["\\s " + pool + " rh restore " + pnfsid
+                                for pnfsid in pnfsids])
+    ssh.close()
+"""
+from __future__ import print_function
+import os
+import socket
+import threading
+
+import paramiko
+
+SSH_HOST = "fndca"
+SSH_PORT = 24223
+SSH_USER = "enstore"
+
+# max number of admin commands in flight over one connection
+PIPELINE_WIDTH = 8
+
+# (pid, host, port, user) -> AdminShell
+_shells = {}
+_shellsLock = threading.Lock()
+
+
+class Output(object):
+    """
+    Output of admin command read in full, file like
+    """
+    def __init__(self, lines):
+        self.lines = lines
+
+    def readlines(self):
+        return list(self.lines)
+
+    def read(self):
+        return "".join(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+
+class AdminShell(object):
+    """
+    Persistent admin door connection. Exposes exec_command and close
+    so it can be used in place of paramiko.SSHClient
+    """
+    def __init__(self, host=SSH_HOST, port=SSH_PORT, user=SSH_USER, kinit=None,
+                 kinit_lock=None):
+        """
+        :param host: admin door host
+        :type host: str
+
+        :param port: admin door port
+        :type port: int
+
+        :param user: admin door user
+        :type user: str
+
+        :param kinit: function that refreshes Kerberos ticket
+        :type kinit: function
+
+        :param kinit_lock: lock held while calling kinit
+        :type kinit_lock: multiprocessing.Lock
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.kinit = kinit
+        self.kinit_lock = kinit_lock
+        self.ssh = None
+        self.connectLock = threading.Lock()
+
+    def connect(self):
+        """
+        (Re)connect to admin door unless connection is alive
+
+        :return: connected client
+        :rtype: paramiko.SSHClient
+        """
+        with self.connectLock:
+            if self.ssh:
+                transport = self.ssh.get_transport()
+                if transport and transport.is_active():
+                    return self.ssh
+                self._close()
+            ssh = paramiko.SSHClient()
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect(hostname=self.host,
+                        port=self.port,
+                        username=self.user,
+                        gss_auth=True,
+                        gss_kex=True)
+            self.ssh = ssh
+            return ssh
+
+    def reconnect(self, failed=None):
+        """
+        Refresh Kerberos ticket and reconnect unless another thread
+        has already replaced the failed client
+
+        :param failed: client that failed, None if connect failed
+        :type failed: paramiko.SSHClient
+
+        :return: connected client
+        :rtype: paramiko.SSHClient
+        """
+        with self.connectLock:
+            replaced = self.ssh is not failed
+            if not replaced:
+                self._close()
+        if replaced:
+            return self.connect()
+        if self.kinit:
+            if self.kinit_lock:
+                with self.kinit_lock:
+                    self.kinit()
+            else:
+                self.kinit()
+        return self.connect()
+
+    @staticmethod
+    def _exec_command(ssh, cmd):
+        stdin, stdout, stderr = ssh.exec_command(cmd)
+        return stdin, Output(stdout.readlines()), Output(stderr.readlines())
+
+    def exec_command(self, cmd):
+        """
+        Execute admin command on a new channel of persistent connection
+        and read its output. Retry once after reconnect if connection
+        is broken
+
+        :param cmd: admin command
+        :type cmd: str
+
+        :return: stdin, stdout, stderr of the command
+        :rtype: tuple
+        """
+        ssh = None
+        try:
+            ssh = self.connect()
+            return AdminShell._exec_command(ssh, cmd)
+        except (paramiko.SSHException, EOFError, socket.error):
+            return AdminShell._exec_command(self.reconnect(ssh), cmd)
+
+    def execute(self, cmd):
+        """
+        Execute admin command and read its output
+
+        :param cmd: admin command
+        :type cmd: str
+
+        :return: stdout lines, stderr lines
+        :rtype: tuple
+        """
+        stdin, stdout, stderr = self.exec_command(cmd)
+        return stdout.readlines(), stderr.readlines()
+
+    def execute_many(self, cmds, width=PIPELINE_WIDTH):
+        """
+        Execute admin commands keeping up to width of them
+        in flight over the same connection
+
+        :param cmds: admin commands
+        :type cmds: list
+
+        :param width: max number of concurrent commands
+        :type width: int
+
+        :return: list of (stdout lines, stderr lines) or exception,
+                 in the order of cmds
+        :rtype: list
+        """
+        results = [None] * len(cmds)
+
+        def run(i):
+            try:
+                results[i] = self.execute(cmds[i])
+            except Exception as e:
+                results[i] = e
+
+        for start in range(0, len(cmds), width):
+            threads = [threading.Thread(target=run, args=(i,))
+                       for i in range(start, min(start + width, len(cmds)))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        return results
+
+    def _close(self):
+        if self.ssh:
+            try:
+                self.ssh.close()
+            except Exception:
+                pass
+            self.ssh = None
+
+    def close(self):
+        """
+        Close connection and forget it
+        """
+        with _shellsLock:
+            for key, value in list(_shells.items()):
+                if value is self:
+                    del _shells[key]
+        with self.connectLock:
+            self._close()
+
+
+def get_shell(host=SSH_HOST, port=SSH_PORT, user=SSH_USER, kinit=None,
+              kinit_lock=None):
+    """
+    Return admin shell for host, port, user shared by all callers
+    in this process. Connections are never shared across processes
+    as SSH transport does not survive fork. If first connect fails,
+    e.g. Kerberos ticket is missing or expired, kinit is called and
+    connect retried once
+
+    :return: admin shell
+    :rtype: AdminShell
+    """
+    key = (os.getpid(), host, port, user)
+    with _shellsLock:
+        shell = _shells.get(key)
+        if not shell:
+            shell = AdminShell(host, port, user, kinit, kinit_lock)
+            _shells[key] = shell
+    try:
+        shell.connect()
+    except (paramiko.SSHException, EOFError, socket.error):
+        shell.reconnect(None)
+    return shell
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+High-water mark and standing discrepancy table of forward, backward
+and check_duplicates audits.
+
+The first run, or a run with full=True, audits everything and
+replaces the table. Later runs only audit rows changed after the
+high-water mark of the previous run and merge their findings into
+the table: a problem found is added or refreshed, and a row that
+checks out clears its entry. The high-water mark is database time
+taken when the scan starts, so rows changed during the scan are
+audited again on the next run. An audit that also picks up rows
+changed in another database keeps a separate mark for it, taken from
+that database server before the scan, as the clocks of the two
+servers may differ. If any rows could not be audited
+the findings are still saved but the high-water mark is kept, so
+those rows are audited again on the next run.
+
+State is kept in <directory>/<name>.json, and the table is also
+written in plain text to <directory>/<name>.txt.
+
+Usage:
+
+    from audit import AuditState
+
+    state = AuditState("forward", directory)
+    mark = <select now() before scan>
+    for key, problem in <audit rows changed since state.high_water_mark>:
+        state.record(key, problem)
+    state.save(mark)
+
+    state = AuditState("forward", directory, other_databases=("enstore",))
+    mark = <select now() on chimera before scan>
+    enstore_mark = <select now() on enstore before scan>
+    <rows changed since state.high_water_mark on chimera and
+     since state.high_water_marks["enstore"] on enstore>
+    state.save(mark, {"enstore": enstore_mark})
+"""
+import json
+import os
+import time
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+class AuditState(object):
+    """
+    High-water mark and discrepancies of one audit
+    """
+    def __init__(self, name, directory, full=False, other_databases=()):
+        """
+        :param name: audit name
+        :type name: str
+
+        :param directory: directory to keep state in
+        :type directory: str
+
+        :param full: ignore high-water mark and rebuild table
+        :type full: bool
+
+        :param other_databases: names of other databases scanned for changed rows
+        :type other_databases: tuple
+        """
+        self.name = name
+        self.directory = directory
+        self.high_water_mark = None
+        # database name -> high-water mark taken from that database
+        self.high_water_marks = {}
+        # key -> {"problem": str, "first_seen": float, "last_seen": float}
+        self.discrepancies = {}
+        # number of chunks that could not be audited
+        self.failed = 0
+        self.load()
+        if full or any(not self.high_water_marks.get(i) for i in other_databases):
+            # state saved without mark of every database, start over
+            self.high_water_mark = None
+            self.high_water_marks = {}
+        if not self.high_water_mark:
+            self.discrepancies = {}
+
+    def __len__(self):
+        return len(self.discrepancies)
+
+    def path(self, extension="json"):
+        return os.path.join(self.directory, "%s.%s" % (self.name, extension))
+
+    def load(self):
+        try:
+            with open(self.path(), "r") as f:
+                state = json.load(f)
+        except (OSError, IOError, ValueError):
+            return
+        self.high_water_mark = state.get("high_water_mark")
+        self.high_water_marks = state.get("high_water_marks", {})
+        self.discrepancies = state.get("discrepancies", {})
+
+    def record(self, key, problem):
+        """
+        Merge audit result of a row into the table
+
+        :param key: row key (pnfsid, bfid, ...)
+        :type key: str
+
+        :param problem: problem description, None if row is fine
+        :type problem: str
+        """
+        if not problem:
+            self.discrepancies.pop(key, None)
+            return
+        now = time.time()
+        entry = self.discrepancies.setdefault(key, {"first_seen": now})
+        entry["problem"] = problem
+        entry["last_seen"] = now
+
+    def save(self, high_water_mark, high_water_marks=None):
+        """
+        Atomically write state with new high-water marks
+        and plain text copy of the table. The previous high-water
+        marks are kept if any chunk failed
+
+        :param high_water_mark: database time taken before the scan
+        :type high_water_mark: str
+
+        :param high_water_marks: database name -> time taken on other database before the scan
+        :type high_water_marks: dict
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        if not self.failed:
+            self.high_water_mark = high_water_mark
+            self.high_water_marks = high_water_marks or {}
+        tmp = self.path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"high_water_mark": self.high_water_mark,
+                       "high_water_marks": self.high_water_marks,
+                       "discrepancies": self.discrepancies}, f)
+        os.rename(tmp, self.path())
+        tmp = self.path("txt") + ".tmp"
+        with open(tmp, "w") as f:
+            for key in sorted(self.discrepancies):
+                entry = self.discrepancies[key]
+                f.write("%s %s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S",
+                                                      time.localtime(entry["first_seen"])),
+                                        key,
+                                        entry["problem"]))
+        os.rename(tmp, self.path("txt"))
+
+
+def collect(results, state, workers):
+    """
+    Merge lists of (key, problem) put on results queue by worker
+    processes into state until every worker sent None. A worker puts
+    False for a chunk it failed to audit. A worker that died without
+    sending None counts as a failure. Meant to run in a thread of the
+    process feeding the workers
+
+    :param results: results queue
+    :type results: multiprocessing.Queue
+
+    :param state: audit state
+    :type state: AuditState
+
+    :param workers: worker processes
+    :type workers: list
+    """
+    done = 0
+    while done < len(workers):
+        try:
+            items = results.get(timeout=10)
+        except Queue.Empty:
+            if any(w.is_alive() for w in workers):
+                continue
+            state.failed += len(workers) - done
+            break
+        if items is None:
+            done += 1
+            continue
+        if items is False:
+            state.failed += 1
+            continue
+        for key, problem in items:
+            state.record(key, problem)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import argparse
 import time
 import os
 import psycopg2
@@ -9,6 +10,9 @@ import re
 import types
 import sys 
 import multiprocessing
+import threading
+
+from audit import AuditState, collect
 
 crc_match = re.compile("[:;]c=1:[a-zA-Z0-9]{8}")
 size_match = re.compile("[:;]l=[0-9]*")
@@ -52,10 +56,24 @@ def print_error(text):
 
 
 
+# pnfsids of a chunk of Enstore files that exist in Chimera
+EXISTING_PNFSIDS_QUERY = """
+SELECT ipnfsid
+FROM t_inodes
+WHERE ipnfsid = ANY(%s)
+"""
+
+
 class Checker(multiprocessing.Process):
-    def __init__(self,queue):
+    """
+    Takes chunks of (label, bfid, pnfsid, path) Enstore rows off
+    the queue, checks which pnfsids exist with one query per chunk
+    and reports the ones that do not
+    """
+    def __init__(self,queue,results=None):
         super(Checker,self).__init__()
         self.queue = queue
+        self.results = results
 
     def run(self):
         pool = PooledDB(psycopg2,
@@ -69,24 +87,93 @@ class Checker(multiprocessing.Process):
         connection = pool.connection()
         cursor = connection.cursor()
 
-        for data in iter(self.queue.get, None):
-            label, bfid, pnfsid, path  = data 
-
-            Q= """
-            select ipnfsid from t_inodes where ipnfsid = %s
-            """
-            cursor.execute(Q, (pnfsid, ))
-            r = cursor.fetchall()
-            if not r:
-                print_error("File does not exist %s %s %s %s" % (label, bfid, pnfsid, path ))
-            connection.commit()
+        for chunk in iter(self.queue.get, None):
+            try:
+                cursor.execute(EXISTING_PNFSIDS_QUERY, ([r[2] for r in chunk], ))
+                existing = set(r[0] for r in cursor.fetchall())
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                print_error("Failed to check %d files %s" % (len(chunk), str(e), ))
+                if self.results:
+                    self.results.put(False)
+                continue
+            results = []
+            for label, bfid, pnfsid, path in chunk:
+                if pnfsid not in existing:
+                    problem = "File does not exist %s %s %s %s" % (label, bfid, pnfsid, path )
+                    print_error(problem)
+                    results.append((bfid, problem))
+                else:
+                    results.append((bfid, None))
+            if self.results:
+                self.results.put(results)
+        if self.results:
+            self.results.put(None)
         cursor.close()
         connection.close()
         pool.close()
 
 
+ENSTORE_QUERY = """
+SELECT v.label,
+       f.bfid,
+       f.pnfs_id,
+       f.pnfs_path,
+       f.deleted
+FROM file f
+INNER JOIN volume v ON v.id = f.volume
+WHERE f.pnfs_id != ''
+  AND v.storage_group NOT IN ('nova', 'cms')
+  AND v.file_family NOT LIKE '%%copy_1'
+"""
+
+# full scan only looks at live files
+LIVE_FILES = """
+  AND f.deleted = 'n'
+"""
+
+# incremental scan also picks up files deleted since previous audit
+# to clear their discrepancies
+CHANGED_SINCE = """
+  AND f.update > %s
+"""
+
+# live Enstore files of a chunk of pnfsids
+PNFSIDS = """
+  AND f.pnfs_id = ANY(%s)
+"""
+
+# pnfsids whose inodes were removed from Chimera since previous audit,
+# their Enstore records are checked again even if nothing changed there
+CHIMERA_DELETED_QUERY = """
+SELECT DISTINCT ipnfsid
+FROM t_locationinfo_trash
+WHERE ictime > %s
+"""
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(
+        description="Check that live Enstore files exist in Chimera. "
+        "With --state_dir only Enstore files changed since previous run and "
+        "live Enstore files whose inodes were removed from Chimera since then "
+        "are checked, and findings are merged into standing discrepancy table "
+        "kept there. Removed inodes are found in t_locationinfo_trash, those "
+        "already purged from it by dCache cleaner before the run are only "
+        "rechecked by --full")
+
+    parser.add_argument(
+        "--state_dir",
+        help="directory to keep high-water mark and discrepancy table in")
+
+    parser.add_argument(
+        "--full", action="store_true",
+        help="ignore high-water mark, check everything and rebuild discrepancy table")
+
+    args = parser.parse_args()
+
     enstoreDbPool = PooledDB(psycopg2,
                              maxconnections=1,
                              maxcached=10,
@@ -96,42 +183,99 @@ if __name__ == "__main__":
                              user="enstore",
                              database="enstoredb")
 
-
-    queue = multiprocessing.Queue(10000)
+    state = AuditState("backward", args.state_dir, args.full,
+                       other_databases=("chimera",)) if args.state_dir else None
 
     cpu_count = multiprocessing.cpu_count()
+    queue = multiprocessing.Queue(2 * cpu_count)
+    results = multiprocessing.Queue(2 * cpu_count) if state else None
     processes = []
 
     for i in range(cpu_count):
-        checker = Checker(queue)
+        checker = Checker(queue,results)
         processes.append(checker)
         checker.start()
 
+    collector = None
+    if state:
+        collector = threading.Thread(target=collect, args=(results, state, processes))
+        collector.start()
+
     db = enstoreDbPool.connection()
-    cursor = db.cursor('cursor_for_backward_scan', cursor_factory=psycopg2.extras.DictCursor)
-    Q="""
-    select v.label, f.bfid, f.pnfs_id, f.pnfs_path 
-           from file f inner join volume v on v.id = f.volume where
-           f.deleted = 'n' and f.pnfs_id != '' and v.storage_group not in  ('nova', 'cms')
-           and v.file_family not like '%copy_1'
-    """
-    
-    cursor.execute(Q)
+    cursor = db.cursor()
+    cursor.execute("select now()")
+    mark = cursor.fetchone()[0].isoformat()
+    cursor.close()
+
+    chimera = chimera_mark = None
+    if state:
+        # Chimera trash ictime is compared with Chimera database time
+        chimera = PooledDB(psycopg2,
+                           maxconnections=1,
+                           maxcached=1,
+                           blocking=True,
+                           host="enstore01",
+                           user="enstore",
+                           database="chimera").connection()
+        chimera_cursor = chimera.cursor()
+        chimera_cursor.execute("select now()")
+        chimera_mark = chimera_cursor.fetchone()[0].isoformat()
+        chimera_cursor.close()
+
+    def scan(cursor, total):
+        """
+        Queue live files fetched by cursor for checking, clear
+        discrepancies of deleted ones
+
+        :return: number of files fetched so far
+        :rtype: int
+        """
+        while True:
+            res = cursor.fetchmany(10000)
+            total += len(res)
+            print_message("Doing %d " % (total, ))
+            if len(res) == 0:
+                break
+            live = []
+            for label, bfid, pnfsid, path, deleted in res:
+                if deleted == 'n':
+                    live.append((label, bfid, pnfsid, path))
+                elif state:
+                    state.record(bfid, None)
+            if live:
+                queue.put(live)
+        return total
+
     total = 0
-    files=0
-    t0 = time.time()
-    while True:
-        res = cursor.fetchmany(10000)
-        ll = len(res)
-        total += ll
-        print_message("Doing %d " % (total, ))
-        if len(res) == 0:
-            break
-        for r in res:
-            queue.put(r)
-        t1 = time.time()
-        t0 = t1
+    chimera_failed = False
+    cursor = db.cursor('cursor_for_backward_scan')
+    if state and state.high_water_mark:
+        cursor.execute(ENSTORE_QUERY + CHANGED_SINCE, (state.high_water_mark, ))
+    else:
+        cursor.execute(ENSTORE_QUERY + LIVE_FILES, ())
+    total = scan(cursor, total)
     cursor.close()
+
+    if state and state.high_water_mark:
+        chimera_cursor = chimera.cursor('cursor_for_deleted_inodes')
+        try:
+            chimera_cursor.execute(CHIMERA_DELETED_QUERY,
+                                   (state.high_water_marks["chimera"], ))
+            while True:
+                res = chimera_cursor.fetchmany(10000)
+                if len(res) == 0:
+                    break
+                cursor = db.cursor()
+                cursor.execute(ENSTORE_QUERY + LIVE_FILES + PNFSIDS,
+                               ([r[0] for r in res], ))
+                total = scan(cursor, total)
+                cursor.close()
+        except Exception as e:
+            print_error("Failed to check files removed from chimera %s" % (str(e), ))
+            chimera_failed = True
+        chimera_cursor.close()
+    if chimera:
+        chimera.close()
     db.close()
 
     for i in range(cpu_count):
@@ -140,4 +284,12 @@ if __name__ == "__main__":
     for process in processes:
         process.join()
 
+    if state:
+        collector.join()
+        if chimera_failed:
+            state.failed += 1
+        state.save(mark, {"chimera" : chimera_mark})
+        print_message("%d files checked, %d discrepancies" % (total, len(state), ))
+        if state.failed:
+            print_error("%d chunks failed, high-water mark not advanced" % (state.failed, ))
 
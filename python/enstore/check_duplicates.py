@@ -13,6 +13,8 @@ import dbaccess
 import copy
 from optparse import OptionParser
 
+from audit import AuditState
+
 
 CHIMERA_QUERY="""
 SELECT t_inodes.ipnfsid,
@@ -26,6 +28,8 @@ LEFT OUTER JOIN t_level_2 l2 ON (l2.ipnfsid=t_inodes.ipnfsid)
 WHERE t_inodes.ipnfsid=%s
 """
 
+# (label, location_cookie) pairs of files updated since the mark,
+# counting all live files on them, unchanged ones included
 DUPLICATE_QUERY="""
 SELECT count(*),
        v.label,
@@ -36,12 +40,25 @@ WHERE f.deleted='n'
   AND v.media_type NOT IN ('null',
                            'disk')
   AND v.system_inhibit_0 != 'DELETED'
-  AND f.update > CURRENT_DATE - interval '7 days'
+  AND (f.volume, f.location_cookie) IN
+    (SELECT c.volume,
+            c.location_cookie
+     FROM file c
+     WHERE c.update > COALESCE(%s::timestamptz, CURRENT_DATE - interval '7 days'))
 GROUP BY f.location_cookie,
          v.label
 HAVING count(*)>1
 """
 
+COUNT_FOR_LOCATION_COOKIE="""
+SELECT count(*)
+FROM file f
+INNER JOIN volume v ON v.id=f.volume
+WHERE f.deleted='n'
+  AND f.location_cookie = %s
+  AND v.label = %s
+"""
+
 GET_PNFSIDS_FOR_LOCATION_COOKIE="""
 SELECT bfid,
        pnfs_id
@@ -68,6 +85,16 @@ if __name__ == "__main__":
                       metavar="QUERY",type=str,
                       help="print query and print  [default: %default] ")
 
+    parser.add_option("-s", "--state_dir",
+                      metavar="DIR",type=str,default=None,
+                      help="directory to keep high-water mark and standing table of "
+                      "duplicates in, only files updated since previous run are "
+                      "checked [default: last 7 days]")
+
+    parser.add_option("--full",default=False,action="store_true",
+                      help="check all files, with --state_dir also rebuild "
+                      "table of duplicates [default: %default]")
+
     (options, args) = parser.parse_args()
 
     csc   = configuration_client.ConfigurationClient((enstore_functions2.default_host(),
@@ -98,11 +125,31 @@ if __name__ == "__main__":
                                         database = dbInfo.get("dbname","enstoredb"))
 
 
+    state = None
     if options.file :
         with open(options.file,"r") as f:
             data = [ i.strip().split() for i in f.readlines()]
     else:
-        data = enstoredb.query(DUPLICATE_QUERY)
+        if options.state_dir:
+            state = AuditState("duplicates", options.state_dir, options.full)
+        mark = enstoredb.query("select now()")[0][0].isoformat()
+        since = None
+        if state and state.high_water_mark:
+            since = state.high_water_mark
+        elif options.full:
+            since = "-infinity"
+        data = enstoredb.query(DUPLICATE_QUERY, (since,))
+        if state:
+            found = set()
+            for datum in data:
+                key = "%s:%s" % (datum[1], datum[2])
+                found.add(key)
+                state.record(key, "%s live files" % (datum[0],))
+            # duplicates found by earlier runs are gone once all but one copy are deleted
+            for key in set(state.discrepancies) - found:
+                label, cookie = key.split(":", 1)
+                count = enstoredb.query(COUNT_FOR_LOCATION_COOKIE, (cookie, label,))[0][0]
+                state.record(key, "%s live files" % (count,) if count > 1 else None)
 
 
     fcc = info_client.infoClient(csc)
@@ -188,6 +235,9 @@ if __name__ == "__main__":
             print "Marking bfid {} , unknown".format(bfid)
             #enstoredb.update("update file set deleted='u' where bfid=%s",(bfid,))
 
+    if state:
+        state.save(mark)
+
     for db in databases:
         db.close()
     enstoredb.close()
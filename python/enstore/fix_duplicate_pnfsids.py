@@ -1,28 +1,24 @@
 #!/bin/env python
 """
-This script takes a file containing list of pnfsids, one pnfsid per line
-and checks if:
+This script finds pnfsids that have more than one non-deleted bfid
+in enstore (or takes them from a file, one pnfsid per line)
+and for each of them checks if:
   1) layer1 corresponds to non-deleted bfid in enstore
   2) marks all bfids deleted that are not equal to layer1 bfid
+
+Duplicates are pulled from enstore with one grouped query, layer 1
+bfids are read from chimera t_level_1 in batches and all deletions
+are applied in a single transaction. Multiple copies and files of
+migrations in progress are not considered duplicates. Without --file
+nothing is changed unless --confirm is given.
 """
 from __future__ import print_function
 import argparse
-import errno
 import multiprocessing
-import os
-import re
-import socket
-import stat
-import subprocess
 import sys
 import time
-import uuid
-import traceback
 import psycopg2
 import psycopg2.extras
-import datetime
-import getpass
-import yaml
 
 try:
     import urlparse
@@ -64,35 +60,6 @@ def print_message(text):
             time.localtime(time.time()))+" INFO : " + text + "\n")
         sys.stdout.flush()
 
-def get_path(pnfsid):
-    """
-    Get path for pnfsid
-    Uses mounts pnfs to do that
-    """
-    path = None
-    with open("/pnfs/fnal.gov/usr/.(pathof)(%s)" % (pnfsid, ), "r") as fh:
-        path = fh.readlines()[0].strip()
-    return path
-
-def get_pnfsid(path):
-    """
-    Get pnfsis for path
-    """
-    pnfsid = None
-    dn = os.path.dirname(path)
-    fn = os.path.basename(path)
-    with open("%s/.(id)(%s)" % (dn, fn,), "r") as fh:
-        pnfsid = fh.readlines()[0].strip()
-    return pnfsid
-
-
-def read_layer(path, layer):
-    dirname = os.path.dirname(path)
-    fname  = os.path.basename(path)
-    layer_file = os.path.join(dirname,'.(use)(%s)(%s)' % (str(layer),fname))
-    with open(layer_file,'r') as fd:
-        return fd.readlines()
-
 
 # create DB connection from URI
 # e.g. "postgresql://enstore@enstore:8888/enstoredb"
@@ -107,50 +74,138 @@ def create_connection(uri):
     return connection
 
 
-class Worker(multiprocessing.Process):
+BATCH_SIZE = 10000
+
+# multiple copies (alt_bfids of file_copies_map on *_copy_1 file
+# families) and both files of a migration that is not closed yet
+# legitimately share pnfs_id with the primary file, they are not
+# duplicates
+DUPLICATE_PNFSIDS_QUERY = """
+SELECT f.pnfs_id,
+       array_agg(f.bfid ORDER BY f.bfid)
+FROM file f
+INNER JOIN volume v ON v.id = f.volume
+WHERE f.deleted = 'n'
+  AND f.pnfs_id != ''
+  AND v.file_family NOT LIKE '%%copy_1'
+  AND NOT EXISTS
+    (SELECT 1
+     FROM file_copies_map fcm
+     WHERE fcm.alt_bfid = f.bfid)
+  AND NOT EXISTS
+    (SELECT 1
+     FROM migration m
+     WHERE (m.src_bfid = f.bfid
+            OR m.dst_bfid = f.bfid)
+       AND m.closed IS NULL)
+  {}
+GROUP BY f.pnfs_id
+HAVING count(*) > 1
+"""
+
+LEVEL_1_QUERY = """
+SELECT i.ipnfsid,
+       encode(l1.ifiledata, 'escape')
+FROM t_inodes i
+INNER JOIN t_level_1 l1 ON l1.inumber = i.inumber
+WHERE i.ipnfsid = ANY(%s)
+"""
+
+MARK_DELETED = """
+UPDATE file
+SET deleted = 'y'
+WHERE bfid = ANY(%s)
+  AND deleted = 'n'
+"""
+
+
+def get_duplicates(enstore_db, pnfsids=None):
     """
-    Class that processed individual enstore volume
+    Get pnfsids that have more than one non-deleted bfid
+
+    :param enstore_db: enstore db connection
+    :type enstore_db: Connection
+
+    :param pnfsids: only look at these pnfsids
+    :type pnfsids: list
+
+    :return: pnfsid -> list of bfids map
+    :rtype: dict
     """
-    def __init__(self, queue, config):
-        super(Worker, self).__init__()
-        self.queue = queue
-        self.config = config
-
-    def run(self):
-        try:
-            # enstroe db
-            enstore_db = create_connection(self.config.get("enstore_db"))
-            for pnfsid in iter(self.queue.get, None):
-                path = get_path(pnfsid)
-                bfid = read_layer(path, 1)
-                if bfid:
-                    bfid = bfid[0]
-                res = select(enstore_db,
-                             "select bfid from file where pnfs_id = %s and deleted = 'n'",
-                             (pnfsid,))
-                bfids = [i[0] for i in res]
-                if bfid not in bfids:
-                    print_error("% has bfid in layer 1 which is marked deleted %s" % (pnfsid, bfid,))
-                    continue
-                other_bfids = [i for i in bfids if i != bfid]
-                if not other_bfids:
-                    continue
-                print_message("%s %s %s" % (pnfsid, bfid, " ".join(other_bfids),))
-                # mark other bfids deleted
-                for i in other_bfids:
-                    update(enstore_db,
-                           "update file set deleted = 'y' where bfid = %s",
-                           (i, ))
-        except Exception as e:
-            print_message("Exception %s" % (str(e)))
-        finally:
-            for i in (enstore_db,):
-                if i:
-                    try:
-                        i.close()
-                    except:
-                        pass
+    if pnfsids:
+        res = select(enstore_db,
+                     DUPLICATE_PNFSIDS_QUERY.format("AND f.pnfs_id = ANY(%s)"),
+                     (pnfsids, ))
+    else:
+        res = select(enstore_db,
+                     DUPLICATE_PNFSIDS_QUERY.format(""),
+                     ())
+    return dict((i[0], i[1]) for i in res)
+
+
+def get_layer1_bfids(chimera_db, pnfsids):
+    """
+    Get layer 1 bfids from chimera
 
+    :param chimera_db: chimera db connection
+    :type chimera_db: Connection
+
+    :param pnfsids: list of pnfsids
+    :type pnfsids: list
+
+    :return: pnfsid -> bfid map
+    :rtype: dict
+    """
+    bfids = {}
+    for i in range(0, len(pnfsids), BATCH_SIZE):
+        res = select(chimera_db,
+                     LEVEL_1_QUERY,
+                     (pnfsids[i:i + BATCH_SIZE], ))
+        for pnfsid, layer1 in res:
+            if layer1:
+                bfids[pnfsid] = layer1.split("\n")[0].strip()
+    return bfids
+
+
+def resolve(duplicates, layer1_bfids):
+    """
+    Pick layer 1 bfid as the one to keep for each pnfsid
+
+    :param duplicates: pnfsid -> list of bfids map
+    :type duplicates: dict
+
+    :param layer1_bfids: pnfsid -> layer 1 bfid map
+    :type layer1_bfids: dict
+
+    :return: list of (pnfsid, bfid to keep, bfids to delete)
+    :rtype: list
+    """
+    resolved = []
+    for pnfsid in sorted(duplicates):
+        bfids = duplicates[pnfsid]
+        bfid = layer1_bfids.get(pnfsid)
+        if not bfid:
+            print_error("%s has no layer 1, not fixing %s" % (pnfsid, " ".join(bfids),))
+            continue
+        if bfid not in bfids:
+            print_error("%s has bfid in layer 1 which is marked deleted %s" % (pnfsid, bfid,))
+            continue
+        resolved.append((pnfsid, bfid, [i for i in bfids if i != bfid]))
+    return resolved
+
+
+def print_diff(resolved):
+    """
+    Print changes to file table as a diff, kept bfid
+    as context line and bfids to be deleted as removed lines
+    """
+    print("--- file (deleted = 'n')")
+    print("+++ file (deleted = 'n') fixed")
+    for pnfsid, bfid, other_bfids in resolved:
+        print("@@ %s @@" % (pnfsid, ))
+        print(" %s" % (bfid, ))
+        for i in other_bfids:
+            print("-%s" % (i, ))
 
 
 def update(con, sql, pars):
@@ -258,7 +313,7 @@ def select(con, sql, pars=None):
     cursor = None
     try:
         cursor = con.cursor()
-        if pars:
+        if pars is not None:
             cursor.execute(sql, pars)
         else:
             cursor.execute(sql)
@@ -276,49 +331,81 @@ def main():
     main function
     """
     configuration = {"enstore_db" :
-                     "postgresql://enstore@enstore00:8888/enstoredb"}
+                     "postgresql://enstore@enstore00:8888/enstoredb",
+                     "chimera_db" :
+                     "postgresql://enstore@enstore01/chimera"}
 
     parser = argparse.ArgumentParser()
 
 
     parser.add_argument(
         "--file",
-        help="A file with list of pnfsids")
+        help="A file with list of pnfsids, if not given all "
+        "duplicate pnfsids in enstore db are fixed")
 
+    parser.add_argument(
+        "--dry_run", action="store_true",
+        help="find what has to be fixed, do not change anything")
 
-    args = parser.parse_args()
+    parser.add_argument(
+        "--confirm", action="store_true",
+        help="without --file runs are dry runs unless this is given")
 
-    if not args.file:
-        parser.print_help(sys.stderr)
-        sys.exit(1)
+    parser.add_argument(
+        "--diff", action="store_true",
+        help="print changes to file table as a diff")
+
+    args = parser.parse_args()
 
     pnfsids = None
-    with open(args.file, "r") as f:
-        pnfsids = [i.strip() for i in f.readlines()]
+    if args.file:
+        with open(args.file, "r") as f:
+            pnfsids = [i.strip() for i in f.readlines() if i.strip()]
 
-    if not pnfsids:
-         print_error("**** No files found, quitting ***")
-         sys.exit(1)
+        if not pnfsids:
+             print_error("**** No files found, quitting ***")
+             sys.exit(1)
 
-    print_message("**** Start processing %d  files ****" % (len(pnfsids), ))
+    # whole db run only changes anything when explicitly confirmed
+    dry_run = args.dry_run or (not args.file and not args.confirm)
 
-    queue = multiprocessing.Queue(10000)
-    workers = []
-    cpu_count = multiprocessing.cpu_count()
+    enstore_db = chimera_db = None
+    try:
+        enstore_db = create_connection(configuration.get("enstore_db"))
+        chimera_db = create_connection(configuration.get("chimera_db"))
 
-    for i in range(cpu_count):
-        worker = Worker(queue, configuration)
-        workers.append(worker)
-        worker.start()
+        duplicates = get_duplicates(enstore_db, pnfsids)
 
-    for pnfsid in pnfsids:
-        queue.put(pnfsid)
+        print_message("**** Start processing %d  files ****" % (len(duplicates), ))
 
-    for i in range(cpu_count):
-        queue.put(None)
+        layer1_bfids = get_layer1_bfids(chimera_db, list(duplicates))
+        resolved = resolve(duplicates, layer1_bfids)
 
-    map(lambda x: x.join(), workers);
+        if args.diff:
+            print_diff(resolved)
+        else:
+            for pnfsid, bfid, other_bfids in resolved:
+                print_message("%s %s %s" % (pnfsid, bfid, " ".join(other_bfids),))
 
+        other_bfids = [i for r in resolved for i in r[2]]
+        if dry_run:
+            print_message("Dry run, would mark %d bfids of %d files deleted" %
+                          (len(other_bfids), len(resolved), ))
+        elif other_bfids:
+            # mark other bfids deleted, all or nothing
+            update(enstore_db, MARK_DELETED, (other_bfids, ))
+            print_message("Marked %d bfids of %d files deleted" %
+                          (len(other_bfids), len(resolved), ))
+    except Exception as e:
+        print_error("Exception %s" % (str(e)))
+        sys.exit(1)
+    finally:
+        for i in (enstore_db, chimera_db):
+            if i:
+                try:
+                    i.close()
+                except:
+                    pass
 
     print_message("**** FINISH ****")
 
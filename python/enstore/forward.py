@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import argparse
 import time
 import os
 import psycopg2
@@ -7,13 +8,13 @@ import psycopg2.extras
 from DBUtils.PooledDB import PooledDB
 import enstore_functions2
 import configuration_client
-import re
 import types
 import sys 
 import multiprocessing
+import threading
 
-crc_match = re.compile("[:;]c=1:[a-zA-Z0-9]{8}")
-size_match = re.compile("[:;]l=[0-9]*")
+from audit import AuditState, collect
+from layers import File
 
 printLock = multiprocessing.Lock()
 
@@ -32,219 +33,141 @@ def convert_0_adler32_to_1_adler32(crc, filesize):
     return (s2 << 16) + s1
 
 
+# Enstore file records for a chunk of bfids found in layer 1
+ENSTORE_QUERY = """
+SELECT f.bfid,
+       f.crc,
+       f.location_cookie,
+       f.pnfs_name0,
+       f.pnfs_id,
+       f.size,
+       v.file_family,
+       v.label
+FROM file f
+INNER JOIN volume v ON v.id = f.volume
+WHERE f.bfid = ANY(%s)
+"""
+
+# number of Chimera rows per chunk resolved with one Enstore query
+CHUNK_SIZE = 10000
+
+
+def check_file(f, bfid_info):
+    """
+    Compare Chimera layers of a file to its Enstore file record
+
+    :param f: file built from Chimera layers
+    :type f: File
+
+    :param bfid_info: (bfid, crc, location_cookie, pnfs_name0,
+                       pnfs_id, size, file_family, label) or None
+    :type bfid_info: tuple
+
+    :return: errors, warnings
+    :rtype: tuple
+    """
+    errors = []
+    warnings = []
+
+    if not bfid_info:
+        errors.append('no file record for bfid %s' % (f.bfid, ))
+        return errors, warnings
+
+    bfid, crc, location_cookie, pnfs_name0, pnfs_id, size, file_family, label = bfid_info
+
+    if f.layer2:
+        if not f.layer2.crc :
+            warnings.append('no layer 2 crc')
+        if not f.layer2.size:
+            warnings.append('no layer 2 size')
+    if not f.layer4:
+        errors.append('no layer 4')
+    else:
+        if f.get_layer4_original_name() != pnfs_name0:
+            warnings.append('original_name != pnfs_name0')
+        if f.get_layer4_volume() != label:
+            warnings.append('layer4 volume != external_label')
+            warnings.append(label)
+        if f.get_layer4_size() != int(size):
+            warnings.append('layer4 size != size')
+        if f.get_layer4_file_family() != file_family:
+            warnings.append('layer4 file != family')
+        if f.get_layer4_location_cookie() != location_cookie:
+            warnings.append('layer4 location_cookie != location_cookie')
+        if f.get_layer4_pnfsid() != pnfs_id:
+            warnings.append('layer4 pnfsid != pnfsid')
+        if f.get_layer4_bfid() != bfid:
+            warnings.append('layer4 bfid != bfid')
+        if f.get_layer4_crc() != int(crc):
+            warnings.append('layer4 crc != crc')
+    return errors, warnings
+
+
 class Checker(multiprocessing.Process):
-    def __init__(self,queue,db):
+    """
+    Takes chunks of Chimera rows off the queue, fetches Enstore
+    records of all their bfids with one query and compares them
+    in a single pass
+    """
+    def __init__(self,queue,db,results=None):
         super(Checker,self).__init__()
         self.queue = queue
         self.db    = db
+        self.results = results
 
-    def run(self):
-        for data in iter(self.queue.get, None):
-            f=data
-            if f.bfid: 
-                enstoreDB = self.db.connection()
-                enstoreCursor = enstoreDB.cursor()
-                q= "select f.*, v.file_family, v.label from file f, volume v where v.id=f.volume and bfid='{}'".format(f.bfid)
-                enstoreCursor.execute(q)
-                try: 
-                    bfid_info= enstoreCursor.fetchall()[0]
-                    enstoreCursor.close()
-                    enstoreDB.close()
-                    errors = []
-                    warnings = []
-                    info = []
-
-                    if f.layer2:
-                        if not f.layer2.crc :
-                            warnings.append('no layer 2 crc')
-                        if not f.layer2.size:
-                            warnings.append('no layer 2 size')
-                    if not f.layer4:
-                        errors.append('no layer 4')
-                    else:
-                        if f.get_layer4_original_name() != bfid_info[6]:
-                            warnings.append('original_name != pnfs_name0')
-                        if f.get_layer4_volume() != bfid_info[25]:
-                            warnings.append('layer4 volume != external_label')
-                            warnings.append(bfid_info[25])
-                        if f.get_layer4_size() != int(bfid_info[10]):
-                            warnings.append('layer4 size != size')
-                        if f.get_layer4_file_family() != bfid_info[24]:
-                            warnings.append('layer4 file != family')
-                        if f.get_layer4_location_cookie() != bfid_info[5]:
-                            warnings.append('layer4 location_cookie != location_cookie')
-                        if f.get_layer4_pnfsid() != bfid_info[7]:
-                            warnings.append('layer4 pnfsid != pnfsid')
-                        if f.get_layer4_bfid() != bfid_info[0]:
-                            warnings.append('layer4 bfid != bfid')
-                        if f.get_layer4_crc() != int(bfid_info[1]):
-                            warnings.append('layer4 crc != crc')
-                except Exception, msg:
-                    errors.append(str(msg))
-                errors_and_warnings(f.pnfsid,errors,warnings,info)
-
-
-                
-
-class Layer2:
-    def __init__(self,data):
-        lines = data.split('\n')
-        self.crc = None
-        self.size = None
-        
-        for l in lines:
-            if not l: continue
-            match = crc_match.search(l)
-            if match:
-                self.crc = match.group().split(":")[-1]
-            match = size_match.search(l)
-            if match:
-                try:
-                    self.size = int(match.group().split("=")[-1])
-                except:
-                    pass 
-                    
-
-class Layer4:
-    def __init__(self,data):
-        """
-        VP6362
-        0000_000000000_0012297
-        53339
-        fardet_data
-        /pnfs/fnal.gov/usr/minos/fardet_data/2014-06/F00061014_0000.mdaq.root
-        
-        0000148F88B823494729A4D973C8AEFB79B2
-        
-        CDMS140314378602481
-        stkenmvr213a:/dev/rmt/tps5d0n:1310250822
-        235446335
+    def get_bfid_info(self, bfids):
         """
-        lines = data.split('\n')
-        self.volume = None
-        self.location_cookie = None
-        self.size = None
-        self.file_family = None
-        self.original_name = None
-        self.pnfsid = None
-        self.bfid = None
-        self.drive = None
-        self.crc = None
+        Get Enstore records for a list of bfids
 
-        try:
-            self.volume = lines[0].strip()
-            self.location_cookie = lines[1].strip()
-            self.size = int(lines[2].strip())
-            self.file_family = lines[3].strip()
-            self.original_name = lines[4].strip()
-            self.pnfsid = lines[6].strip()
-            self.bfid = lines[8].strip()
-            self.drive = lines[9].strip()
-            self.crc = int(lines[10].strip())
-        except:
-            pass
-
-    def  __repr__(self):
-        info = """
-        {}
-        {}
-        {}
-        {}
-        {}
-
-        {}
-
-        {}
-        {}
-        {}
+        :param bfids: list of bfids
+        :type bfids: list
+
+        :return: bfid -> record map
+        :rtype: dict
         """
-        return info.format(self.volume,
-                           self.location_cookie,
-                           self.size,
-                           self.file_family,
-                           self.original_name,
-                           self.pnfsid,
-                           self.bfid,
-                           self.drive,
-                           self.crc)
-    
-    
+        enstoreDB = self.db.connection()
+        try:
+            enstoreCursor = enstoreDB.cursor()
+            try:
+                enstoreCursor.execute(ENSTORE_QUERY, (bfids, ))
+                return dict((r[0], r) for r in enstoreCursor.fetchall())
+            finally:
+                enstoreCursor.close()
+        finally:
+            enstoreDB.close()
+
+    def run(self):
+        for chunk in iter(self.queue.get, None):
+            files = [f for f in (File(r) for r in chunk) if f.bfid]
+            if not files:
+                continue
+            try:
+                records = self.get_bfid_info([f.bfid for f in files])
+            except Exception, msg:
+                for f in files:
+                    errors_and_warnings(f.pnfsid, [str(msg)], [], [])
+                if self.results:
+                    self.results.put(False)
+                continue
+            results = []
+            for f in files:
+                try:
+                    errors, warnings = check_file(f, records.get(f.bfid))
+                except Exception, msg:
+                    errors, warnings = [str(msg)], []
+                errors_and_warnings(f.pnfsid, errors, warnings, [])
+                if errors:
+                    results.append((f.pnfsid, 'ERROR ' + ' ... '.join(errors + warnings)))
+                elif warnings:
+                    results.append((f.pnfsid, 'WARNING ' + ' ... '.join(warnings)))
+                else:
+                    results.append((f.pnfsid, None))
+            if self.results:
+                self.results.put(results)
+        if self.results:
+            self.results.put(None)
 
-class File:
-    def __init__(self, row):
-        self.pnfsid=row[0]
-        self.size=long(row[1])
-        self.bfid=row[2] if row[2] else None
-        self.layer2=Layer2(row[3]) if row[3] else None
-        self.layer4=Layer4(row[4]) if row[4] else None
-
-    def get_layer2_crc(self):
-        if self.layer2:
-            return self.layer2.crc
-        else:
-            return None
-
-    def get_layer2_size(self):
-        if self.layer2:
-            return self.layer2.size
-        else:
-            return None
-
-    def get_layer4_crc(self):
-        if self.layer4:
-            return self.layer4.crc
-        else:
-            return None
-
-    def get_layer4_size(self):
-        if self.layer4:
-            return self.layer4.size
-        else:
-            return None
-
-    def get_layer4_volume(self):
-        if self.layer4:
-            return self.layer4.volume
-        else:
-            return None
-
-    def get_layer4_location_cookie(self):
-        if self.layer4:
-            return self.layer4.location_cookie
-        else:
-            return None
-
-    def get_layer4_file_family(self):
-        if self.layer4:
-            return self.layer4.file_family
-        else:
-            return None
-
-    def get_layer4_pnfsid(self):
-        if self.layer4:
-            return self.layer4.pnfsid
-        else:
-            return None
-
-    def get_layer4_bfid(self):
-        if self.layer4:
-            return self.layer4.bfid
-        else:
-            return None
-
-    def get_layer4_drive(self):
-        if self.layer4:
-            return self.layer4.drive
-        else:
-            return None
-
-    def get_layer4_original_name(self):
-        if self.layer4:
-            return self.layer4.original_name
-        else:
-            return None
 
-    
 def errors_and_warnings(fname, error, warning, information):
 
     printLock.acquire()
@@ -272,11 +195,67 @@ def errors_and_warnings(fname, error, warning, information):
          
 
 
+CHIMERA_QUERY = """
+SELECT t_inodes.ipnfsid,
+       t_inodes.isize,
+       encode(l1.ifiledata,'escape') AS layer1,
+       encode(l2.ifiledata,'escape') AS layer2,
+       encode(l4.ifiledata,'escape') AS layer4
+FROM t_inodes
+LEFT OUTER JOIN t_level_4 l4 ON (l4.ipnfsid=t_inodes.ipnfsid)
+LEFT OUTER JOIN t_level_1 l1 ON (l1.ipnfsid=t_inodes.ipnfsid)
+LEFT OUTER JOIN t_level_2 l2 ON (l2.ipnfsid=t_inodes.ipnfsid)
+WHERE t_inodes.itype=32768
+"""
+
+# only inodes or layers changed since previous audit
+CHANGED_SINCE = """
+  AND (t_inodes.imtime > %(mark)s
+       OR t_inodes.ictime > %(mark)s
+       OR l1.imtime > %(mark)s
+       OR l2.imtime > %(mark)s
+       OR l4.imtime > %(mark)s)
+"""
+
+# pnfsids of Enstore files changed since previous audit, their
+# inodes are checked again even if nothing changed in Chimera
+ENSTORE_CHANGED_QUERY = """
+SELECT pnfs_id
+FROM file
+WHERE update > %s
+  AND pnfs_id != ''
+"""
+
+# inodes of a chunk of pnfsids
+PNFSIDS = """
+  AND t_inodes.ipnfsid = ANY(%(pnfsids)s)
+"""
+
+
 if __name__ == "__main__":
 
 #    csc   = configuration_client.ConfigurationClient((enstore_functions2.default_host(),
 #                                                      enstore_functions2.default_port()))
 
+    parser = argparse.ArgumentParser(
+        description="Check Chimera layers against Enstore file records. "
+        "With --state_dir only inodes whose attributes or layers changed "
+        "since previous run, or whose Enstore file record changed, are checked "
+        "and findings are merged into standing discrepancy table kept there. "
+        "Layers deleted without being written again, inodes removed from "
+        "Chimera and Enstore records whose pnfs_id does not match the inode "
+        "are only rechecked by --full")
+
+    parser.add_argument(
+        "--state_dir",
+        help="directory to keep high-water mark and discrepancy table in")
+
+    parser.add_argument(
+        "--full", action="store_true",
+        help="ignore high-water mark, check everything and rebuild discrepancy table")
+
+    args = parser.parse_args()
+
     enstoreDbPool = PooledDB(psycopg2,
                              maxconnections=20,
                              maxcached=10,
@@ -296,43 +275,76 @@ if __name__ == "__main__":
                     user="enstore",
                     database="chimera")
 
-    queue = multiprocessing.Queue(10000)
+    state = AuditState("forward", args.state_dir, args.full,
+                       other_databases=("enstore",)) if args.state_dir else None
 
     cpu_count = multiprocessing.cpu_count()
+    queue = multiprocessing.Queue(2 * cpu_count)
+    results = multiprocessing.Queue(2 * cpu_count) if state else None
     processes = []
 
     for i in range(cpu_count):
-        checker = Checker(queue,enstoreDbPool)
+        checker = Checker(queue,enstoreDbPool,results)
         processes.append(checker)
         checker.start()
 
+    collector = None
+    if state:
+        collector = threading.Thread(target=collect, args=(results, state, processes))
+        collector.start()
+
     db = pool.connection()
-    cursor = db.cursor('cursor_for_scan', cursor_factory=psycopg2.extras.DictCursor)
-    cursor.execute("select t_inodes.ipnfsid, t_inodes.isize,\
-                       encode(l1.ifiledata,'escape') as layer1, \
-                       encode(l2.ifiledata,'escape') as layer2, \
-                       encode(l4.ifiledata,'escape') as layer4 from \
-                       t_inodes  left outer join t_level_4 l4 on (l4.ipnfsid=t_inodes.ipnfsid) \
-                       left outer join t_level_1 l1 on (l1.ipnfsid=t_inodes.ipnfsid) \
-                       left outer join t_level_2 l2 on (l2.ipnfsid=t_inodes.ipnfsid) where \
-                       t_inodes.itype=32768")
+    cursor = db.cursor()
+    cursor.execute("select now()")
+    mark = cursor.fetchone()[0].isoformat()
+    cursor.close()
+
+    enstore_mark = None
+    if state:
+        # Enstore file.update is compared with Enstore database time
+        enstore_db = enstoreDbPool.connection()
+        enstore_cursor = enstore_db.cursor()
+        enstore_cursor.execute("select now()")
+        enstore_mark = enstore_cursor.fetchone()[0].isoformat()
+        enstore_cursor.close()
+        enstore_db.close()
+
+    cursor = db.cursor('cursor_for_scan')
+    if state and state.high_water_mark:
+        cursor.execute(CHIMERA_QUERY + CHANGED_SINCE,
+                       {"mark" : state.high_water_mark})
+    else:
+        cursor.execute(CHIMERA_QUERY)
 
     total = 0
-    files=0
-    t0 = time.time()
     while True:
-        res = cursor.fetchmany(10000)
-        ll = len(res)
-        total += ll
+        res = cursor.fetchmany(CHUNK_SIZE)
         if len(res) == 0:
             break
-        for r in res:
-            f = File(r)
-            if f.bfid : files += 1 
-            queue.put(f)
-        t1 = time.time()
-        t0 = t1
+        total += len(res)
+        queue.put(res)
     cursor.close()
+
+    if state and state.high_water_mark:
+        # inodes of files changed on Enstore side, may repeat
+        # some of the inodes above, checking them twice is harmless
+        enstore_db = enstoreDbPool.connection()
+        enstore_cursor = enstore_db.cursor('cursor_for_changed')
+        enstore_cursor.execute(ENSTORE_CHANGED_QUERY,
+                               (state.high_water_marks["enstore"], ))
+        while True:
+            pnfsids = [i[0] for i in enstore_cursor.fetchmany(CHUNK_SIZE)]
+            if not pnfsids:
+                break
+            cursor = db.cursor()
+            cursor.execute(CHIMERA_QUERY + PNFSIDS, {"pnfsids" : pnfsids})
+            res = cursor.fetchall()
+            cursor.close()
+            if res:
+                total += len(res)
+                queue.put(res)
+        enstore_cursor.close()
+        enstore_db.close()
     db.close()
 
     for i in range(cpu_count):
@@ -341,4 +353,10 @@ if __name__ == "__main__":
     for process in processes:
         process.join()
 
+    if state:
+        collector.join()
+        state.save(mark, {"enstore" : enstore_mark})
+        sys.stderr.write("%d inodes checked, %d discrepancies\n" % (total, len(state), ))
+        if state.failed:
+            sys.stderr.write("%d chunks failed, high-water mark not advanced\n" % (state.failed, ))
 
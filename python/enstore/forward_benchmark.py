@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark comparing shipping one File object per row across
+process boundary, as forward.py used to do, with shipping chunks of
+raw rows and parsing them into slotted File records in the checker,
+as forward.py does now. Rows are synthetic Chimera layer rows, queue
+transfer is measured as pickling round trip. The per object path uses
+a copy of the former forward.py record classes below.
+"""
+import argparse
+import cPickle as pickle
+import random
+import sys
+import time
+
+import layers
+
+CRC_MATCH = layers.crc_match
+SIZE_MATCH = layers.size_match
+
+LAYER4 = "\n".join(("VP%04d",
+                    "0000_000000000_%07d",
+                    "%d",
+                    "fardet_data",
+                    "/pnfs/fnal.gov/usr/minos/fardet_data/2014-06/F%08d_0000.mdaq.root",
+                    "",
+                    "%s",
+                    "",
+                    "%s",
+                    "stkenmvr213a:/dev/rmt/tps5d0n:1310250822",
+                    "%d",
+                    ""))
+
+LAYER2 = "2,0,0,0.0,0.0\n:c=1:%08x;h=yes;l=%d;\n"
+
+
+#
+# record classes of forward.py before chunked shipping
+#
+
+class BaselineLayer2:
+    def __init__(self,data):
+        lines = data.split('\n')
+        self.crc = None
+        self.size = None
+
+        for l in lines:
+            if not l: continue
+            match = CRC_MATCH.search(l)
+            if match:
+                self.crc = match.group().split(":")[-1]
+            match = SIZE_MATCH.search(l)
+            if match:
+                try:
+                    self.size = int(match.group().split("=")[-1])
+                except:
+                    pass
+
+
+class BaselineLayer4:
+    def __init__(self,data):
+        """
+        VP6362
+        0000_000000000_0012297
+        53339
+        fardet_data
+        /pnfs/fnal.gov/usr/minos/fardet_data/2014-06/F00061014_0000.mdaq.root
+
+        0000148F88B823494729A4D973C8AEFB79B2
+
+        CDMS140314378602481
+        stkenmvr213a:/dev/rmt/tps5d0n:1310250822
+        235446335
+        """
+        lines = data.split('\n')
+        self.volume = None
+        self.location_cookie = None
+        self.size = None
+        self.file_family = None
+        self.original_name = None
+        self.pnfsid = None
+        self.bfid = None
+        self.drive = None
+        self.crc = None
+
+        try:
+            self.volume = lines[0].strip()
+            self.location_cookie = lines[1].strip()
+            self.size = int(lines[2].strip())
+            self.file_family = lines[3].strip()
+            self.original_name = lines[4].strip()
+            self.pnfsid = lines[6].strip()
+            self.bfid = lines[8].strip()
+            self.drive = lines[9].strip()
+            self.crc = int(lines[10].strip())
+        except:
+            pass
+
+    def  __repr__(self):
+        info = """
+        {}
+        {}
+        {}
+        {}
+        {}
+
+        {}
+
+        {}
+        {}
+        {}
+        """
+        return info.format(self.volume,
+                           self.location_cookie,
+                           self.size,
+                           self.file_family,
+                           self.original_name,
+                           self.pnfsid,
+                           self.bfid,
+                           self.drive,
+                           self.crc)
+
+
+
+class BaselineFile:
+    def __init__(self, row):
+        self.pnfsid=row[0]
+        self.size=long(row[1])
+        self.bfid=row[2] if row[2] else None
+        self.layer2=BaselineLayer2(row[3]) if row[3] else None
+        self.layer4=BaselineLayer4(row[4]) if row[4] else None
+
+    def get_layer2_crc(self):
+        if self.layer2:
+            return self.layer2.crc
+        else:
+            return None
+
+    def get_layer2_size(self):
+        if self.layer2:
+            return self.layer2.size
+        else:
+            return None
+
+    def get_layer4_crc(self):
+        if self.layer4:
+            return self.layer4.crc
+        else:
+            return None
+
+    def get_layer4_size(self):
+        if self.layer4:
+            return self.layer4.size
+        else:
+            return None
+
+    def get_layer4_volume(self):
+        if self.layer4:
+            return self.layer4.volume
+        else:
+            return None
+
+    def get_layer4_location_cookie(self):
+        if self.layer4:
+            return self.layer4.location_cookie
+        else:
+            return None
+
+    def get_layer4_file_family(self):
+        if self.layer4:
+            return self.layer4.file_family
+        else:
+            return None
+
+    def get_layer4_pnfsid(self):
+        if self.layer4:
+            return self.layer4.pnfsid
+        else:
+            return None
+
+    def get_layer4_bfid(self):
+        if self.layer4:
+            return self.layer4.bfid
+        else:
+            return None
+
+    def get_layer4_drive(self):
+        if self.layer4:
+            return self.layer4.drive
+        else:
+            return None
+
+    def get_layer4_original_name(self):
+        if self.layer4:
+            return self.layer4.original_name
+        else:
+            return None
+
+
+def make_rows(count):
+    rows = []
+    for i in range(count):
+        pnfsid = "0000%032X" % (i, )
+        bfid = "CDMS%d00000" % (1300000000 + i, )
+        size = random.randint(0, 1 << 32)
+        crc = random.randint(0, (1 << 32) - 1)
+        rows.append((pnfsid,
+                     size,
+                     bfid,
+                     LAYER2 % (crc, size),
+                     LAYER4 % (i % 10000, i, size, i, pnfsid, bfid, crc)))
+    return rows
+
+
+def per_object(rows):
+    """
+    one File per row, pickled and unpickled individually
+    """
+    count = 0
+    for r in rows:
+        f = pickle.loads(pickle.dumps(BaselineFile(r), pickle.HIGHEST_PROTOCOL))
+        if f.bfid:
+            count += 1
+    return count
+
+
+def per_chunk(rows, chunk_size):
+    """
+    chunks of raw rows pickled and unpickled, parsed on arrival
+    """
+    count = 0
+    for i in range(0, len(rows), chunk_size):
+        chunk = pickle.loads(pickle.dumps(rows[i:i + chunk_size],
+                                          pickle.HIGHEST_PROTOCOL))
+        for f in (layers.File(r) for r in chunk):
+            if f.bfid:
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Compare rows/s of per object and per chunk "
+        "record shipping used by forward.py")
+
+    parser.add_argument(
+        "--rows",
+        action="store",
+        type=int,
+        default=200000,
+        help="number of synthetic rows")
+
+    parser.add_argument(
+        "--chunk_size",
+        action="store",
+        type=int,
+        default=10000,
+        help="rows per chunk, forward.CHUNK_SIZE")
+
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+
+    t0 = time.time()
+    n1 = per_object(rows)
+    t1 = time.time() - t0
+
+    t0 = time.time()
+    n2 = per_chunk(rows, args.chunk_size)
+    t2 = time.time() - t0
+
+    if n1 != n2:
+        sys.stderr.write("Per chunk path saw %d files, per object %d\n" % (n2, n1))
+        return 1
+
+    print "%d rows" % (args.rows, )
+    print "per object : %.3f s, %d rows/s" % (t1, args.rows / t1)
+    print "per chunk  : %.3f s, %d rows/s" % (t2, args.rows / t2)
+    print "speedup    : %.1f" % (t1 / t2, )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Chimera file records built from t_inodes row and layers 1, 2 and 4,
+used by forward.py. Kept free of Enstore and database dependencies
+so that forward_benchmark.py can use them standalone.
+"""
+import re
+
+crc_match = re.compile("[:;]c=1:[a-zA-Z0-9]{8}")
+size_match = re.compile("[:;]l=[0-9]*")
+
+
+class Layer2(object):
+    """
+    crc and size from layer 2, parsed once with a search over the
+    whole text. Slotted to keep per file memory and pickle size small
+    """
+    __slots__ = ("crc", "size")
+
+    def __init__(self,data):
+        self.crc = None
+        self.size = None
+
+        crcs = crc_match.findall(data)
+        if crcs:
+            self.crc = crcs[-1].split(":")[-1]
+        for match in reversed(size_match.findall(data)):
+            try:
+                self.size = int(match.split("=")[-1])
+                break
+            except ValueError:
+                pass
+
+
+class Layer4(object):
+    __slots__ = ("volume", "location_cookie", "size", "file_family",
+                 "original_name", "pnfsid", "bfid", "drive", "crc")
+
+    def __init__(self,data):
+        lines = data.split('\n', 11)
+        self.volume = None
+        self.location_cookie = None
+        self.size = None
+        self.file_family = None
+        self.original_name = None
+        self.pnfsid = None
+        self.bfid = None
+        self.drive = None
+        self.crc = None
+
+        try:
+            self.volume = lines[0].strip()
+            self.location_cookie = lines[1].strip()
+            self.size = int(lines[2].strip())
+            self.file_family = lines[3].strip()
+            self.original_name = lines[4].strip()
+            self.pnfsid = lines[6].strip()
+            self.bfid = lines[8].strip()
+            self.drive = lines[9].strip()
+            self.crc = int(lines[10].strip())
+        except:
+            pass
+
+    def  __repr__(self):
+        info = """
+        {}
+        {}
+        {}
+        {}
+        {}
+
+        {}
+
+        {}
+        {}
+        {}
+        """
+        return info.format(self.volume,
+                           self.location_cookie,
+                           self.size,
+                           self.file_family,
+                           self.original_name,
+                           self.pnfsid,
+                           self.bfid,
+                           self.drive,
+                           self.crc)
+    
+    
+
+class File(object):
+    """
+    Chimera file with its layers. Built in Checker processes from
+    raw rows, which are shipped across the queue in chunks
+    """
+    __slots__ = ("pnfsid", "size", "bfid", "layer2", "layer4")
+
+    def __init__(self, row):
+        self.pnfsid=row[0]
+        self.size=long(row[1])
+        self.bfid=row[2] if row[2] else None
+        self.layer2=Layer2(row[3]) if row[3] else None
+        self.layer4=Layer4(row[4]) if row[4] else None
+
+    def get_layer2_crc(self):
+        if self.layer2:
+            return self.layer2.crc
+        else:
+            return None
+
+    def get_layer2_size(self):
+        if self.layer2:
+            return self.layer2.size
+        else:
+            return None
+
+    def get_layer4_crc(self):
+        if self.layer4:
+            return self.layer4.crc
+        else:
+            return None
+
+    def get_layer4_size(self):
+        if self.layer4:
+            return self.layer4.size
+        else:
+            return None
+
+    def get_layer4_volume(self):
+        if self.layer4:
+            return self.layer4.volume
+        else:
+            return None
+
+    def get_layer4_location_cookie(self):
+        if self.layer4:
+            return self.layer4.location_cookie
+        else:
+            return None
+
+    def get_layer4_file_family(self):
+        if self.layer4:
+            return self.layer4.file_family
+        else:
+            return None
+
+    def get_layer4_pnfsid(self):
+        if self.layer4:
+            return self.layer4.pnfsid
+        else:
+            return None
+
+    def get_layer4_bfid(self):
+        if self.layer4:
+            return self.layer4.bfid
+        else:
+            return None
+
+    def get_layer4_drive(self):
+        if self.layer4:
+            return self.layer4.drive
+        else:
+            return None
+
+    def get_layer4_original_name(self):
+        if self.layer4:
+            return self.layer4.original_name
+        else:
+            return None
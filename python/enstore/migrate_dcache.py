@@ -4,36 +4,31 @@ import argparse
 import errno
 import multiprocessing
 import os
-import re
-import socket
-import subprocess
 import sys
 import time
-import uuid
-import paramiko
-import psycopg2
-import psycopg2.extras
 import yaml
 
-try:
-    from DBUtils.PooledDB import PooledDB
-except ModuleNotFoundError:
-    from dbutils.pooled_db import PooledDB
-
-try:
-    import urlparse
-except ModuleNotFoundError:
-    import urllib.parse as urlparse
-
-import pandas as pd
-from tabulate import tabulate
+from migration import (print_error, print_message, load_profile, get_shell,
+                       create_connection, get_path,
+                       print_progress, updater,
+                       get_active_pools_in_pool_group, get_precious_fraction,
+                       get_locations, get_locations_bulk, get_existing_pnfsids,
+                       get_label_system_inhibit, mark_precious_on_location,
+                       clear_file_cache_location, bust_layers, mark_migrated,
+                       KinitWorker, kinit, kinitLock,
+                       Readiness, StageScheduler, RESTAGE_INTERVAL)
+from pending import PendingFiles, ONLINE, DONE
 
 PNFS_HOME = "/pnfs/fs/usr"
 
-printLock = multiprocessing.Lock()
-kinitLock = multiprocessing.Lock()
+# files of a label are checked on pnfs mount instead of chimera
+# when all of them or more than this fraction are missing there,
+# as that rather means wrong or empty chimera_db
+MAX_MISSING_FRACTION = 0.1
+
+# staged file is given up on after failing to be marked migrated this many times
+MAX_MIGRATE_ATTEMPTS = 5
 
-UUID = str(uuid.uuid4())
 
 """
 The SQL below creates table in Enstore database
@@ -65,383 +60,17 @@ if not CONFIG_FILE:
     CONFIG_FILE = "migration.yaml"
 
 
-HOSTNAME = socket.gethostname()
-SSH_HOST = "fndca"
-SSH_PORT = 24223
-SSH_USER = "enstore"
-POOL_GROUP = "CdfWritePools"
-
-
-# v.media_type in ('LTO8', 'LTO9')
-
-UPDATER_SQL = """
-UPDATE file_migrate
-SET dst_bfid = t.bfid
-FROM
-  (SELECT fm.src_bfid AS src_bfid,
-          f.bfid AS bfid
-   FROM file_migrate fm
-   INNER JOIN FILE f ON fm.pnfsid = f.pnfs_id
-   INNER JOIN volume v ON f.volume = v.id
-   AND f.deleted = 'n'
-   AND v.file_family like '%MIGRATION2'
---   AND v.storage_group = 'cms'
-   AND v.library in ('TFF2-LTO9M', 'TFF1-LTO9M')
---   AND v.media_type in ('LTO8', 'LTO9')
-   AND fm.dst_bfid IS NULL) AS t
-WHERE t.src_bfid = file_migrate.src_bfid
-  AND file_migrate.dst_bfid IS NULL
-"""
-
-SELECT_FOR_SFA_UPDATE = """
-SELECT f.bfid,
-       fm.dst_bfid
-FROM FILE f
-INNER JOIN file_migrate fm ON f.bfid = fm.src_bfid
-INNER JOIN FILE f1 ON f1.bfid = fm.dst_bfid
-INNER JOIN volume v on v.id = f1.volume
-WHERE f.package_id = f.bfid
-  AND fm.dst_bfid IS NOT NULL
-  AND f1.package_id IS NULL
---   AND v.file_family like '%MIGRATION2'
-  AND v.library = 'TFF2-LTO9M'
-"""
-
-SWAP_PACKAGE  = """
-select swap_package(%s, %s)
-"""
-
-UPDATE_STATUS="""
-UPDATE FILE
-SET archive_status='ARCHIVED',
-    cache_status = 'PURGED'
-WHERE bfid=%s
-"""
-
-PROGRESS_SQL = """
-SELECT to_char(sum(CASE
-                       WHEN dst_bfid IS NOT NULL THEN f.size
-                       ELSE 0
-                   END)/1024./1024./1024./1024., '99999D9') AS migrated,
-       to_char(sum(CASE
-                       WHEN dst_bfid IS NOT NULL THEN 0
-                       ELSE f.size
-                   END)/1024./1024./1024./1024., '999D9') AS precious,
-       v.storage_group
-FROM FILE f
-INNER JOIN volume v ON v.id = f.volume
-INNER JOIN file_migrate fm ON f.bfid = fm.src_bfid
-GROUP BY v.storage_group
-"""
-
-PROGRESS_FOR_SG_SQL = """
-SELECT to_char(sum(CASE
-                       WHEN dst_bfid IS NOT NULL THEN f.size
-                       ELSE 0
-                   END)/1024./1024./1024./1024., '99999D9') AS migrated,
-       to_char(sum(CASE
-                       WHEN dst_bfid IS NOT NULL THEN 0
-                       ELSE f.size
-                   END)/1024./1024./1024./1024., '999D9') AS precious
-FROM FILE f
-INNER JOIN volume v ON v.id = f.volume
-INNER JOIN file_migrate fm ON f.bfid = fm.src_bfid
-WHERE v.storage_group = %s
-"""
-
-
-def print_progress(sg=None):
-    connection = None
-    try:
-        connection = psycopg2.connect(database="enstoredb",
-                                      host="enstore00",
-                                      port=8888,
-                                      user="enstore")
-        if sg:
-            data = pd.read_sql_query(PROGRESS_FOR_SG_SQL % (sg, ),
-                                     connection)
-        else:
-            data = pd.read_sql_query(PROGRESS_SQL,
-                                     connection)
-        print(tabulate(data,
-                       headers='keys',
-                       tablefmt='psql'))
-    finally:
-        if connection:
-            try:
-                connection.close()
-            except:
-                pass
-
-
-def updater():
-    cursor = connection = None
-    try:
-        connection = psycopg2.connect(database="enstoredb",
-                                      host="enstore00",
-                                      port=8888,
-                                      user="enstore")
-        cursor = connection.cursor()
-        cursor.execute(UPDATER_SQL)
-        connection.commit()
-
-
-        res = select(connection,
-                     SELECT_FOR_SFA_UPDATE,
-                     None,
-                     cursor_factory=psycopg2.extras.RealDictCursor)
-        for r in res:
-            cursor.execute(SWAP_PACKAGE,
-                           (r.get("bfid"), r.get("dst_bfid")))
-            connection.commit()
-            cursor.execute(UPDATE_STATUS, (r.get("dst_bfid"),))
-            connection.commit()
-
-        return 0
-    except Exception as e:
-        return 1
-    finally:
-        for i in (cursor, connection):
-            try:
-                i.close()
-            except:
-                pass
-
-
-def execute_command(cmd):
-    """
-    Executes shell command
-
-    :param cmd: command string
-    :type cmd: str
-    :return: shell command return code
-    :rtype: int
-    """
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True)
-    output, errors = p.communicate()
-    rc = p.returncode
-    return rc
-
-
-KRB5CCNAME = "/tmp/krb5cc_root.migration-%s"%(UUID,)
-os.environ["KRB5CCNAME"] = KRB5CCNAME
-
-
-def kinit():
-    """
-    Create kerberos ticket for admin shell access
-    """
-
-    cmd = "/usr/bin/kinit -k host/%s"%(HOSTNAME)
-    execute_command(cmd)
-
-
-def get_shell(host=SSH_HOST, port=SSH_PORT, user=SSH_USER):
-    """
-    Admin shell
-    """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=host,
-                port=port,
-                username=user,
-                gss_auth=True,
-                gss_kex=True)
-    return ssh
-
-
-def execute_admin_command(ssh, cmd):
-    """
-    Execute admin shell command
-    """
-    stdin, stdout, stderr = ssh.exec_command(cmd)
-    if len(stderr.readlines()) > 0:
-        raise RuntimeError(" ".join(stderr.readlines()))
-    return [i.strip().replace(r"\r","\n") for i in stdout.readlines() if i.strip().replace(r"\r", "\n") != ""]
-
-
-def is_cached(ssh, pnfsid):
-    """
-    Check if file is cached
-    """
-    result = execute_admin_command(ssh, "\sn cacheinfoof " + pnfsid)
-    if not result:
-        return False
-    else:
-        return True
-
-
-def get_locations(ssh, pnfsid):
-    result = execute_admin_command(ssh, "\sn cacheinfoof " + pnfsid)
-    if result:
-        return result[0].split()
-    else:
-        return []
-
-
-def mark_precious(ssh, pnfsid):
-    """
-    marks pnfsid on all locations as precious
-    """
-    result = execute_admin_command(ssh, "\sl " + pnfsid + " rep set precious " + pnfsid)
-    return True
-
-
-def mark_cached(ssh, pnfsid):
-    """
-    marks pnfsid on all locations as cached
-    """
-    result = execute_admin_command(ssh, "\sl " + pnfsid + " rep set cached " + pnfsid)
-    return True
-
-
-def mark_precious_on_location(ssh, pool, pnfsid):
-    """
-    marks pnfsid on a pool as precious
-    """
-    result = execute_admin_command(ssh, "\s " + pool + " rep set precious " + pnfsid)
-    print_message("Marked precious %s %s %s" % (pnfsid, pool, result, ))
-    return True
-
-
-def clear_file_cache_location(ssh, pool, pnfsid):
-    """
-    clear file cache location
-    """
-    result = execute_admin_command(ssh, "\sn clear file cache location  " + pnfsid + " " + pool)
-    print_message("Cleared file cache location %s %s %s" % (pnfsid, pool, result, ))
-    return True
-
-def get_precious_fraction(ssh, pool):
-    """
-    return fraction of precious data on pool
-    """
-    result = execute_admin_command(ssh, "\s " + pool + " info -a")
-    lines = [i.strip() for i in result]
-    percentage = 0
-    for line in lines:
-        if line.find("Precious") != -1:
-            percentage = float(re.sub("[\[-\]]","", line.split()[-1]))
-            break
-    return percentage
-
-
-def get_active_pools_in_pool_group(ssh, pgroup):
-    """
-    Get list of pools in a  pool group
-    """
-    result = execute_admin_command(ssh, "\s PoolManager  psu ls pgroup -a " + pgroup)
-    pools = []
-    hasPoolList = False
-    for line in result:
-        i = line.strip()
-        if not i:
-            continue
-        if i.strip().find("nested groups") != -1:
-            break
-        if i.strip().startswith("poolList :"):
-            hasPoolList = True
-            continue
-        if hasPoolList:
-            parts = i.split()
-            if parts[1].find("mode=disabled") != -1:
-                continue
-            pool = parts[0].strip()
-            pools.append(pool)
-    return pools
-
-
-def stage(ssh, pool, pnfsid):
-    """
-    Schedule restore of file by pnfsid on a pool
-    """
-    cmd = "\s " + pool + " rh restore " + pnfsid
-    result = execute_admin_command(ssh, cmd)
-
-
-def print_error(text):
-    """
-    Print text string to stderr prefixed with timestamp
-    and ERROR keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stderr.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" ERROR : " + text + "\n")
-        sys.stderr.flush()
-
-
-def print_message(text):
-    """
-    Print text string to stdout prefixed with timestamp
-    and INFO keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stdout.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" INFO : " + text + "\n")
-        sys.stdout.flush()
-
-
-def get_path(pnfsid):
-    """
-    Get path for pnfsid
-    Uses mounts pnfs to do that
-    """
-    path = None
-    with open("/pnfs/fnal.gov/usr/.(pathof)(%s)" % (pnfsid, ), "r") as fh:
-        path = fh.readlines()[0].strip()
-    return path
-
-
-# create DB connection from URI
-def create_connection(uri):
-    result = urlparse.urlparse(uri)
-    return PooledDB(psycopg2,
-                    maxconnections=1,
-                    maxcached=1,
-                    blocking=True,
-                    database=result.path[1:],
-                    user=result.username,
-                    password=result.password,
-                    host=result.hostname,
-                    port=result.port)
-
-
-class KinitWorker(multiprocessing.Process):
-    def __init__(self):
-        super(KinitWorker, self).__init__()
-        self.stop = False
-
-    def run(self):
-        while not self.stop:
-            with kinitLock:
-                kinit()
-                time.sleep(14400)
-
-
 class StageWorker(multiprocessing.Process):
     """
     This class is responsible for staging files into source dCache system
     """
-    def __init__(self, stage_queue, pool, config):
+    def __init__(self, stage_queue, pool, config, request_queue, scheduler_stopped):
         super(StageWorker, self).__init__()
         self.stage_queue = stage_queue
         self.pool = pool
         self.config = config
+        self.request_queue = request_queue
+        self.scheduler_stopped = scheduler_stopped
 
     def run(self):
         """
@@ -452,22 +81,27 @@ class StageWorker(multiprocessing.Process):
         """
 
         # admin shell
-        ssh = get_shell(self.config.get("admin").get("host", SSH_HOST),
-                        self.config.get("admin").get("port", SSH_PORT),
-                        self.config.get("admin").get("user", SSH_USER))
+        ssh = get_shell(self.config["admin"]["host"],
+                        self.config["admin"]["port"],
+                        self.config["admin"]["user"])
         # db connection pool to enstore db
         pool = create_connection(self.config.get("enstore_db"))
         # db connection pool to chimera db
         chimera_pool = create_connection(self.config.get("chimera_db"))
 
+        readiness = Readiness(self.pool, self.config.get("kafka"))
+
         while True:
+            if self.scheduler_stopped.is_set():
+                print_error("%s: Stage scheduler exited, quitting" % (self.pool, ))
+                break
             # before next label
             try:
                 precious_fraction = get_precious_fraction(ssh, self.pool)
                 while precious_fraction > 0.1:
                     print_message("%s pool has %d percent precious, sleeping" %
                                   (self.pool, int(precious_fraction * 100),))
-                    time.sleep(600)
+                    readiness.wait()
                     precious_fraction = get_precious_fraction(ssh, self.pool)
             except RuntimeError as e:
                 print_message("%s: Failed to query pool for spaces, sleeping, retrying" %
@@ -496,7 +130,7 @@ class StageWorker(multiprocessing.Process):
                     continue
 
                 try:
-                    cursor.execute("select f.bfid, f.pnfs_id, f.crc, f.size "
+                    cursor.execute("select f.bfid, f.pnfs_id, f.crc, f.size, f.location_cookie "
                                    "from file f inner join volume v on v.id = f.volume "
                                    "left outer join file_migrate fm on f.bfid = fm.src_bfid where v.label = %s "
                                    "and f.deleted = 'n' and "
@@ -507,27 +141,52 @@ class StageWorker(multiprocessing.Process):
                         self.stage_queue.task_done()
                         continue
                     files = []
+                    cookies = dict((i[1], i[4]) for i in res)
                     pnfs_mounted = True
+                    missing = []
+                    try:
+                        existing = get_existing_pnfsids(chimera_pool, [i[1] for i in res])
+                    except Exception as e:
+                        print_error("%s %s: Failed to check files in chimera, "
+                                    "falling back to pnfs %s" % (self.pool, label, str(e), ))
+                        existing = None
+                    if existing is not None:
+                        absent = len([i for i in res if i[1] not in existing])
+                        if absent and (absent == len(res) or
+                                       absent > MAX_MISSING_FRACTION * len(res)):
+                            print_error("%s %s: %d of %d files not found in chimera, check "
+                                        "chimera_db, falling back to pnfs" %
+                                        (self.pool, label, absent, len(res), ))
+                            existing = None
                     for i in res:
+                        if existing is not None:
+                            if i[1] in existing:
+                                files.append((i[0], i[1], i[2], i[3]))
+                            else:
+                                missing.append(i)
+                            continue
                         try:
                             p = get_path(i[1])
                             files.append((i[0], i[1], i[2], i[3]))
                         except (OSError, IOError) as e:
                             if e.errno == errno.ENOENT:
-                                try:
-                                    if os.path.exists(PNFS_HOME):
-                                        print_error("%s %s %s Does not exist, mark deleted "%(label, i[0], i[1]))
-                                        cursor.execute("update file set deleted = 'y' where bfid = %s", (i[0],))
-                                        connection.commit()
-                                    else:
-                                        pnfs_mounted = False
-                                        break
-                                except Exception as e:
-                                    print_error("%s %s Failed to set file deleted: %s" % (label, i[0], str(e)))
-                                    connection.rollback()
-                                    continue
+                                if os.path.exists(PNFS_HOME):
+                                    missing.append(i)
+                                else:
+                                    pnfs_mounted = False
+                                    break
                             else:
                                 raise
+                    if missing and pnfs_mounted:
+                        for i in missing:
+                            print_error("%s %s %s Does not exist, mark deleted "%(label, i[0], i[1]))
+                        try:
+                            cursor.execute("update file set deleted = 'y' where bfid = any(%s)",
+                                           ([i[0] for i in missing], ))
+                            connection.commit()
+                        except Exception as e:
+                            print_error("%s Failed to set %d files deleted: %s" % (label, len(missing), str(e)))
+                            connection.rollback()
 
                 except Exception as e:
                     print_error("Failed to retrieve files for label %s %s" % (label, str(e)))
@@ -549,10 +208,10 @@ class StageWorker(multiprocessing.Process):
                 self.stage_queue.task_done()
                 break
 
-            number_of_files = len(files)
-            total = number_of_files
-            print("Doing label %s, number of files %d" % (label, number_of_files))
-            cached = loop = count = 0
+            total = len(files)
+            print("Doing label %s, number of files %d" % (label, total))
+            cached = loop = 0
+            last_cached = 0
             pools = []
             try:
                 pools = get_active_pools_in_pool_group(ssh,
@@ -560,39 +219,34 @@ class StageWorker(multiprocessing.Process):
             except RuntimeError as e:
                 print_error("%s %s: Failed to query pools" % (self.pool, label, ))
                 continue
-            while files:
-                count += 1
-                bfid, pnfsid, crc, fsize = files.pop(0)
-                locations = []
-                try:
-                    locations = get_locations(ssh, pnfsid)
-                except RuntimeError as e:
-                    print_error("%s %s: Failed to get locations for %s" % (self.pool, label, pnfsid, ))
-                    files.append((bfid, pnfsid, crc, fsize))
-                    continue
-                location = ""
-                for i in locations:
-                    if i in pools:
-                        location = i
-                if not location:
-                    files.append((bfid, pnfsid, crc, fsize))
-                    try:
-                        stage(ssh, self.pool, pnfsid)
-                    except RuntimeError as e:
-                        print_error("%s %s: Stage failed, %s, Sleeping 10 seconds", (self.pool, label, pnfsid,))
-                        time.sleep(10)
-                else:
+            pending = PendingFiles(label, files, self.config.get("state_dir"))
+            while pending:
+                locations_map = self.get_locations_map(chimera_pool, label, pending.remaining())
+                for bfid, pnfsid, crc, fsize in pending.remaining():
+                    locations = []
+                    if locations_map is not None:
+                        locations = locations_map.get(pnfsid, [])
+                    else:
+                        try:
+                            locations = get_locations(ssh, pnfsid)
+                        except RuntimeError as e:
+                            print_error("%s %s: Failed to get locations for %s" % (self.pool, label, pnfsid, ))
+                            continue
+                    location = ""
+                    for i in locations:
+                        if i in pools:
+                            location = i
+                    if not location:
+                        if pending.should_request(pnfsid, RESTAGE_INTERVAL):
+                            self.request_queue.put((self.pool, label, cookies.get(pnfsid), pnfsid))
+                        continue
                     # file is online
                     cached += 1
+                    pending.set_state(pnfsid, ONLINE)
                     #print_message("%s File is online, calling mark_precious %s %s" % (label, bfid, pnfsid))
                     #rc = mark_precious(ssh, pnfsid)
                     try:
                         rc = mark_precious_on_location(ssh, location, pnfsid)
-                        try:
-                            rc = bust_layers(chimera_pool, (label, bfid, pnfsid, crc, self.pool))
-                            rc = mark_migrated(pool, (label, bfid, pnfsid, crc, self.pool))
-                        except:
-                            pass
                     except Exception as e:
                         print_error("%s, %s : %s %s Failed to mark precious on location %s , %s" %
                                     (self.pool, label, bfid, pnfsid, location, str(e), ))
@@ -601,262 +255,85 @@ class StageWorker(multiprocessing.Process):
                         except Exception as e:
                             print_error("%s, %s : %s %s Failed to clear file cache location %s , %s" %
                                         (self.pool, label, bfid, pnfsid, location, str(e), ))
-                        files.append((bfid, pnfsid, crc, fsize))
-                        try:
-                            stage(ssh, self.pool, pnfsid)
-                        except RuntimeError as e:
-                            print_error("%s %s: Stage failed, %s, Sleeping 10 seconds", (self.pool, label, pnfsid,))
-                            time.sleep(10)
-
-                if count == number_of_files and files:
-                    loop += 1
-                    number_of_files = len(files)
-                    print_message("%s, %s : %d staged, %d total, %d remain,  %d pass" %
-                                  (self.pool, label, cached, total,  number_of_files, loop))
-                    count = 0
-                    #
-                    # Check that label is still OK
-                    #
-                    inhibit = get_label_system_inhibit(pool, label)
-                    if inhibit in ('NOACCESS', 'NOTALLOWED',):
-                        print_error("%s, %s : %s, Skipping " % (self.pool, label, inhibit, ))
-                        break
-                    print_message("%s, %s Sleeping" % (self.pool, label, ))
-                    pools = get_active_pools_in_pool_group(ssh, self.config.get("pool_group"))
-                    time.sleep(600)
-
+                        pending.mark_requested(pnfsid)
+                        self.request_queue.put((self.pool, label, cookies.get(pnfsid), pnfsid))
+                        continue
+                    # file is done only once it is recorded in file_migrate,
+                    # otherwise it stays online and is retried next pass
+                    entry = (label, bfid, pnfsid, crc, self.pool)
+                    if bust_layers(chimera_pool, entry) and \
+                       mark_migrated(pool, entry, by_pnfsid=True):
+                        pending.set_state(pnfsid, DONE)
+                    elif pending.fail(pnfsid, MAX_MIGRATE_ATTEMPTS):
+                        print_error("%s, %s : %s %s Failed to mark migrated %d times, giving up" %
+                                    (self.pool, label, bfid, pnfsid, MAX_MIGRATE_ATTEMPTS, ))
+                    else:
+                        print_error("%s, %s : %s %s Failed to mark migrated, will retry" %
+                                    (self.pool, label, bfid, pnfsid, ))
+
+                pending.save()
+                if not pending:
+                    break
+                loop += 1
+                print_message("%s, %s : %d staged, %d total, %d remain,  %d pass" %
+                              (self.pool, label, cached, total, len(pending), loop))
+                if self.scheduler_stopped.is_set():
+                    break
+                #
+                # Check that label is still OK
+                #
+                inhibit = get_label_system_inhibit(pool, label)
+                if inhibit in ('NOACCESS', 'NOTALLOWED',):
+                    print_error("%s, %s : %s, Skipping " % (self.pool, label, inhibit, ))
+                    break
+                print_message("%s, %s Sleeping" % (self.pool, label, ))
+                pools = get_active_pools_in_pool_group(ssh, self.config.get("pool_group"))
+                readiness.wait(cached > last_cached)
+                last_cached = cached
+
+            if self.scheduler_stopped.is_set():
+                # files left are kept in pending snapshot for next run
+                print_error("%s, %s : Stage scheduler exited, quitting" % (self.pool, label, ))
+                self.stage_queue.task_done()
+                break
+            # drop restore requests of files left, if label was skipped
+            self.request_queue.put((self.pool, label, None, None))
+            if not pending:
+                pending.remove()
+            failed = pending.failed()
+            if failed:
+                print_error("%s, %s : %d files failed to be marked migrated" %
+                            (self.pool, label, len(failed), ))
             # label is done here
             print_message("%s, %s : Done" % (self.pool, label, ))
             self.stage_queue.task_done()
         ssh.close()
         return
 
+    def get_locations_map(self, chimera_pool, label, files):
+        """
+        Resolve cache locations of all remaining files of a label
+        with a single Chimera query per batch
 
-def update(con, sql, pars):
-    """
-    Update database record
-
-    :param con: database connection
-    :type con: Connection
-
-    :param sql: SQL statement
-    :type sql: str
-
-    :param pars: query parameters
-    :type pars: tuple
-
-    :return: result
-    :rtype: object
-    """
-    return insert(con, sql, pars)
-
-
-def insert(con, sql, pars):
-    """
-    Insert database record
-
-    :param con: database connection
-    :type con: Connection
-
-    :param sql: SQL statement
-    :type sql: str
-
-    :param pars: query parameters
-    :type pars: tuple
-
-    :return: result
-    :rtype: object
-    """
-    cursor = None
-    try:
-        cursor = con.cursor()
-        cursor.execute(sql, pars)
-        con.commit()
-    except Exception:
-        con.rollback()
-        raise
-    finally:
-        if cursor:
-            try:
-                cursor.close()
-            except Exception:
-                pass
-
-
-def select(con, sql, pars, cursor_factory=None):
-    """
-    Select  database records
-
-    :param con: database connection
-    :type con: Connection
-
-    :param sql: SQL statement
-    :type sql: str
-
-    :param pars: query parameters
-    :type pars: tuple
-
-    :return: result
-    :rtype: object
-    """
-    cursor = None
-    try:
-        if cursor_factory:
-            cursor = con.cursor(cursor_factory=cursor_factory)
-        else:
-            cursor = con.cursor()
-        cursor.execute(sql, pars)
-        return cursor.fetchall()
-    finally:
-        if cursor:
-            try:
-                cursor.close()
-            except Exception:
-                pass
-
-
-def get_label_system_inhibit(pool, label):
-    """
-    get label status
-    """
-    connection = None
-    try:
-        connection = pool.connection()
-        res = select(connection, "select system_inhibit_0 from volume where label = %s", (label, ))
-        return res[0][0]
-    except Exception as e:
-            print_error("%s Failed to query system inhibit for label %s " % (pool, label, ))
-            pass
-    except Exception as e:
-        print_error("%s Failed to get connection when querying system inhibit for label %s" % (pool, label, ))
-        pass
-    finally:
-        try:
-            if connection:
-                connection.close()
-        except Exception:
-            pass
-    return None
-
-
-def bust_layers(pool, entry):
-    """
-    Delete layers
-    """
-    connection = None
-    label, bfid, pnfsid, crc, dcache_pool = entry
-    try:
-        connection = pool.connection()
-        try:
-            res = select(connection, "select pnfsid2inumber(%s)", (pnfsid, ))
-            inumber = res[0][0]
-            res = insert(connection, "delete from t_level_1 where inumber=%s", (inumber, ))
-            res = insert(connection, "delete from t_level_4 where inumber=%s", (inumber, ))
-            res = insert(connection, "delete from t_storageinfo where inumber=%s", (inumber, ))
-            res = insert(connection, "delete from t_locationinfo where inumber=%s and itype=0", (inumber, ))
-            return True
-        except Exception as e:
-            print_error("%s Failed to drop layers  %s %s %s " % (label, bfid, pnfsid, str(e)))
-            pass
-    except Exception as e:
-        print_error("%s Failed to get connection when trying to drop layers %s %s %s" % (label, bfid, pnfsid, str(e),))
-        pass
-    finally:
-        try:
-            if connection:
-                connection.close()
-        except Exception:
-            pass
-    return False
-
-
-def mark_migrated(pool, entry):
-    """
-    Mark source file migrated
-
-    :param pool: database connection pool
-    :type pool: PooledDB
-
-    :param entry: (label, bfid, file, src) source data
-    :type entry: tuple
-
-    :param destination: destination full file path name
-    :type destination: str
-
-    :param check: Mark checked or nor
-    :type check: bool
-
-    :return: true / false
-    :rtype: bool
-    """
-    connection = None
-    label, bfid, pnfsid, crc, dcache_pool = entry
-    try:
-        connection = pool.connection()
-        try:
-            res = insert(connection, "insert into file_migrate (src_bfid, pnfsid) "
-                                     "values (%s, %s)", (bfid, pnfsid,))
-
-            #res = update(connection, "update file set deleted = 'y' where bfid = %s", (bfid, ))
-            res = update(connection, "update file set deleted = 'y' where pnfs_id = %s and deleted = 'n'", (pnfsid, ))
-            return True
-        except Exception as e:
-            print_error("%s Failed to insert into file_migrate %s %s %s " % (label, bfid, pnfsid, str(e)))
-            pass
-    except Exception as e:
-        print_error("%s Failed to get connection when inserting into file_migrate %s" % (label, str(e),))
-        pass
-    finally:
-        try:
-            if connection:
-                connection.close()
-        except Exception:
-            pass
-    return False
-
-
-def mark_unmigrated(pool, entry):
-    """
-    Revert file to original state so it can be re-migrated
-
-    :param pool: database connection pool
-    :type pool: PooledDB
-
-    :param entry: (label, bfid, file, src) source data
-    :type entry: tuple
+        :param chimera_pool: chimera database connection pool
+        :type chimera_pool: PooledDB
 
-    :param destination: destination full file path name
-    :type destination: str
+        :param label: volume label
+        :type label: str
 
-    :param check: Mark checked or nor
-    :type check: bool
+        :param files: list of (bfid, pnfsid, crc, size) tuples
+        :type files: list
 
-    :return: true / false
-    :rtype: bool
-    """
-    connection = None
-    label, bfid, pnfsid, crc, dcache_pool = entry
-    try:
-        connection = pool.connection()
+        :return: pnfsid -> list of pools map or None if Chimera query failed,
+                 in which case caller falls back to per file admin shell lookup
+        :rtype: dict
+        """
         try:
-            res = insert(connection, "delete from file_migrate where src_bfid = %s ",
-                                     (bfid, ))
-
-            res = update(connection, "update file set deleted = 'n' where bfid = %s and deleted = 'y'", (bfid, ))
-            return True
+            return get_locations_bulk(chimera_pool, [i[1] for i in files])
         except Exception as e:
-            print_error("%s Failed to insert into file_migrate %s %s %s " % (label, bfid, pnfsid, str(e)))
-            pass
-    except Exception as e:
-        print_error("%s Failed to get connection when inserting into file_migrate %s" % (label, str(e),))
-        pass
-    finally:
-        try:
-            if connection:
-                connection.close()
-        except Exception:
-            pass
-    return False
+            print_error("%s %s: Failed to get locations from chimera, "
+                        "falling back to admin shell %s" % (self.pool, label, str(e), ))
+            return None
 
 
 def main():
@@ -891,6 +368,12 @@ def main():
         "--update", action='store_true',
         help="run updater")
 
+    parser.add_argument(
+        "--site",
+        default="public",
+        help="site profile (public, cms, cdf, d0) providing defaults "
+        "for values missing in configuration")
+
     args = parser.parse_args()
 
 
@@ -912,15 +395,18 @@ def main():
         print_error("Failed to load configuration %s" % (CONFIG_FILE,))
         sys.exit(1)
 
+    try:
+        configuration = load_profile(args.site, configuration)
+    except (ValueError, OSError, IOError, yaml.YAMLError) as e:
+        print_error("Failed to load site profile %s %s" % (args.site, str(e), ))
+        sys.exit(1)
+
     if args.progress:
-        if args.sg:
-            print_progress(args.sg)
-        else:
-            print_progress()
+        print_progress(configuration, args.sg)
         sys.exit(0)
 
     if args.update:
-        sys.exit(updater())
+        sys.exit(updater(configuration))
 
     if not args.file and not args.label:
         parser.print_help(sys.stderr)
@@ -950,19 +436,28 @@ def main():
     stage_queue = multiprocessing.JoinableQueue()
     stage_workers = []
 
+    # Kerberos ticket cache of this run is empty until first kinit
+    with kinitLock:
+        kinit()
+
     kinitWorker = KinitWorker()
     kinitWorker.start()
 
-    ssh = get_shell(configuration.get("admin").get("host", SSH_HOST),
-                    configuration.get("admin").get("port", SSH_PORT),
-                    configuration.get("admin").get("user", SSH_USER))
+    request_queue = multiprocessing.Queue()
+    scheduler = StageScheduler(request_queue, configuration)
+    scheduler.start()
+
+    ssh = get_shell(configuration["admin"]["host"],
+                    configuration["admin"]["port"],
+                    configuration["admin"]["user"])
 
     pools = get_active_pools_in_pool_group(ssh, configuration.get("pool_group"))
     cpu_count = len(pools)
     ssh.close()
 
     for pool in pools:
-        worker = StageWorker(stage_queue, pool, configuration)
+        worker = StageWorker(stage_queue, pool, configuration, request_queue,
+                             scheduler.stopped)
         stage_workers.append(worker)
         worker.start()
 
@@ -972,7 +467,17 @@ def main():
     for i in range(cpu_count):
         stage_queue.put(None)
 
-    stage_queue.join()
+    while any(w.is_alive() for w in stage_workers):
+        if not scheduler.is_alive():
+            print_error("Stage scheduler exited, quitting")
+            for w in stage_workers:
+                w.terminate()
+            kinitWorker.terminate()
+            sys.exit(1)
+        time.sleep(10)
+
+    request_queue.put(None)
+    scheduler.join()
 
     kinitWorker.stop = True
     kinitWorker.terminate()
@@ -1,110 +1,19 @@
 #!/usr/bin/env python
 
 import argparse
-import errno
-import json
 import multiprocessing
 import os
-import random
 import re
-import socket
 import stat
-import subprocess
-import sys
 import time
 
 import psycopg2
 import psycopg2.extras
-from DBUtils.PooledDB import PooledDB
-
-try:
-    from urllib2 import Request, urlopen
-except ImportError:
-    from urllib.request import Request, urlopen
-    pass
-
-printLock = multiprocessing.Lock()
-
-
-def print_error(text):
-    """
-    Print text string to stderr prefixed with timestamp
-    and ERROR keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stderr.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" ERROR : " + text + "\n")
-        sys.stderr.flush()
-
-
-def print_message(text):
-    """
-    Print text string to stdout prefixed with timestamp
-    and INFO keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stdout.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" INFO : " + text + "\n")
-        sys.stdout.flush()
-
-
-BASE = 65521
-
-
-def convert_0_adler32_to_1_adler32(crc, filesize):
-    """
-    Converts ADLER32 seeded 0 checksum to ADLER32 seeded 1 (correct) checksum
-
-    :param crc: ADLER32 seeded 0 checksum value
-    :type crc: str
-
-    :param  filesize: file size
-    :type filesize: int
-
-    :return: ADLER32 seeded 1 checksum value with leading 0x dropped
-    :rtype: str
-    """
-    crc = int(crc)
-    filesize = int(filesize)
-    size = int(filesize % BASE)
-    s1 = (crc & 0xffff)
-    s2 = ((crc >> 16) & 0xffff)
-    s1 = (s1 + 1) % BASE
-    s2 = (size + s2) % BASE
-    return hex((s2 << 16) + s1).split('x')[1]
-
-
-def execute_command(cmd):
-    """
-    Executes shell command
-
-    :param cmd: command string
-    :type cmd: str
-    :return: shell command return code
-    :rtype: int
-    """
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True)
-    output, errors = p.communicate()
-    rc = p.returncode
-#    if rc != 0:
-#       print_error(errors)
-    return rc
 
+from migration import (print_error, print_message, load_profile,
+                       execute_command, convert_0_adler32_to_1_adler32,
+                       get_random_door, get_ftp_doors, create_connection,
+                       select, get_local_checksum, get_pnfsid, touch, mark_copied)
 
 CDF_GFTP = ("gsiftp://cdfdca1.fnal.gov", "gsiftp://cdfdca2.fnal.gov", "gsiftp://cdfdca3.fnal.gov")
 
@@ -140,71 +49,6 @@ CDF_DCAP = ("dcap://cdfdca1.fnal.gov:22125",
             "dcap://cdfdca3.fnal.gov:25164")
 
 
-def wrapper(func, args=None):
-    """
-    Execute a function wih retry loop
-
-    :param func: function
-    :type func: function
-    :param args: function parameter list
-    :type args: list
-    :return: result of function execution
-    """
-    if not args:
-        args = ()
-    count = 0
-    while count < 10:
-        try:
-            return func(*args)
-        except (OSError, IOError) as e:
-            count += 1
-            if e.errno in (errno.EBUSY, errno.ELOOP, errno.ESTALE, errno.ENOENT, errno.EIO):
-                if count < 10:
-                    time.sleep(0.5)
-                else:
-                    raise
-
-
-def get_random_door(door_list):
-    """
-    Select a random item from a list
-
-    :param door_list: list of doors
-    :type door_list: list
-    :return: a random item from the list
-    """
-    length = len(door_list)
-    return door_list[random.randint(0, length - 1)]
-
-
-def get_ftp_doors(system="fndca3b.fnal.gov"):
-    """
-    Get list of FTP doors from info provoder of destination dCache system
-    :param system: name of the host running info provider
-    :type system: string
-    :return: list of GFTP doors
-    :type: list
-    """
-    url = "http://%s:2288/info/doors?format=json" % (system,)
-    request = Request(url)
-    request.add_header("Accept", "application/json")
-    response = urlopen(request)
-    data = json.load(response)
-    doors = [i for i in data.values() if i.get("protocol").get("family") == "gsiftp"]
-    door_list = []
-    fqdn = None
-    for d in doors:
-        for key, value in d.get("interfaces").items():
-            if value.get("scope") != "global":
-                continue
-            fqdn = socket.gethostbyaddr(value.get("address"))[0]
-        port = d.get("port")
-        protocol = d.get("protocol").get("family")
-        door = protocol + "://" + fqdn + ":" + str(port)
-        door_list.append(door)
-    return door_list
-
-
 def dc_stage(path):
     """
     Pre-stage file (full path) in the source dCache system
@@ -285,7 +129,7 @@ class StageWorker(multiprocessing.Process):
     """
     This class is responsible for staging files into source dCache system
     """
-    def __init__(self, stage_queue, copy_queue):
+    def __init__(self, stage_queue, copy_queue, profile):
         """
         Constructor, takes two arguments: stage_queue and copy_queue
 
@@ -294,10 +138,14 @@ class StageWorker(multiprocessing.Process):
 
         :param copy_queue: a queue that collects staged files for subsequent copy
         :type copy_queue: Queue
+
+        :param profile: site profile
+        :type profile: dict
         """
         super(StageWorker, self).__init__()
         self.stage_queue = stage_queue
         self.copy_queue = copy_queue
+        self.profile = profile
 
     def run(self):
         """
@@ -306,14 +154,7 @@ class StageWorker(multiprocessing.Process):
         :return: no value
         :rtype: none
         """
-        pool = PooledDB(psycopg2,
-                        maxconnections=1,
-                        maxcached=1,
-                        blocking=True,
-                        host="cdfensrv0n",
-                        port=8888,
-                        user="enstore",
-                        database="enstoredb")
+        pool = create_connection(self.profile["enstore_db"])
 
         while True:
             label = self.stage_queue.get()
@@ -422,15 +263,19 @@ class CopyWorker(multiprocessing.Process):
     """
     This class is responsible for copying files between two dCache systems
     """
-    def __init__(self, copy_queue):
+    def __init__(self, copy_queue, profile):
         """
         Constructor takes copy_queue containing tuple (label, bfid, file, crc) files to be copied
 
         :param copy_queue: queue of files to be copied
         :type copy_queue: Queue
+
+        :param profile: site profile
+        :type profile: dict
         """
         super(CopyWorker, self).__init__()
         self.copy_queue = copy_queue
+        self.profile = profile
 
     @staticmethod
     def get_db_checksum(pool, dest):
@@ -446,13 +291,13 @@ class CopyWorker(multiprocessing.Process):
         :return: checksum value
         :rtype: str
         """
-        pnfsid = CopyWorker.get_pnfsid(dest)
+        pnfsid = get_pnfsid(dest)
         connection = None
         try:
             connection = pool.connection()
-            res = CopyWorker.select(connection, "select isum from t_inodes_checksum where itype = 1 and "
-                                                "inumber = (select inumber from t_inodes where ipnfsid = %s)",
-                                    (pnfsid, ))
+            res = select(connection, "select isum from t_inodes_checksum where itype = 1 and "
+                         "inumber = (select inumber from t_inodes where ipnfsid = %s)",
+                         (pnfsid, ))
             return res[0][0]
         finally:
             if connection:
@@ -461,136 +306,6 @@ class CopyWorker(multiprocessing.Process):
                 except Exception:
                     pass
 
-    @staticmethod
-    def get_local_checksum(f):
-        """
-        Extract checksum using .(get)(file name)(checksum) dot command
-
-        :param f: full file name
-        :type f: str
-
-        :return: checksum value string
-        :rtype: str
-        """
-        dname = os.path.dirname(f)
-        fname = os.path.basename(f)
-        csum_fn = dname + "/.(get)(" + fname + ")(checksum)"
-        retries = 10
-        for i in range(retries):
-            try:
-                with open(csum_fn, "r") as fh:
-                    csums = [i.strip() for i in fh.readlines() if i.startswith("ADLER32")]
-                    return csums[0].split(":")[1]
-            except IOError:
-                if i == retries - 1:
-                    raise
-                time.sleep(1)
-
-    @staticmethod
-    def get_pnfsid(f):
-        """
-        Return pnfsid for a given full file path name
-
-        :param f: full file path name
-        :type f: str
-
-        :return: pnfsid string
-        :rtype: str
-        """
-        dname = os.path.dirname(f)
-        fname = os.path.basename(f)
-        id_fn = dname + "/.(id)(" + fname + ")"
-        retries = 10
-        for i in range(retries):
-            try:
-                pnfsid = None
-                with open(id_fn, "r") as fh:
-                    pnfsid = [i.strip() for i in fh.readlines()][0]
-                return pnfsid
-            except IOError:
-                if i == retries - 1:
-                    raise
-                time.sleep(1)
-
-    @staticmethod
-    def update(con, sql, pars):
-        """
-        Update database record
-
-        :param con: database connection
-        :type con: Connection
-
-        :param sql: SQL statement
-        :type sql: str
-
-        :param pars: query parameters
-        :type pars: tuple
-
-        :return: result
-        :rtype: object
-        """
-        return CopyWorker.insert(con, sql, pars)
-
-    @staticmethod
-    def insert(con, sql, pars):
-        """
-        Insert database record
-
-        :param con: database connection
-        :type con: Connection
-
-        :param sql: SQL statement
-        :type sql: str
-
-        :param pars: query parameters
-        :type pars: tuple
-
-        :return: result
-        :rtype: object
-        """
-        cursor = None
-        try:
-            cursor = con.cursor()
-            cursor.execute(sql, pars)
-            con.commit()
-        except Exception:
-            con.rollback()
-            raise
-        finally:
-            if cursor:
-                try:
-                    cursor.close()
-                except Exception:
-                    pass
-
-    @staticmethod
-    def select(con, sql, pars):
-        """
-        Select  database records
-
-        :param con: database connection
-        :type con: Connection
-
-        :param sql: SQL statement
-        :type sql: str
-
-        :param pars: query parameters
-        :type pars: tuple
-
-        :return: result
-        :rtype: object
-        """
-        try:
-            cursor = con.cursor()
-            cursor.execute(sql, pars)
-            return cursor.fetchall()
-        finally:
-            if cursor:
-                try:
-                    cursor.close()
-                except Exception:
-                    pass
-
     @staticmethod
     def check(pool, entry, destination):
         """
@@ -616,7 +331,7 @@ class CopyWorker(multiprocessing.Process):
                         (label, bfid, dst_stat.st_size, src_stat.st_size, destination, ))
             return False
         try:
-            dst_checksum = CopyWorker.get_local_checksum(destination)
+            dst_checksum = get_local_checksum(destination)
             #dst_checksum = CopyWorker.get_db_checksum(dest_pool, destination)
         except Exception as e:
             print_error("%s Failed to get destination checksum %s %s" % (label, destination, str(e)))
@@ -624,14 +339,14 @@ class CopyWorker(multiprocessing.Process):
         if dst_checksum.lstrip("0") == crc.lstrip("0"):
             return True
         print_error("%s checksum mismatch %s %s" % (label, dst_checksum, crc))
-        pnfsid = CopyWorker.get_pnfsid(f)
+        pnfsid = get_pnfsid(f)
         if pnfsid is None:
             print_error("%s Failed to get pnfsid %s %s" % (label, bfid, f, ))
             return False
         try:
             connection = pool.connection()
-            res = CopyWorker.select(connection,
-                                    "select isum from t_inodes_checksum where ipnfsid = %s", (pnfsid,))
+            res = select(connection,
+                         "select isum from t_inodes_checksum where ipnfsid = %s", (pnfsid,))
             if not res:
                 print_error("%s Failed to get source checksum %s %s" % (label, bfid, f, ))
                 return True
@@ -649,96 +364,17 @@ class CopyWorker(multiprocessing.Process):
                 pass
         return False
 
-    @staticmethod
-    def mark_migrated(pool, entry, destination, check=False):
-        """
-        Mark source file migrated
-
-        :param pool: database connection pool
-        :type pool: PooledDB
-
-        :param entry: (label, bfid, file, src) source data
-        :type entry: tuple
-
-        :param destination: destination full file path name
-        :type destination: str
-
-        :param check: Mark checked or nor
-        :type check: bool
-
-        :return: true / false
-        :rtype: bool
-        """
-        connection = None
-        label, bfid, f, crc = entry
-        try:
-            connection = pool.connection()
-            try:
-                res = CopyWorker.insert(connection, "insert into file_migrate (src_bfid, dst_path, checked) "
-                                                    "values (%s, %s, %s)", (bfid, destination, check))
-            except Exception as e:
-                print_error("%s Failed to insert into file_migrate %s %s %s %s" % (label, bfid, f, destination, str(e)))
-                try:
-                    res = CopyWorker.update(connection, "update file_migrate set checked = true where "
-                                                        "src_bfid=%s ", (bfid,))
-                except Exception as e:
-                    print_error("%s Failed to update file_migrate %s %s %s" % (label, bfid, f, destination))
-                    pass
-        except Exception as e:
-            print_error("%s Failed to get connection when inserting into file_migrate %s" % (label, str(e),))
-            pass
-        finally:
-            try:
-                if connection:
-                    connection.close()
-            except Exception:
-                pass
-        return False
-
-    @staticmethod
-    def touch(source, destination):
-        """
-        Set destination atime, mtime to be the same as tha of tyhe source
-
-        :param source: full source file path
-        :type source: str
-
-        :param destination: full destination file path
-        :type destination: str
-        """
-        stat = os.stat(source)
-        wrapper(os.utime, (destination, (stat.st_atime, stat.st_mtime)))
-
     def run(self):
         """
         Main copy loop
         :return: no value
         :rtype: none
         """
-        chimera_pool = PooledDB(psycopg2,
-                                maxconnections=1,
-                                maxcached=1,
-                                blocking=True,
-                                host="cdfensrv1n",
-                                user="enstore_reader",
-                                database="chimera")
-
-        dest_chimera_pool = PooledDB(psycopg2,
-                                     maxconnections=1,
-                                     maxcached=1,
-                                     blocking=True,
-                                     host="stkensrv1n",
-                                     user="enstore_reader",
-                                     database="chimera")
-
-        enstoredb_pool = PooledDB(psycopg2,
-                                  maxconnections=1,
-                                  maxcached=1,
-                                  blocking=True,
-                                  host="cdfensrv0n",
-                                  port=8888,
-                                  user="enstore",
-                                  database="enstoredb")
+        chimera_pool = create_connection(self.profile["chimera_db"])
+
+        dest_chimera_pool = create_connection(self.profile["dest_chimera_db"])
+
+        enstoredb_pool = create_connection(self.profile["enstore_db"])
 
         while True:
             entry = self.copy_queue.get()
@@ -753,8 +389,8 @@ class CopyWorker(multiprocessing.Process):
             if os.path.exists(dest):
                 print_error("%s %s File %s already exists" % (label, bfid, dest, ))
                 if CopyWorker.check(chimera_pool, entry, dest):
-                    CopyWorker.touch(f, dest)
-                    CopyWorker.mark_migrated(enstoredb_pool, entry, dest, True)
+                    touch(f, dest)
+                    mark_copied(enstoredb_pool, entry, dest, True)
                     #self.copy_queue.task_done()
                     continue
                 else:
@@ -774,9 +410,9 @@ class CopyWorker(multiprocessing.Process):
                 print_error("%s Failed to copy %s %s %s" % (label, bfid, f, dest))
             else:
                 print_message("%s %s Copied %s %s " % (label, bfid, f, dest))
-                CopyWorker.touch(f, dest)
+                touch(f, dest)
                 if CopyWorker.check(chimera_pool, entry, dest):
-                    CopyWorker.mark_migrated(enstoredb_pool, entry, dest, True)
+                    mark_copied(enstoredb_pool, entry, dest, True)
                 else:
                     print_error("%s Failed to check destination after successful copy %s %s %s " %
                                 (label, bfid, f, dest))
@@ -807,6 +443,8 @@ def main():
 
     args = parser.parse_args()
 
+    profile = load_profile("cdf")
+
     cpu_count = args.processes
 
     print_message("**** START ****")
@@ -816,14 +454,7 @@ def main():
     os.environ["X509_CERT_DIR"] = "/etc/grid-security/certificates"
     os.environ["X509_USER_PROXY"] = "/etc/grid-security/hostcert.pem"
 
-    pool = PooledDB(psycopg2,
-                    maxconnections=1,
-                    maxcached=1,
-                    blocking=True,
-                    host="cdfensrv0n",
-                    port=8888,
-                    user="enstore_reader",
-                    database="enstoredb")
+    pool = create_connection(profile["enstore_reader_db"])
 
     connection = pool.connection()
     cursor = connection.cursor()
@@ -857,7 +488,7 @@ def main():
     copy_workers = []
 
     for i in range(cpu_count):
-        worker = StageWorker(stage_queue, copy_queue)
+        worker = StageWorker(stage_queue, copy_queue, profile)
         stage_workers.append(worker)
         worker.start()
 
@@ -865,7 +496,7 @@ def main():
         stage_queue.put(label)
 
     for i in range(40):
-        worker = CopyWorker(copy_queue)
+        worker = CopyWorker(copy_queue, profile)
         copy_workers.append(worker)
         worker.start()
 
@@ -2,38 +2,30 @@
 
 import argparse
 import errno
-import json
 import multiprocessing
 import os
-import random
 import re
-import socket
 import stat
-import subprocess
-import sys
+import tempfile
+import threading
 import time
-import paramiko
-import gssapi
-import uuid
 
 import psycopg2
 import psycopg2.extras
-from DBUtils.PooledDB import PooledDB
 
 try:
-    from urllib2 import Request, urlopen
+    import Queue
 except ImportError:
-    from urllib.request import Request, urlopen
-    pass
-
-printLock = multiprocessing.Lock()
-kinitLock =  multiprocessing.Lock()
-UUID = str(uuid.uuid4())
-HOSTNAME=socket.gethostname()
-SSH_HOST = "cdfdca"
-SSH_PORT = 25223 
-SSH_USER = "enstore"
-POOL_GROUP = "readPools"
+    import queue as Queue
+
+from migration import (print_error, print_message, load_profile, get_shell,
+                       execute_admin_command, execute_command, is_cached,
+                       stage, convert_0_adler32_to_1_adler32, get_path,
+                       get_random_door, get_ftp_doors, create_connection, select,
+                       get_label_system_inhibit, get_local_checksum, get_pnfsid,
+                       touch, mark_copied, KinitWorker, Doors, print_door_stats,
+                       MAX_TRANSFERS_PER_DOOR)
+
 
 """
 -- DROP TABLE IF EXISTS file_migrate;
@@ -57,79 +49,6 @@ grant select on  file_migrate to enstore_reader;
 """
 
 
-KRB5CCNAME = "/tmp/krb5cc_root.migration-%s"%(UUID,)
-os.environ["KRB5CCNAME"] =  KRB5CCNAME
-
-def kinit():
-
-    cmd = "/usr/bin/kinit -k host/%s"%(HOSTNAME)
-    execute_command(cmd)
-
-
-class KinitWorker(multiprocessing.Process):
-    def __init__(self):
-        super(KinitWorker, self).__init__()
-        self.stop = False
-
-    def run(self):
-        while not self.stop:
-            with kinitLock:
-                kinit()
-                time.sleep(14400)
-
-
-def get_shell():
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname = SSH_HOST,
-                port = SSH_PORT,
-                username = SSH_USER,
-                gss_auth = True,
-                gss_kex = True)
-    return ssh
-
-def execute_admin_command(ssh, cmd):
-    stdin, stdout, stderr = ssh.exec_command(cmd)
-    if len(stderr.readlines()) > 0:
-        raise RuntimeError(" ".join(stderr.readlines()))
-    return stdout.readlines()
-
-
-def is_cached(ssh, pnfsid): 
-    result = execute_admin_command(ssh, "\sn cacheinfoof " + pnfsid)
-    payload = result[0].strip()
-    if payload == "":
-        return False
-    else:
-        return True
-
-def get_locations(ssh, pnfsid): 
-    result = execute_admin_command(ssh, "\sn cacheinfoof " + pnfsid)
-    payload = result[0].strip()
-    if payload == "":
-        return []
-    else:
-        return payload.split();
-
-def get_active_pools_in_pool_group(ssh, pgroup):
-    result = execute_admin_command(ssh, "\s PoolManager  psu ls pgroup -a " + pgroup)
-    pools = []
-    hasPoolList = False
-    for line in result:
-        i = line.strip()
-        if not i: 
-            continue
-        if i.strip().startswith("poolList :"):
-            hasPoolList = True
-            continue
-        if hasPoolList: 
-            parts = i.split()
-            if parts[1].find("mode=disabled") != -1: 
-                continue
-            pool = parts[0].strip()
-            pools.append(pool)
-    return pools
-
 def get_restore_queue(ssh, pool):
     cmd = "\s " + pool + " rh ls"
     result = execute_admin_command(ssh, cmd)
@@ -145,10 +64,6 @@ def get_restore_queue(ssh, pool):
         ids.add(id)
     return ids
 
-def stage(ssh, pool, pnfsid):
-    cmd = "\s " + pool + " rh restore " + pnfsid
-    result = execute_admin_command(ssh, cmd)
-
 def get_staging_files(ssh, pools):
     pool_string = ",".join(pools)
     result = execute_admin_command(ssh, "\s " + pool_string + " rh ls")
@@ -161,85 +76,6 @@ def get_staging_files(ssh, pools):
         pnfsids.append(pnfsid)
     return pnfsids
 
-def print_error(text):
-    """
-    Print text string to stderr prefixed with timestamp
-    and ERROR keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stderr.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" ERROR : " + text + "\n")
-        sys.stderr.flush()
-
-
-def print_message(text):
-    """
-    Print text string to stdout prefixed with timestamp
-    and INFO keyword
-
-    :param text: text to be printed
-    :type text: str
-    :return: no value
-    :rtype: none
-    """
-    with printLock:
-        sys.stdout.write(time.strftime(
-            "%Y-%m-%d %H:%M:%S",
-            time.localtime(time.time()))+" INFO : " + text + "\n")
-        sys.stdout.flush()
-
-
-BASE = 65521
-
-
-def convert_0_adler32_to_1_adler32(crc, filesize):
-    """
-    Converts ADLER32 seeded 0 checksum to ADLER32 seeded 1 (correct) checksum
-
-    :param crc: ADLER32 seeded 0 checksum value
-    :type crc: str
-
-    :param  filesize: file size
-    :type filesize: int
-
-    :return: ADLER32 seeded 1 checksum value with leading 0x dropped
-    :rtype: str
-    """
-    crc = int(crc)
-    filesize = int(filesize)
-    size = int(filesize % BASE)
-    s1 = (crc & 0xffff)
-    s2 = ((crc >> 16) & 0xffff)
-    s1 = (s1 + 1) % BASE
-    s2 = (size + s2) % BASE
-    return hex((s2 << 16) + s1).split('x')[1]
-
-
-def execute_command(cmd):
-    """
-    Executes shell command
-
-    :param cmd: command string
-    :type cmd: str
-    :return: shell command return code
-    :rtype: int
-    """
-    p = subprocess.Popen(cmd,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         shell=True)
-    output, errors = p.communicate()
-    rc = p.returncode
-    #if rc != 0:
-    #   print_error(errors)
-    return rc
-
 
 CDF_GFTP = ("gsiftp://cdfdca1.fnal.gov", "gsiftp://cdfdca2.fnal.gov", "gsiftp://cdfdca3.fnal.gov")
 
@@ -275,76 +111,6 @@ CDF_DCAP = ("dcap://cdfdca1.fnal.gov:22125",
             "dcap://cdfdca3.fnal.gov:25164")
 
 
-def wrapper(func, args=None):
-    """
-    Execute a function wih retry loop
-
-    :param func: function
-    :type func: function
-    :param args: function parameter list
-    :type args: list
-    :return: result of function execution
-    """
-    if not args:
-        args = ()
-    count = 0
-    while count < 10:
-        try:
-            return func(*args)
-        except (OSError, IOError) as e:
-            count += 1
-            if e.errno in (errno.EBUSY, errno.ELOOP, errno.ESTALE, errno.ENOENT, errno.EIO):
-                if count < 10:
-                    time.sleep(0.5)
-                else:
-                    raise
-
-def get_path(pnfsid):
-    path = None
-    with open("/pnfs/fnal.gov/usr/dzero/.(pathof)(%s)"%(pnfsid,), "r") as fh:
-        path = fh.readlines()[0].strip()
-    return path
-
-def get_random_door(door_list):
-    """
-    Select a random item from a list
-
-    :param door_list: list of doors
-    :type door_list: list
-    :return: a random item from the list
-    """
-    length = len(door_list)
-    return door_list[random.randint(0, length - 1)]
-
-
-def get_ftp_doors(system="fndca3b.fnal.gov"):
-    """
-    Get list of FTP doors from info provoder of destination dCache system
-    :param system: name of the host running info provider
-    :type system: string
-    :return: list of GFTP doors
-    :type: list
-    """
-    url = "http://%s:2288/info/doors?format=json" % (system,)
-    request = Request(url)
-    request.add_header("Accept", "application/json")
-    response = urlopen(request)
-    data = json.load(response)
-    doors = [i for i in data.values() if i.get("protocol").get("family") == "gsiftp"]
-    door_list = []
-    fqdn = None
-    for d in doors:
-        for key, value in d.get("interfaces").items():
-            if value.get("scope") != "global":
-                continue
-            fqdn = socket.gethostbyaddr(value.get("address"))[0]
-        port = d.get("port")
-        protocol = d.get("protocol").get("family")
-        door = protocol + "://" + fqdn + ":" + str(port)
-        door_list.append(door)
-    return door_list
-
-
 def dc_stage(path):
     """
     Pre-stage file (full path) in the source dCache system
@@ -380,7 +146,12 @@ def dc_check(path):
     return rc
 
 
-def copy(source, dest):
+DEFAULT_DEST_DOOR = "gsiftp://fndca4b.fnal.gov:2812"
+# times to query info provider again for doors at start
+DOOR_RETRIES = 3
+
+
+def copy(source, dest, dest_door=None):
     """
     Copy source to dest using globus-url-cpoy
 
@@ -390,16 +161,20 @@ def copy(source, dest):
     :param dest:  destination file full path
     :type dest: str
 
+    :param dest_door:  destination door, random door if not specified
+    :type dest_door: str
+
     :return: 0 - success, 1 - failure
     :type: int
     """
     source_door = get_random_door(CDF_GFTP)
-    dest_door = "gsiftp://fndca4b.fnal.gov:2812"
-    try:
-        dest_door = get_random_door(get_ftp_doors())
-    except Exception:
-        print_error("Failed to get randoom door, using default %s " % (dest_door, ))
-        pass
+    if not dest_door:
+        dest_door = DEFAULT_DEST_DOOR
+        try:
+            dest_door = get_random_door(get_ftp_doors())
+        except Exception:
+            print_error("Failed to get randoom door, using default %s " % (dest_door, ))
+            pass
 #    cmd = ("globus-url-copy -checksum-alg adler32 -verify-checksum -nodcau -p 4 -fast "
 #           "-cd  -vb %s/%s %s/%s" % (source_door,
 #                                     source,
@@ -420,11 +195,52 @@ def copy(source, dest):
     return rc
 
 
+def copy_many(pairs, dest_door):
+    """
+    Copy list of (source, dest) files in one globus-url-copy
+    invocation using -f file list
+
+    :param pairs: list of (source, dest) full path tuples
+    :type pairs: list
+
+    :param dest_door:  destination door
+    :type dest_door: str
+
+    :return: 0 - all succeeded, otherwise some failed
+    :type: int
+    """
+    source_door = get_random_door(CDF_GFTP)
+    fd, list_file = tempfile.mkstemp(prefix="migration-copy-")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            for source, dest in pairs:
+                fh.write("%s/%s %s/%s\n" % (source_door, source, dest_door, dest))
+        cmd = ("globus-url-copy -nodcau -p 4 -fast "
+               "-cd -vb -f %s" % (list_file, ))
+        return execute_command(cmd)
+    finally:
+        try:
+            os.unlink(list_file)
+        except OSError:
+            pass
+
+
+# files smaller than this are copied in batches with globus-url-copy -f
+SMALL_FILE_SIZE = 64 * 1024 * 1024
+BATCH_SIZE = 32
+# how long to wait for more small files before copying partial batch
+BATCH_WAIT = 5
+TRANSFERS_PER_WORKER = 4
+MAX_RETRIES = 10
+MAX_BACKOFF = 300
+STATS_INTERVAL = 600
+
+
 class StageWorker(multiprocessing.Process):
     """
     This class is responsible for staging files into source dCache system
     """
-    def __init__(self, stage_queue, copy_queue, pool):
+    def __init__(self, stage_queue, copy_queue, pool, profile):
         """
         Constructor, takes two arguments: stage_queue and copy_queue
 
@@ -433,11 +249,15 @@ class StageWorker(multiprocessing.Process):
 
         :param copy_queue: a queue that collects staged files for subsequent copy
         :type copy_queue: Queue
+
+        :param profile: site profile
+        :type profile: dict
         """
         super(StageWorker, self).__init__()
         self.stage_queue = stage_queue
         self.copy_queue = copy_queue
         self.pool = pool
+        self.profile = profile
 
     def run(self):
         """
@@ -446,15 +266,10 @@ class StageWorker(multiprocessing.Process):
         :return: no value
         :rtype: none
         """
-        ssh = get_shell()
-        pool = PooledDB(psycopg2,
-                        maxconnections=1,
-                        maxcached=1,
-                        blocking=True,
-                        host="d0ensrv0n",
-                        port=8888,
-                        user="enstore",
-                        database="enstoredb")
+        ssh = get_shell(self.profile["admin"]["host"],
+                        self.profile["admin"]["port"],
+                        self.profile["admin"]["user"])
+        pool = create_connection(self.profile["enstore_db"])
 
         while True:
             label = self.stage_queue.get()
@@ -492,7 +307,7 @@ class StageWorker(multiprocessing.Process):
                     files = []
                     for i in res:
                         try:
-                            p = get_path(i[1])
+                            p = get_path(i[1], self.profile["pnfs_root"])
                             files.append((i[0], i[1], p, i[2], i[3]))
                         except (OSError, IOError) as e:
                             if e.errno == errno.ENOENT:
@@ -549,7 +364,7 @@ class StageWorker(multiprocessing.Process):
                     #
                     # Check if tape still OK
                     #
-                    inhibit = CopyWorker.get_label_system_inhibit(pool, label)
+                    inhibit = get_label_system_inhibit(pool, label)
                     if inhibit in ('NOACCESS', 'NOTALLOWED',):
                         print_error("%s, %s : %s, Skipping " % (self.pool, label, inhibit, ))
                         break
@@ -582,19 +397,54 @@ class StageWorker(multiprocessing.Process):
         return
 
 
+# may return files of other requested directories with requested
+# names, caller keeps only requested (directory, name) pairs
+SELECT_CHECKSUMS_IN_DIRS = """
+SELECT p.ipnfsid,
+       d.iname,
+       i.isize,
+       c.isum
+FROM t_dirs d
+INNER JOIN t_inodes p ON p.inumber = d.iparent
+INNER JOIN t_inodes i ON i.inumber = d.ichild
+LEFT OUTER JOIN t_inodes_checksum c ON c.inumber = i.inumber
+AND c.itype = 1
+WHERE p.ipnfsid = any(%s)
+  AND d.iname = any(%s)
+"""
+
+
 class CopyWorker(multiprocessing.Process):
     """
     This class is responsible for copying files between two dCache systems
     """
-    def __init__(self, copy_queue):
+    def __init__(self, copy_queue, doors, profile, stats_queue=None, streams=TRANSFERS_PER_WORKER):
         """
         Constructor takes copy_queue containing tuple (label, bfid, file, crc) files to be copied
 
         :param copy_queue: queue of files to be copied
         :type copy_queue: Queue
+
+        :param doors: destination doors
+        :type doors: Doors
+
+        :param profile: site profile
+        :type profile: dict
+
+        :param stats_queue: queue to report (door, bytes, files) of transfers to
+        :type stats_queue: Queue
+
+        :param streams: number of concurrent transfers
+        :type streams: int
         """
         super(CopyWorker, self).__init__()
         self.copy_queue = copy_queue
+        self.doors = doors
+        self.profile = profile
+        self.stats_queue = stats_queue
+        self.streams = streams
+        # directory -> pnfsid
+        self.dir_ids = {}
 
     @staticmethod
     def get_db_checksum(pool, dest):
@@ -610,15 +460,15 @@ class CopyWorker(multiprocessing.Process):
         :return: checksum value
         :rtype: str
         """
-        pnfsid = CopyWorker.get_pnfsid(dest)
+        pnfsid = get_pnfsid(dest)
         connection = None
         try:
             connection = pool.connection()
-            res = CopyWorker.select(connection, 
-                                    "select c.isum from t_inodes_checksum c " 
-                                    "inner join t_inodes i on i.inumber = c.inumber "
-                                    "and i.itype = 1 and i.ipnfsid=%s",
-                                    (pnfsid, ))
+            res = select(connection, 
+                         "select c.isum from t_inodes_checksum c " 
+                         "inner join t_inodes i on i.inumber = c.inumber "
+                         "and i.itype = 1 and i.ipnfsid=%s",
+                         (pnfsid, ))
             return res[0][0]
         finally:
             if connection:
@@ -628,160 +478,6 @@ class CopyWorker(multiprocessing.Process):
                     pass
         return None
 
-    @staticmethod
-    def get_label_system_inhibit(pool, label):
-        connection = None
-        try:
-            connection = pool.connection()
-            res = CopyWorker.select(connection, 
-                                    " select system_inhibit_0 from volume where label = %s", 
-                                    (label, ))
-            return res[0][0]
-        except Exception as e:
-            print_error("%s Failed to query system inhibit for label %s " % (label, ))
-            pass
-        except Exception as e:
-            print_error("%s Failed to get connection when querying system inhibit for lanel %s" % (label, ))
-            pass
-        finally:
-            try:
-                if connection:
-                    connection.close()
-            except Exception:
-                pass
-        return None
-
-
-    @staticmethod
-    def get_local_checksum(f):
-        """
-        Extract checksum using .(get)(file name)(checksum) dot command
-
-        :param f: full file name
-        :type f: str
-
-        :return: checksum value string
-        :rtype: str
-        """
-        dname = os.path.dirname(f)
-        fname = os.path.basename(f)
-        csum_fn = dname + "/.(get)(" + fname + ")(checksum)"
-        retries = 10
-        for i in range(retries):
-            try:
-                with open(csum_fn, "r") as fh:
-                    csums = [i.strip() for i in fh.readlines() if i.startswith("ADLER32")]
-                    return csums[0].split(":")[1]
-            except IOError:
-                if i == retries - 1:
-                    raise
-                time.sleep(1)
-
-    @staticmethod
-    def get_pnfsid(f):
-        """
-        Return pnfsid for a given full file path name
-
-        :param f: full file path name
-        :type f: str
-
-        :return: pnfsid string
-        :rtype: str
-        """
-        dname = os.path.dirname(f)
-        fname = os.path.basename(f)
-        id_fn = dname + "/.(id)(" + fname + ")"
-        retries = 10
-        for i in range(retries):
-            try:
-                pnfsid = None
-                with open(id_fn, "r") as fh:
-                    pnfsid = [i.strip() for i in fh.readlines()][0]
-                return pnfsid
-            except IOError:
-                if i == retries - 1:
-                    raise
-                time.sleep(1)
-
-    @staticmethod
-    def update(con, sql, pars):
-        """
-        Update database record
-
-        :param con: database connection
-        :type con: Connection
-
-        :param sql: SQL statement
-        :type sql: str
-
-        :param pars: query parameters
-        :type pars: tuple
-
-        :return: result
-        :rtype: object
-        """
-        return CopyWorker.insert(con, sql, pars)
-
-    @staticmethod
-    def insert(con, sql, pars):
-        """
-        Insert database record
-
-        :param con: database connection
-        :type con: Connection
-
-        :param sql: SQL statement
-        :type sql: str
-
-        :param pars: query parameters
-        :type pars: tuple
-
-        :return: result
-        :rtype: object
-        """
-        cursor = None
-        try:
-            cursor = con.cursor()
-            cursor.execute(sql, pars)
-            con.commit()
-        except Exception:
-            con.rollback()
-            raise
-        finally:
-            if cursor:
-                try:
-                    cursor.close()
-                except Exception:
-                    pass
-
-    @staticmethod
-    def select(con, sql, pars):
-        """
-        Select  database records
-
-        :param con: database connection
-        :type con: Connection
-
-        :param sql: SQL statement
-        :type sql: str
-
-        :param pars: query parameters
-        :type pars: tuple
-
-        :return: result
-        :rtype: object
-        """
-        try:
-            cursor = con.cursor()
-            cursor.execute(sql, pars)
-            return cursor.fetchall()
-        finally:
-            if cursor:
-                try:
-                    cursor.close()
-                except Exception:
-                    pass
-
     @staticmethod
     def check(pool, entry, destination):
         """
@@ -807,7 +503,7 @@ class CopyWorker(multiprocessing.Process):
                         (label, bfid, dst_stat.st_size, src_stat.st_size, destination, ))
             return False
         try:
-            dst_checksum = CopyWorker.get_local_checksum(destination)
+            dst_checksum = get_local_checksum(destination)
             #dst_checksum = CopyWorker.get_db_checksum(dest_pool, destination)
         except Exception as e:
             if dst_stat.st_size == src_stat.st_size == 0:
@@ -821,155 +517,265 @@ class CopyWorker(multiprocessing.Process):
             return False
         return False
 
-    @staticmethod
-    def mark_migrated(pool, entry, destination, check=False):
+    def get_dir_pnfsid(self, d):
         """
-        Mark source file migrated
+        Return pnfsid of directory, cached
 
-        :param pool: database connection pool
-        :type pool: PooledDB
+        :param d: full directory path name
+        :type d: str
 
-        :param entry: (label, bfid, file, src) source data
-        :type entry: tuple
+        :return: pnfsid string
+        :rtype: str
+        """
+        pnfsid = self.dir_ids.get(d)
+        if not pnfsid:
+            pnfsid = get_pnfsid(d)
+            self.dir_ids[d] = pnfsid
+        return pnfsid
 
-        :param destination: destination full file path name
-        :type destination: str
+    def get_checksums(self, pool, paths):
+        """
+        Get size and ADLER32 checksum of files from Chimera with
+        one query for all their directories
 
-        :param check: Mark checked or nor
-        :type check: bool
+        :param pool: chimera database connection pool
+        :type pool: PooledDB
 
-        :return: true / false
-        :rtype: bool
+        :param paths: list of full file path names
+        :type paths: list
+
+        :return: path -> (size, checksum) map, files that do not exist are absent
+        :rtype: dict
         """
+        wanted = set(paths)
+        dirs = dict((self.get_dir_pnfsid(d), d)
+                    for d in set(os.path.dirname(path) for path in paths))
+        names = list(set(os.path.basename(path) for path in paths))
+        result = {}
         connection = None
-        label, bfid, f, crc = entry
         try:
             connection = pool.connection()
-            try:
-                res = CopyWorker.insert(connection, "insert into file_migrate (src_bfid, dst_path, checked) "
-                                                    "values (%s, %s, %s)", (bfid, destination, check))
-            except Exception as e:
-                print_error("%s Failed to insert into file_migrate %s %s %s %s" % (label, bfid, f, destination, str(e)))
+            res = select(connection,
+                         SELECT_CHECKSUMS_IN_DIRS,
+                         (list(dirs), names))
+            for dir_pnfsid, name, size, checksum in res:
+                path = os.path.join(dirs[dir_pnfsid], name)
+                if path in wanted:
+                    result[path] = (size, checksum)
+        finally:
+            if connection:
                 try:
-                    res = CopyWorker.update(connection, "update file_migrate set checked = true where "
-                                                        "src_bfid=%s ", (bfid,))
-                except Exception as e:
-                    print_error("%s Failed to update file_migrate %s %s %s" % (label, bfid, f, destination))
+                    connection.close()
+                except Exception:
                     pass
+        return result
+
+    def verify(self, chimera_pool, dest_chimera_pool, items):
+        """
+        Check sizes and checksums of copied files against source
+        Chimera and Enstore CRC in bulk. Files whose checksum is not
+        in Chimera are checked one by one with check()
+
+        :param items: list of (entry, dest) tuples
+        :type items: list
+
+        :return: list of (entry, dest, size) verified, list of (entry, dest) failed
+        :rtype: tuple
+        """
+        try:
+            src = self.get_checksums(chimera_pool, [entry[2] for entry, dest in items])
+            dst = self.get_checksums(dest_chimera_pool, [dest for entry, dest in items])
         except Exception as e:
-            print_error("%s Failed to get connection when inserting into file_migrate %s" % (label, str(e),))
-            pass
-        finally:
-            try:
-                if connection:
-                    connection.close()
-            except Exception:
-                pass
-        return False
+            print_error("Failed to get checksums from chimera, checking files one by one %s" % (str(e), ))
+            src = dst = None
+        good = []
+        bad = []
+        for entry, dest in items:
+            label, bfid, f, crc = entry
+            if dst is not None and dest not in dst:
+                bad.append((entry, dest, "destination does not exist"))
+                continue
+            if dst is None or f not in src or (dst[dest][1] is None and dst[dest][0] != 0):
+                if os.path.exists(dest) and CopyWorker.check(chimera_pool, entry, dest):
+                    good.append((entry, dest, os.stat(dest).st_size))
+                else:
+                    bad.append((entry, dest, "check failed"))
+                continue
+            src_size, src_checksum = src[f]
+            dst_size, dst_checksum = dst[dest]
+            if src_size != dst_size:
+                bad.append((entry, dest, "size mismatch %d %d" % (src_size, dst_size)))
+            elif dst_size == 0 and not dst_checksum:
+                good.append((entry, dest, dst_size))
+            elif dst_checksum.lstrip("0") != crc.lstrip("0"):
+                bad.append((entry, dest, "checksum mismatch %s %s" % (dst_checksum, crc)))
+            else:
+                if src_checksum and src_checksum.lstrip("0") != crc.lstrip("0"):
+                    print_error("%s %s source chimera checksum %s differs from enstore %s" %
+                                (label, bfid, src_checksum, crc))
+                good.append((entry, dest, dst_size))
+        if bad:
+            print_error("%d of %d copied files failed verification" % (len(bad), len(items)))
+            for entry, dest, reason in bad:
+                print_error("%s %s %s %s : %s" % (entry[0], entry[1], entry[2], dest, reason))
+        return good, [(entry, dest) for entry, dest, reason in bad]
 
     @staticmethod
-    def touch(source, destination):
+    def get_destination(f):
         """
-        Set destination atime, mtime to be the same as tha of tyhe source
+        Map source file path to destination file path
 
-        :param source: full source file path
-        :type source: str
+        :param f: source full file path name
+        :type f: str
 
-        :param destination: full destination file path
-        :type destination: str
+        :return: destination full file path name
+        :rtype: str
         """
-        stat = os.stat(source)
-        wrapper(os.utime, (destination, (stat.st_atime, stat.st_mtime)))
+        #/pnfs/fs/usr/beagle/copy1/datalogger/initial_runs/datalogger/all/all/all_0000141154_004.raw
+        for item in ("run_1_data", "sam-lto", "sam-m2", "sam-mammoth", "ssa_test", "archive", "d0backup", "beagle"):
+            if f.startswith("/pnfs/fs/usr/%s"%(item,)) :
+                dest = re.sub("^/pnfs/.*/usr","/pnfs/fnal.gov/usr/d0/data", f)
+                break
+            else:
+                dest = re.sub("^/pnfs/.*/usr/dzero","/pnfs/fnal.gov/usr/d0/data", f)
+        return dest
 
-    def run(self):
+    def prepare(self, chimera_pool, enstoredb_pool, entry):
         """
-        Main copy loop
-        :return: no value
-        :rtype: none
+        Find destination of entry and deal with already existing
+        destination
+
+        :return: destination path or None if there is nothing to copy
+        :rtype: str
         """
-        chimera_pool = PooledDB(psycopg2,
-                                maxconnections=1,
-                                maxcached=1,
-                                blocking=True,
-                                host="d0ensrv1n",
-                                user="enstore_reader",
-                                database="chimera")
-
-        dest_chimera_pool = PooledDB(psycopg2,
-                                     maxconnections=1,
-                                     maxcached=1,
-                                     blocking=True,
-                                     host="stkensrv1n",
-                                     user="enstore_reader",
-                                     database="chimera")
-
-        enstoredb_pool = PooledDB(psycopg2,
-                                  maxconnections=1,
-                                  maxcached=1,
-                                  blocking=True,
-                                  host="d0ensrv0n",
-                                  port=8888,
-                                  user="enstore",
-                                  database="enstoredb")
+        label, bfid, f, crc = entry
+        dest = CopyWorker.get_destination(f)
+        if os.path.exists(dest):
+            print_error("%s %s File %s already exists" % (label, bfid, dest, ))
+            if CopyWorker.check(chimera_pool, entry, dest):
+                touch(f, dest)
+                mark_copied(enstoredb_pool, entry, dest, True)
+                return None
+            try:
+                os.unlink(dest)
+            except (IOError, OSError) as e:
+                print_error("%s %s Failed to remove destination %s %s " % (label, bfid, dest, str(e)))
+                return None
+        return dest
 
-        while True:
-            entry = self.copy_queue.get()
-            if not entry:
-                #print_message("%s: Exiting %d" % (self.name, self.copy_queue.qsize()))
-                #self.copy_queue.task_done()
-                break
-            label, bfid, f, crc = entry
-            #/pnfs/fs/usr/beagle/copy1/datalogger/initial_runs/datalogger/all/all/all_0000141154_004.raw
+    def transfer(self, chimera_pool, dest_chimera_pool, enstoredb_pool, items):
+        """
+        Copy files retrying failed ones with exponential backoff.
+        More than one file is copied in a single globus-url-copy -f call
 
-            for item in ("run_1_data", "sam-lto", "sam-m2", "sam-mammoth", "ssa_test", "archive", "d0backup", "beagle"):
-                if f.startswith("/pnfs/fs/usr/%s"%(item,)) :
-                    dest = re.sub("^/pnfs/.*/usr","/pnfs/fnal.gov/usr/d0/data", f)
-                    break
-                else:
-                    dest = re.sub("^/pnfs/.*/usr/dzero","/pnfs/fnal.gov/usr/d0/data", f)
-            
-            if os.path.exists(dest):
-                print_error("%s %s File %s already exists" % (label, bfid, dest, ))
-                if CopyWorker.check(chimera_pool, entry, dest):
-                    CopyWorker.touch(f, dest)
-                    CopyWorker.mark_migrated(enstoredb_pool, entry, dest, True)
-                    #self.copy_queue.task_done()
-                    continue
+        :param items: list of (entry, dest) tuples
+        :type items: list
+        """
+        retry = 0
+        # bad destinations that could not be removed, not retried
+        given_up = []
+        while items and retry < MAX_RETRIES:
+            if retry:
+                time.sleep(min(2 ** retry, MAX_BACKOFF))
+            retry += 1
+            door = self.doors.acquire()
+            t0 = time.time()
+            try:
+                if len(items) == 1:
+                    entry, dest = items[0]
+                    rc = copy(entry[2], dest, door)
                 else:
-                    #print_error("%s %s Failed to check destination %s %s" % (label, bfid, f, dest, ))
-                    #continue
+                    rc = copy_many([(entry[2], dest) for entry, dest in items], door)
+            finally:
+                self.doors.release(door)
+            elapsed = time.time() - t0
+            if rc != 0 and len(items) == 1:
+                good, bad = [], items
+            else:
+                good, bad = self.verify(chimera_pool, dest_chimera_pool, items)
+            failed = []
+            nbytes = nfiles = 0
+            for entry, dest, size in good:
+                label, bfid, f, crc = entry
+                touch(f, dest)
+                print_message("%s %s Copied %s %s " % (label, bfid, f, dest))
+                mark_copied(enstoredb_pool, entry, dest, True)
+                nbytes += size
+                nfiles += 1
+            for entry, dest in bad:
+                label, bfid, f, crc = entry
+                if os.path.exists(dest):
                     try:
                         os.unlink(dest)
-                    except IOError as e:
+                    except (IOError, OSError) as e:
                         print_error("%s %s Failed to remove destination %s %s " % (label, bfid, dest, str(e)))
-                        #self.copy_queue.task_done()
+                        given_up.append((entry, dest))
                         continue
-            count = 0
-            rc = 1
-            while rc != 0 and count < 10:
-                count += 1
-                rc = copy(f, dest)
-#                if rc != 0:
-#                    if os.path.exists(dest):
-#                        try:
-#                            os.unlink(dest)
-#                        except:
-#                            pass
-            if rc != 0:
-                print_error("%s Failed to copy %s %s %s" % (label, bfid, f, dest))
-            else:
-                print_message("%s %s Copied %s %s " % (label, bfid, f, dest))
-                CopyWorker.touch(f, dest)
-                if CopyWorker.check(chimera_pool, entry, dest):
-                    CopyWorker.mark_migrated(enstoredb_pool, entry, dest, True)
+                failed.append((entry, dest))
+            self.doors.record(door, nbytes, elapsed, len(bad) / float(len(items)))
+            if self.stats_queue and nfiles:
+                self.stats_queue.put((door, nbytes, nfiles))
+            items = failed
+        for entry, dest in items:
+            label, bfid, f, crc = entry
+            print_error("%s Failed to copy %s %s %s" % (label, bfid, f, dest))
+        for entry, dest in given_up:
+            label, bfid, f, crc = entry
+            print_error("%s Failed to copy %s %s %s, bad destination left in place, "
+                        "giving up" % (label, bfid, f, dest))
+
+    def transfer_loop(self, chimera_pool, dest_chimera_pool, enstoredb_pool):
+        """
+        Take files from copy queue and copy them, collecting small
+        files into batches
+        """
+        batch = []
+        while True:
+            try:
+                if batch:
+                    entry = self.copy_queue.get(True, BATCH_WAIT)
                 else:
-                    print_error("%s Failed to check destination after successful copy %s %s %s " %
-                                (label, bfid, f, dest))
+                    entry = self.copy_queue.get()
+            except Queue.Empty:
+                entry = ()
+            stop = entry is None
+            if entry:
+                dest = self.prepare(chimera_pool, enstoredb_pool, entry)
+                if dest:
                     try:
-                        os.unlink(dest)
-                    except IOError as e:
-                        print_error("%s %s Failed to remove destination %s %s " % (label, bfid, dest, str(e)))
-                        pass
+                        small = os.stat(entry[2]).st_size < SMALL_FILE_SIZE
+                    except OSError:
+                        small = False
+                    if small:
+                        batch.append((entry, dest))
+                    else:
+                        self.transfer(chimera_pool, dest_chimera_pool, enstoredb_pool, [(entry, dest)])
+            if batch and (not entry or len(batch) >= BATCH_SIZE):
+                self.transfer(chimera_pool, dest_chimera_pool, enstoredb_pool, batch)
+                batch = []
+            if stop:
+                break
+
+    def run(self):
+        """
+        Main copy loop, runs streams concurrent transfer threads
+        :return: no value
+        :rtype: none
+        """
+        chimera_pool = create_connection(self.profile["chimera_db"], self.streams)
+
+        dest_chimera_pool = create_connection(self.profile["dest_chimera_db"], self.streams)
+
+        enstoredb_pool = create_connection(self.profile["enstore_db"], self.streams)
+
+        threads = []
+        for i in range(self.streams):
+            t = threading.Thread(target=self.transfer_loop,
+                                 args=(chimera_pool, dest_chimera_pool, enstoredb_pool))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
         return
 
 
@@ -987,8 +793,27 @@ def main():
         "--label",
         help="comma separated list of labels")
 
+    parser.add_argument(
+        "--copy_workers",
+        type=int,
+        default=25,
+        help="number of copy processes")
+
+    parser.add_argument(
+        "--streams",
+        type=int,
+        default=TRANSFERS_PER_WORKER,
+        help="number of concurrent transfers per copy process")
+
+    parser.add_argument(
+        "--door_limit",
+        type=int,
+        default=MAX_TRANSFERS_PER_DOOR,
+        help="max number of concurrent transfers per destination door")
+
     args = parser.parse_args()
 
+    profile = load_profile("d0")
 
     print_message("**** START ****")
 
@@ -997,14 +822,7 @@ def main():
     os.environ["X509_CERT_DIR"] = "/etc/grid-security/certificates"
     os.environ["X509_USER_PROXY"] = "/etc/grid-security/hostcert.pem"
 
-    pool = PooledDB(psycopg2,
-                    maxconnections=1,
-                    maxcached=1,
-                    blocking=True,
-                    host="d0ensrv0n",
-                    port=8888,
-                    user="enstore_reader",
-                    database="enstoredb")
+    pool = create_connection(profile["enstore_reader_db"])
 
     connection = pool.connection()
     cursor = connection.cursor()
@@ -1031,8 +849,10 @@ def main():
     kinitWorker = KinitWorker()
     kinitWorker.start()
 
-    ssh = get_shell()
-    #pools = get_active_pools_in_pool_group(ssh, POOL_GROUP)
+    ssh = get_shell(profile["admin"]["host"],
+                    profile["admin"]["port"],
+                    profile["admin"]["user"])
+    #pools = get_active_pools_in_pool_group(ssh, profile["pool_group"])
 
     pools = ("r-fcdfcache111-1", "r-fcdfcache112-1", "r-fcdfcache113-1",
              "r-fcdfcache115-1", "r-fcdfcache118-1", "r-fcdfcache119-1",
@@ -1045,16 +865,29 @@ def main():
     ssh.close()
 
     for pool in pools:
-        worker = StageWorker(stage_queue, copy_queue, pool)
+        worker = StageWorker(stage_queue, copy_queue, pool, profile)
         stage_workers.append(worker)
         worker.start()
 
     for label in labels:
         stage_queue.put(label)
 
-    number_of_copy_processes = 100
+    # Doors adds doors reported by info provider later, so if it is
+    # down now the default door is only used until it comes back
+    try:
+        door_list = get_ftp_doors(retries=DOOR_RETRIES)
+    except Exception as e:
+        print_error("Failed to get doors %s" % (str(e), ))
+        door_list = []
+    if not door_list:
+        print_error("No doors found, using default %s" % (DEFAULT_DEST_DOOR, ))
+        door_list = [DEFAULT_DEST_DOOR]
+    doors = Doors(door_list, args.door_limit)
+    stats_queue = multiprocessing.Queue()
+
+    number_of_copy_processes = args.copy_workers
     for i in range(number_of_copy_processes):
-        worker = CopyWorker(copy_queue)
+        worker = CopyWorker(copy_queue, doors, profile, stats_queue, args.streams)
         copy_workers.append(worker)
         worker.start()
 
@@ -1064,16 +897,27 @@ def main():
     stage_queue.join()
 
     copy_progress = 0 
+    t0 = time.time()
     while copy_queue.qsize():
         copy_progress += 1
         if copy_progress == 1000:
             copy_progress = 0
             print_message("Copy queue size %d " % (copy_queue.qsize(), ))
+        if time.time() - t0 >= STATS_INTERVAL:
+            print_door_stats(stats_queue, time.time() - t0)
+            t0 = time.time()
         time.sleep(60)
 
-    for i in range(number_of_copy_processes):
+    for i in range(number_of_copy_processes * args.streams):
         copy_queue.put(None)
 
+    while [w for w in copy_workers if w.is_alive()]:
+        if time.time() - t0 >= STATS_INTERVAL:
+            print_door_stats(stats_queue, time.time() - t0)
+            t0 = time.time()
+        time.sleep(60)
+    print_door_stats(stats_queue, time.time() - t0)
+
         
     kinitWorker.stop = True 
     kinitWorker.terminate()
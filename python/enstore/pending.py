@@ -0,0 +1,200 @@
+#!/bin/env python
+"""
+Set of files of a label pending stage / pin / unpin, keyed by pnfsid.
+
+Used by StageWorker loops of migrate_dcache, stage_dcache_public,
+pin_dcache_public and unpin. Each file has a state and times of last
+state change and last restore request, so a pass only goes over files
+that are not done and a restore is not re-sent on every pass. A file
+that could not be processed max_attempts times is set failed and is
+not tried again.
+If directory is given, per label state is saved there after each pass
+and loaded back on restart.
+
+Usage:
+
+    from pending import PendingFiles, DONE
+
+    pending = PendingFiles(label, files, directory)
+    while pending:
+        for bfid, pnfsid, crc, size in pending.remaining():
+            if online:
+                if process(pnfsid):
+                    pending.set_state(pnfsid, DONE)
+                elif pending.fail(pnfsid, 10):
+                    print_error("giving up on %s" % (pnfsid, ))
+            elif pending.should_request(pnfsid, 600):
+                stage(ssh, pool, pnfsid)
+        pending.save()
+    pending.remove()
+"""
+from __future__ import print_function
+import collections
+import json
+import os
+import time
+
+NEW = "new"
+REQUESTED = "requested"
+ONLINE = "online"
+DONE = "done"
+FAILED = "failed"
+
+FINAL_STATES = (DONE, FAILED)
+
+
+class PendingFiles(object):
+    """
+    Files of a label with their state
+    """
+    def __init__(self, label, files, directory=None):
+        """
+        :param label: volume label
+        :type label: str
+
+        :param files: list of (bfid, pnfsid, crc, size) tuples
+        :type files: list
+
+        :param directory: directory to keep state snapshots in
+        :type directory: str
+        """
+        self.label = label
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+        for bfid, pnfsid, crc, size in files:
+            self.entries[pnfsid] = {"file": (bfid, pnfsid, crc, size),
+                                    "state": NEW,
+                                    "updated": 0,
+                                    "requested": 0,
+                                    "attempts": 0}
+        self.load()
+
+    def __len__(self):
+        return len([i for i in self.entries.values() if i["state"] not in FINAL_STATES])
+
+    def __bool__(self):
+        return len(self) > 0
+
+    __nonzero__ = __bool__
+
+    def remaining(self):
+        """
+        Files that are neither done nor failed, in original order
+
+        :return: list of (bfid, pnfsid, crc, size) tuples
+        :rtype: list
+        """
+        return [i["file"] for i in self.entries.values() if i["state"] not in FINAL_STATES]
+
+    def set_state(self, pnfsid, state):
+        entry = self.entries[pnfsid]
+        entry["state"] = state
+        entry["updated"] = time.time()
+
+    def should_request(self, pnfsid, interval):
+        """
+        Check if restore of file was not requested within interval
+        and if so, mark it requested now
+
+        :param pnfsid: pnfsid
+        :type pnfsid: str
+
+        :param interval: seconds between repeated requests
+        :type interval: int
+
+        :return: True if request has to be sent
+        :rtype: bool
+        """
+        if time.time() - self.entries[pnfsid]["requested"] < interval:
+            return False
+        self.mark_requested(pnfsid)
+        return True
+
+    def mark_requested(self, pnfsid):
+        """
+        Mark restore of file requested now
+
+        :param pnfsid: pnfsid
+        :type pnfsid: str
+        """
+        self.entries[pnfsid]["requested"] = time.time()
+        self.set_state(pnfsid, REQUESTED)
+
+    def fail(self, pnfsid, max_attempts):
+        """
+        Count failed attempt to process file, set it failed
+        after max_attempts
+
+        :param pnfsid: pnfsid
+        :type pnfsid: str
+
+        :param max_attempts: number of attempts before giving up
+        :type max_attempts: int
+
+        :return: True if file is given up on
+        :rtype: bool
+        """
+        entry = self.entries[pnfsid]
+        entry["attempts"] += 1
+        if entry["attempts"] < max_attempts:
+            return False
+        self.set_state(pnfsid, FAILED)
+        return True
+
+    def failed(self):
+        """
+        Files given up on
+
+        :return: list of (bfid, pnfsid, crc, size) tuples
+        :rtype: list
+        """
+        return [i["file"] for i in self.entries.values() if i["state"] == FAILED]
+
+    def path(self):
+        return os.path.join(self.directory, "%s.json" % (self.label, ))
+
+    def load(self):
+        """
+        Apply saved state of files that are still in the set
+        """
+        if not self.directory:
+            return
+        try:
+            with open(self.path(), "r") as f:
+                snapshot = json.load(f)
+        except (OSError, IOError, ValueError):
+            return
+        for pnfsid, value in snapshot.items():
+            entry = self.entries.get(pnfsid)
+            if entry:
+                entry.update(value)
+
+    def save(self):
+        """
+        Atomically write state snapshot
+        """
+        if not self.directory:
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        snapshot = dict((pnfsid, {"state": i["state"],
+                                  "updated": i["updated"],
+                                  "requested": i["requested"],
+                                  "attempts": i["attempts"]})
+                        for pnfsid, i in self.entries.items()
+                        if i["state"] != NEW)
+        tmp = self.path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(snapshot, f)
+        os.rename(tmp, self.path())
+
+    def remove(self):
+        """
+        Remove state snapshot once label is done
+        """
+        if not self.directory:
+            return
+        try:
+            os.unlink(self.path())
+        except OSError:
+            pass
@@ -11,10 +11,12 @@ import sys
 import time
 import uuid
 
-import paramiko
+import admin_shell
 import psycopg2
 import psycopg2.extras
 
+from pending import PendingFiles, DONE
+
 #migration copy -permanent -storage=GM2.gm2_daq_run5 -tmode=same+admin(604800) -sticky -smode=removable -select=random -target=pgroup GM2Pools
 
 try:
@@ -37,6 +39,8 @@ SSH_HOST = "fndca"
 SSH_PORT = 24223
 SSH_USER = "enstore"
 POOL_GROUP = "StagePools"
+# do not re-send restore request for a file more often than this
+RESTAGE_INTERVAL = 600
 
 
 def execute_command(cmd):
@@ -74,14 +78,7 @@ def get_shell():
     """
     Admin shell
     """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=SSH_HOST,
-                port=SSH_PORT,
-                username=SSH_USER,
-                gss_auth=True,
-                gss_kex=True)
-    return ssh
+    return admin_shell.get_shell(SSH_HOST, SSH_PORT, SSH_USER, kinit, kinitLock)
 
 
 def execute_admin_command(ssh, cmd):
@@ -315,16 +312,17 @@ class KinitWorker(multiprocessing.Process):
         while not self.stop:
             with kinitLock:
                 kinit()
-                time.sleep(14400)
+            time.sleep(14400)
 
 
 class StageWorker(multiprocessing.Process):
     """
     This class is responsible for staging files into source dCache system
     """
-    def __init__(self, stage_queue, pool):
+    def __init__(self, stage_queue, pool, state_dir=None):
         super(StageWorker, self).__init__()
         self.stage_queue = stage_queue
+        self.state_dir = state_dir
         self.pool = pool
 
     def run(self):
@@ -412,102 +410,104 @@ class StageWorker(multiprocessing.Process):
                 print_error("%s %s: PNFS is not mounted, mount pnfs. Quitting" % (self.pool, label,))
                 break
 
-            number_of_files = len(files)
-            total = number_of_files
-            print_message("Doing label %s, number of files %d" % (label, number_of_files))
-            cached = loop = count = migrated = 0
+            total = len(files)
+            print_message("Doing label %s, number of files %d" % (label, total))
+            cached = loop = migrated = 0
             pools = get_active_pools_in_pool_group(ssh, POOL_GROUP)
-            while files:
-                count += 1
-                bfid, pnfsid, crc, fsize = files.pop(0)
-                locations = []
-                try:
-                    locations = get_locations(ssh, pnfsid)
-                except:
-                    pass
-                if not locations:
-                    files.append((bfid, pnfsid, crc, fsize))
-                    try: 
-                        stage(ssh, self.pool, pnfsid)
-                    except RuntimeError as e:
-                        print_error("%s, %s : Failed to stage %s, sleeping 10 seconds " % (self.pool, label, pnfsid))
-                        time.sleep(10)
-                else:
-                    right_locations = [ l for l in locations if l.startswith("rw-gm2") ]
-                    set_sticky = False
-                    for l in right_locations:
-                        repls = None
+            pending = PendingFiles(label, files, self.state_dir)
+            while pending:
+                for bfid, pnfsid, crc, fsize in pending.remaining():
+                    locations = []
+                    try:
+                        locations = get_locations(ssh, pnfsid)
+                    except:
+                        pass
+                    if not locations:
+                        if not pending.should_request(pnfsid, RESTAGE_INTERVAL):
+                            continue
                         try:
-                            repls = rep_ls(ssh, l, pnfsid)
+                            stage(ssh, self.pool, pnfsid)
                         except RuntimeError as e:
-                            print_error("%s, %s : Failed to rep ls %s on location %s " % (self.pool, label, pnfsid, l))
-                            rc = clear_file_cache_location(ssh, l, pnfsid)
-                            print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
-                            #continue
-                        if repls:
-                            try:
-                                res = set_sticky_on_location(ssh, l, pnfsid, 7776000000)
-                                set_sticky = True
-                                break
-                            except RuntimeError as e:
-                                print_error("%s %s : Failed to set %s sticky on location %s" % (self.pool,
-                                                                                                label,
-                                                                                                pnfsid,
-                                                                                                l))
-                                
-                                rc = clear_file_cache_location(ssh, l, pnfsid)
-                                print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
-                                continue
-                        else:
-                            rc = clear_file_cache_location(ssh, l, pnfsid)
-                            print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
-                    if set_sticky:
-                        cached += 1 
+                            print_error("%s, %s : Failed to stage %s, sleeping 10 seconds " % (self.pool, label, pnfsid))
+                            time.sleep(10)
                     else:
-                        files.append((bfid, pnfsid, crc, fsize))
-                        wrong_locations =  [ l for l in locations if not l.startswith("rw-gm2") ]
-                        started_migration = False
-                        for l in wrong_locations:
+                        right_locations = [ l for l in locations if l.startswith("rw-gm2") ]
+                        set_sticky = False
+                        for l in right_locations:
                             repls = None
                             try:
                                 repls = rep_ls(ssh, l, pnfsid)
                             except RuntimeError as e:
                                 print_error("%s, %s : Failed to rep ls %s on location %s " % (self.pool, label, pnfsid, l))
                                 rc = clear_file_cache_location(ssh, l, pnfsid)
-                                print_message("%s cleared %s cache location %s" %(self.pool, pnfsid, l,))
+                                print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
+                                #continue
                             if repls:
-                                storage_class = repls[-1].split("=")[-1]
-                                storage_class = re.sub("[\{\}]", "", storage_class)
-                                destination = "GM2Pools"
-                                #if storage_class in ("GM2.gm2_daq", "GM2.gm2_daq_run5",):
-                                #    destination = "GM2Pools"
-                                res = migrate(ssh, l, destination, pnfsid)
-                                started_migration = True
-                                break
+                                try:
+                                    res = set_sticky_on_location(ssh, l, pnfsid, 7776000000)
+                                    set_sticky = True
+                                    break
+                                except RuntimeError as e:
+                                    print_error("%s %s : Failed to set %s sticky on location %s" % (self.pool,
+                                                                                                    label,
+                                                                                                    pnfsid,
+                                                                                                    l))
+
+                                    rc = clear_file_cache_location(ssh, l, pnfsid)
+                                    print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
+                                    continue
                             else:
                                 rc = clear_file_cache_location(ssh, l, pnfsid)
                                 print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
+                        if set_sticky:
+                            cached += 1
+                            pending.set_state(pnfsid, DONE)
+                        elif pending.should_request(pnfsid, RESTAGE_INTERVAL):
+                            wrong_locations =  [ l for l in locations if not l.startswith("rw-gm2") ]
+                            started_migration = False
+                            for l in wrong_locations:
+                                repls = None
+                                try:
+                                    repls = rep_ls(ssh, l, pnfsid)
+                                except RuntimeError as e:
+                                    print_error("%s, %s : Failed to rep ls %s on location %s " % (self.pool, label, pnfsid, l))
+                                    rc = clear_file_cache_location(ssh, l, pnfsid)
+                                    print_message("%s cleared %s cache location %s" %(self.pool, pnfsid, l,))
+                                if repls:
+                                    storage_class = repls[-1].split("=")[-1]
+                                    storage_class = re.sub("[\{\}]", "", storage_class)
+                                    destination = "GM2Pools"
+                                    #if storage_class in ("GM2.gm2_daq", "GM2.gm2_daq_run5",):
+                                    #    destination = "GM2Pools"
+                                    res = migrate(ssh, l, destination, pnfsid)
+                                    started_migration = True
+                                    break
+                                else:
+                                    rc = clear_file_cache_location(ssh, l, pnfsid)
+                                    print_message("%s %s cleared %s cache location %s" %(self.pool, label, pnfsid, l,))
+
+                            if not started_migration:
+                                stage(ssh, self.pool, pnfsid)
+
+                pending.save()
+                if not pending:
+                    break
+                loop += 1
+                print_message("%s, %s : %d staged, %d migrated, %d total, %d remain,  %d pass" %
+                              (self.pool, label, cached, migrated, total, len(pending), loop))
+                #
+                # Check that label is still OK
+                #
+                inhibit = get_label_system_inhibit(pool, label)
+                if inhibit in ('NOACCESS', 'NOTALLOWED',):
+                    print_error("%s, %s : %s, Skipping " % (self.pool, label, inhibit, ))
+                    break
+                print_message("%s, %s Sleeping" % (self.pool, label, ))
+                pools = get_active_pools_in_pool_group(ssh, POOL_GROUP)
+                time.sleep(600)
 
-                        if not started_migration:
-                            stage(ssh, self.pool, pnfsid)
-
-                if count == number_of_files and files:
-                    loop += 1
-                    number_of_files = len(files)
-                    print_message("%s, %s : %d staged, %d migrated, %d total, %d remain,  %d pass" %
-                                  (self.pool, label, cached, migrated, total,  number_of_files, loop))
-                    count = 0
-                    #
-                    # Check that label is still OK
-                    #
-                    inhibit = get_label_system_inhibit(pool, label)
-                    if inhibit in ('NOACCESS', 'NOTALLOWED',):
-                        print_error("%s, %s : %s, Skipping " % (self.pool, label, inhibit, ))
-                        break
-                    print_message("%s, %s Sleeping" % (self.pool, label, ))
-                    pools = get_active_pools_in_pool_group(ssh, POOL_GROUP)
-                    time.sleep(600)
-
+            if not pending:
+                pending.remove()
             # label is done here
             print_message("%s, %s : Done,  %d staged, %d migrated, %d total  " % (self.pool, label, cached, migrated, total))
         ssh.close()
@@ -680,6 +680,11 @@ def main():
         "--sg",
         help="storage group")
 
+    parser.add_argument(
+        "--state_dir",
+        help="directory to keep per label file state in, so that restart "
+        "does not redo files already done")
+
     args = parser.parse_args()
 
     if not args.file and not args.label:
@@ -719,7 +724,7 @@ def main():
     ssh.close()
 
     for pool in pools:
-        worker = StageWorker(stage_queue, pool)
+        worker = StageWorker(stage_queue, pool, args.state_dir)
         stage_workers.append(worker)
         worker.start()
 
@@ -11,7 +11,7 @@ import sys
 import time
 import uuid
 
-import paramiko
+import admin_shell
 import psycopg2
 import psycopg2.extras
 
@@ -74,14 +74,7 @@ def get_shell():
     """
     Admin shell
     """
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=SSH_HOST,
-                port=SSH_PORT,
-                username=SSH_USER,
-                gss_auth=True,
-                gss_kex=True)
-    return ssh
+    return admin_shell.get_shell(SSH_HOST, SSH_PORT, SSH_USER, kinit, kinitLock)
 
 
 def execute_admin_command(ssh, cmd):
@@ -312,7 +305,7 @@ class KinitWorker(multiprocessing.Process):
         while not self.stop:
             with kinitLock:
                 kinit()
-                time.sleep(14400)
+            time.sleep(14400)
 
 
 class UnpinWorker(multiprocessing.Process):
@@ -15,6 +15,8 @@ import paramiko
 import psycopg2
 import psycopg2.extras
 
+from pending import PendingFiles, DONE
+
 #migration copy -permanent -storage=GM2.gm2_daq_run5 -tmode=same+admin(604800) -sticky -smode=removable -select=random -target=pgroup GM2Pools
 
 try:
@@ -311,9 +313,10 @@ class StageWorker(multiprocessing.Process):
     """
     This class is responsible for staging files into source dCache system
     """
-    def __init__(self, stage_queue, pool):
+    def __init__(self, stage_queue, pool, state_dir=None):
         super(StageWorker, self).__init__()
         self.stage_queue = stage_queue
+        self.state_dir = state_dir
         self.pool = str(pool)
 
     def run(self):
@@ -394,13 +397,11 @@ class StageWorker(multiprocessing.Process):
                 print_error("%s %s %s: PNFS is not mounted, mount pnfs. Quitting" % (self.pool, label,))
                 break
 
-            number_of_files = len(files)
-            total = number_of_files
-            print_message("Doing label %s, number of files %d" % (label, number_of_files))
-            cached = loop = count = migrated = 0
-            while files:
-                count += 1
-                bfid, pnfsid, crc, fsize = files.pop(0)
+            total = len(files)
+            print_message("Doing label %s, number of files %d" % (label, total))
+            cached = migrated = 0
+            pending = PendingFiles(label, files, self.state_dir)
+            for bfid, pnfsid, crc, fsize in pending.remaining():
                 locations = []
                 try:
                     locations = get_locations(ssh, pnfsid)
@@ -409,7 +410,12 @@ class StageWorker(multiprocessing.Process):
                 if not locations:
                     continue
                 res = unpin(ssh, pnfsid)
-                cached += 1 
+                cached += 1
+                pending.set_state(pnfsid, DONE)
+            if pending:
+                pending.save()
+            else:
+                pending.remove()
             # label is done here
             print_message("%s, %s : Done,  %d unpinned, %d migrated, %d total  " % (self.pool, label, cached, migrated, total))
         ssh.close()
@@ -582,6 +588,11 @@ def main():
         "--sg",
         help="storage group")
 
+    parser.add_argument(
+        "--state_dir",
+        help="directory to keep per label file state in, so that restart "
+        "does not redo files already done")
+
     args = parser.parse_args()
 
     if not args.file and not args.label:
@@ -620,7 +631,7 @@ def main():
     ssh.close()
 
     for pool in range(cpu_count):
-        worker = StageWorker(stage_queue, pool)
+        worker = StageWorker(stage_queue, pool, args.state_dir)
         stage_workers.append(worker)
         worker.start()
 
@@ -0,0 +1,89 @@
+#!/bin/env python
+"""
+Micro-benchmark comparing per file and batch conversion of
+seed 0 adler32 checksums to seed 1 adler32 checksums as done
+by enstore2cta.py. The per file path uses a copy of the former
+enstore2cta.py switch epoch function below, which set TZ and
+parsed CRC_SWITCH for every file.
+"""
+from __future__ import print_function
+import argparse
+import os
+import random
+import time
+
+import enstore2cta
+
+
+#
+# switch epoch of enstore2cta.py before it was calculated once
+#
+
+def get_switch_epoch():
+    """
+    Timestamp when the change from 0 to 1 based adler checksum happened
+    """
+    time_format = '%Y-%m-%d %H:%M:%S'
+    os.environ['TZ'] = 'America/Chicago'
+    epoch = int(time.mktime(time.strptime(enstore2cta.CRC_SWITCH, time_format)))
+    return epoch
+
+
+def main():
+    """
+    main function
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="This script compares speed of per file and batch "
+        "adler32 seed 0 to seed 1 conversion on synthetic volume "
+        "and checks that both produce identical results")
+
+    parser.add_argument(
+        "--rows",
+        action="store",
+        type=int,
+        default=1000000,
+        help="number of files on synthetic volume")
+
+    args = parser.parse_args()
+
+    epoch = enstore2cta.get_switch_epoch()
+    crcs = [random.randint(0, (1 << 32) - 1) for i in range(args.rows)]
+    sizes = [random.randint(0, 1 << 42) for i in range(args.rows)]
+    create_times = [random.randint(epoch - 86400 * 365 * 5, epoch + 86400 * 365 * 5)
+                    for i in range(args.rows)]
+
+    bfids = ["CDMS%d00000" % (i,) for i in create_times]
+    t0 = time.time()
+    expected = []
+    for bfid, crc, size in zip(bfids, crcs, sizes):
+        file_create_time = int(bfid[4:14])
+        if file_create_time < get_switch_epoch():
+            crc = enstore2cta.convert_0_adler32_to_1_adler32(crc, size)
+        expected.append(crc)
+    t1 = time.time() - t0
+
+    t0 = time.time()
+    create_times = [int(bfid[4:14]) for bfid in bfids]
+    result = enstore2cta.convert_0_adler32_to_1_adler32_batch(crcs,
+                                                              sizes,
+                                                              create_times,
+                                                              enstore2cta.get_switch_epoch())
+    t2 = time.time() - t0
+
+    if result != expected:
+        enstore2cta.print_error("Batch conversion differs from per file conversion")
+        return 1
+
+    enstore2cta.print_message("%d rows, numpy %s" %
+                              (args.rows,
+                               "available" if enstore2cta.numpy else "not available",))
+    enstore2cta.print_message("per file : %.3f s, %d rows/s" % (t1, args.rows / t1,))
+    enstore2cta.print_message("batch    : %.3f s, %d rows/s" % (t2, args.rows / t2,))
+    enstore2cta.print_message("speedup  : %.1f" % (t1 / t2,))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,396 @@
+#!/bin/env python
+"""
+Throughput benchmark of enstore2cta.py against local PostgreSQL.
+
+Script creates synthetic Enstore, CTA and Chimera databases,
+runs enstore2cta.py --all in each requested mode on freshly
+created databases and reports files/s, commits/s, peak RSS and
+time spent in bootstrap, file migration and copy counts phases.
+"""
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+import enstore2cta
+
+try:
+    import urlparse
+except ModuleNotFoundError:
+    import urllib.parse as urlparse
+
+
+CTA_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "cta_schema.sql")
+
+ENSTORE2CTA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "enstore2cta.py")
+
+DATABASES = ("enstore", "cta", "chimera")
+
+MODES = {
+    "per_file" : [],
+    "bulk" : ["--bulk"],
+    "pipeline" : ["--pipeline"],
+}
+
+ENSTORE_SCHEMA = """
+create table volume (
+  id serial primary key,
+  label varchar(16) not null unique,
+  media_type varchar(16) not null,
+  library varchar(64) not null,
+  storage_group varchar(64) not null,
+  file_family varchar(64) not null,
+  system_inhibit_0 varchar(16) not null,
+  active_files integer not null,
+  active_bytes bigint not null,
+  eod_cookie varchar(32) not null,
+  declared timestamp not null,
+  last_access timestamp not null,
+  sum_rd_access integer not null,
+  sum_wr_access integer not null,
+  sum_mounts integer not null,
+  comment varchar(256)
+);
+
+create table file (
+  bfid varchar(32) primary key,
+  volume integer not null references volume(id),
+  pnfs_id varchar(36) not null,
+  size bigint not null,
+  crc bigint not null,
+  uid integer not null,
+  gid integer not null,
+  location_cookie varchar(32) not null,
+  deleted char(1) not null,
+  update timestamp not null default now()
+);
+
+create index file_volume_idx on file(volume);
+create index file_pnfs_id_idx on file(pnfs_id);
+
+create table file_copies_map (
+  bfid varchar(32) not null,
+  alt_bfid varchar(32) not null
+);
+
+create index file_copies_map_bfid_idx on file_copies_map(bfid);
+"""
+
+#
+# %(volumes)s primary volumes with %(files)s files each, volume n has
+# copy volume n for files selected by %(copy_ratio)s
+#
+ENSTORE_DATA = """
+insert into volume (label, media_type, library, storage_group, file_family,
+                    system_inhibit_0, active_files, active_bytes, eod_cookie,
+                    declared, last_access, sum_rd_access, sum_wr_access,
+                    sum_mounts, comment)
+select 'BP'||lpad(v::text, 4, '0')||'L8', 'LTO8', 'BENCH', 'bench', 'raw',
+       'none', %(files)s, %(files)s::bigint * %(file_size)s,
+       '0000_000000000_'||lpad((%(files)s + 1)::text, 7, '0'),
+       now(), now(), 1, 1, 2, 'benchmark volume'
+from generate_series(1, %(volumes)s) v;
+
+insert into volume (label, media_type, library, storage_group, file_family,
+                    system_inhibit_0, active_files, active_bytes, eod_cookie,
+                    declared, last_access, sum_rd_access, sum_wr_access,
+                    sum_mounts, comment)
+select 'BC'||lpad(v::text, 4, '0')||'L8', 'LTO8', 'BENCH', 'bench', 'raw_copy_1',
+       'none', %(files)s, %(files)s::bigint * %(file_size)s,
+       '0000_000000000_'||lpad((%(files)s + 1)::text, 7, '0'),
+       now(), now(), 1, 1, 2, 'benchmark copy volume'
+from generate_series(1, %(volumes)s) v;
+
+insert into file (bfid, volume, pnfs_id, size, crc, uid, gid, location_cookie, deleted)
+select 'BNCH'||(1500000000 + v)::text||lpad(n::text, 8, '0'),
+       (select id from volume where label = 'BP'||lpad(v::text, 4, '0')||'L8'),
+       '0000'||upper(md5(v::text||'.'||n::text)),
+       %(file_size)s,
+       (hashtext(v::text||'.'||n::text)::bigint & 4294967295),
+       1000, 1000,
+       '0000_000000000_'||lpad(n::text, 7, '0'),
+       'n'
+from generate_series(1, %(volumes)s) v, generate_series(1, %(files)s) n;
+
+insert into file (bfid, volume, pnfs_id, size, crc, uid, gid, location_cookie, deleted)
+select 'BNCC'||(1500000000 + v)::text||lpad(n::text, 8, '0'),
+       (select id from volume where label = 'BC'||lpad(v::text, 4, '0')||'L8'),
+       '0000'||upper(md5(v::text||'.'||n::text)),
+       %(file_size)s,
+       (hashtext(v::text||'.'||n::text)::bigint & 4294967295),
+       1000, 1000,
+       '0000_000000000_'||lpad(n::text, 7, '0'),
+       'n'
+from generate_series(1, %(volumes)s) v, generate_series(1, %(files)s) n
+  where (hashtext('copy.'||v::text||'.'||n::text)::bigint & 65535) < %(copy_ratio)s * 65536;
+
+insert into file_copies_map (bfid, alt_bfid)
+select 'BNCH'||substr(bfid, 5), bfid from file where bfid like 'BNCC%%';
+
+analyze;
+"""
+
+CHIMERA_SCHEMA = """
+create table t_inodes (
+  inumber bigserial primary key,
+  ipnfsid varchar(36) not null unique
+);
+
+create table t_locationinfo (
+  inumber bigint not null references t_inodes(inumber),
+  itype integer not null,
+  ilocation varchar(1024) not null,
+  ipriority integer not null,
+  ictime timestamp not null,
+  iatime timestamp not null,
+  istate integer not null,
+  primary key (inumber, itype, ilocation)
+);
+"""
+
+CHIMERA_DATA = """
+insert into t_inodes (ipnfsid)
+select '0000'||upper(md5(v::text||'.'||n::text))
+from generate_series(1, %(volumes)s) v, generate_series(1, %(files)s) n;
+
+analyze;
+"""
+
+SELECT_COMMITS = """
+select xact_commit from pg_stat_database where datname = current_database()
+"""
+
+
+def database_uri(uri, name):
+    """
+    Replace database name in connection URI
+    """
+    result = urlparse.urlparse(uri)
+    return urlparse.urlunparse(result._replace(path="/" + name))
+
+
+def execute(uri, sql, pars=None):
+    """
+    Execute SQL statement(s) in autocommit mode
+    """
+    connection = enstore2cta.create_connection(uri)
+    try:
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute(sql, pars)
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def get_commits(uri):
+    connection = enstore2cta.create_connection(uri)
+    try:
+        rows = enstore2cta.select(connection, SELECT_COMMITS)
+        return int(rows[0]["xact_commit"])
+    finally:
+        connection.close()
+
+
+def create_databases(args, uris):
+    """
+    (Re-)create and populate synthetic databases
+    """
+    for name in DATABASES:
+        db_name = "%s_%s" % (args.prefix, name)
+        execute(args.db, "drop database if exists %s" % (db_name,))
+        execute(args.db, "create database %s" % (db_name,))
+
+    pars = {"volumes" : args.volumes,
+            "files" : args.files,
+            "file_size" : args.file_size,
+            "copy_ratio" : args.copy_ratio}
+
+    execute(uris["enstore"], ENSTORE_SCHEMA)
+    execute(uris["enstore"], ENSTORE_DATA, pars)
+
+    with open(CTA_SCHEMA, "r") as f:
+        schema = "".join([line for line in f if "OWNER TO" not in line])
+    execute(uris["cta"], schema)
+
+    execute(uris["chimera"], CHIMERA_SCHEMA)
+    execute(uris["chimera"], CHIMERA_DATA, pars)
+
+
+def run_mode(args, uris, mode, config_file):
+    """
+    Run enstore2cta.py in one mode and collect statistics
+    """
+    commits = dict((name, get_commits(uris[name])) for name in ("cta", "chimera"))
+    env = dict(os.environ)
+    env["MIGRATION_CONFIG"] = config_file
+    cmd = [sys.executable, ENSTORE2CTA,
+           "--all",
+           "--cpu_count", str(args.cpu_count)] + MODES[mode]
+
+    phases = {}
+    t0 = time.time()
+    process = subprocess.Popen(cmd,
+                               env=env,
+                               stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    for line in process.stdout:
+        if args.verbose:
+            sys.stdout.write(line)
+        if "Start processing" in line:
+            phases["bootstrap"] = time.time() - t0
+        elif "Finished file migration" in line:
+            phases["migration"] = time.time() - t0 - phases.get("bootstrap", 0)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    duration = time.time() - t0
+    phases["copy_counts"] = duration - phases.get("migration", 0) - phases.get("bootstrap", 0)
+    process.stdout.close()
+
+    #
+    # statistics collector is updated asynchronously
+    #
+    time.sleep(1)
+    for name in ("cta", "chimera"):
+        commits[name] = get_commits(uris[name]) - commits[name]
+
+    connection = enstore2cta.create_connection(uris["cta"])
+    try:
+        migrated = enstore2cta.select(connection,
+                                      "select count(*) as count from archive_file")[0]["count"]
+    finally:
+        connection.close()
+    return {"mode" : mode,
+            "status" : os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1,
+            "files" : int(migrated),
+            "duration" : duration,
+            "phases" : phases,
+            "commits" : commits,
+            "max_rss" : rusage.ru_maxrss}
+
+
+def main():
+    """
+    main function
+    """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="This script creates synthetic Enstore, CTA and Chimera "
+        "databases in local PostgreSQL and measures enstore2cta.py "
+        "throughput in per file, bulk and pipeline modes. Databases "
+        "<prefix>_enstore, <prefix>_cta and <prefix>_chimera are dropped "
+        "and re-created for each mode.")
+
+    parser.add_argument(
+        "--db",
+        default="postgresql://postgres@localhost:5432/postgres",
+        help="connection URI of local PostgreSQL, needs create database privilege")
+
+    parser.add_argument(
+        "--prefix",
+        default="enstore2cta_bench",
+        help="prefix of names of created databases")
+
+    parser.add_argument(
+        "--volumes",
+        type=int,
+        default=8,
+        help="number of primary volumes")
+
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=10000,
+        help="number of files per volume")
+
+    parser.add_argument(
+        "--file_size",
+        type=int,
+        default=1 << 30,
+        help="file size in bytes")
+
+    parser.add_argument(
+        "--copy_ratio",
+        type=float,
+        default=0.1,
+        help="fraction of files having second copy")
+
+    parser.add_argument(
+        "--cpu_count",
+        type=int,
+        default=4,
+        help="number of enstore2cta workers")
+
+    parser.add_argument(
+        "--modes",
+        default=",".join(sorted(MODES.keys())),
+        help="comma separated list of modes to run")
+
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print enstore2cta.py output")
+
+    args = parser.parse_args()
+
+    modes = args.modes.strip().split(",")
+    for mode in modes:
+        if mode not in MODES:
+            enstore2cta.print_error("Unknown mode %s" % (mode,))
+            return 1
+
+    uris = dict((name, database_uri(args.db, "%s_%s" % (args.prefix, name)))
+                for name in DATABASES)
+
+    fd, config_file = tempfile.mkstemp(suffix=".yaml")
+    os.close(fd)
+    os.chmod(config_file, 0o600)
+    with open(config_file, "w") as f:
+        yaml.safe_dump({"disk_instance_name" : "benchmark",
+                        "cta_db" : uris["cta"],
+                        "enstore_db" : uris["enstore"],
+                        "chimera_db" : uris["chimera"],
+                        "media_type_map" : {"LTO8" : "LTO8",
+                                            "M8" : "LTO7M",
+                                            "LTO9" : "LTO9"}},
+                       f)
+
+    results = []
+    try:
+        for mode in modes:
+            t0 = time.time()
+            create_databases(args, uris)
+            enstore2cta.print_message("%s: created synthetic databases in %.1f s" %
+                                      (mode, time.time() - t0,))
+            results.append(run_mode(args, uris, mode, config_file))
+    finally:
+        os.unlink(config_file)
+
+    print("%-10s %6s %9s %9s %9s %12s %12s %11s %11s %11s %8s" %
+          ("mode", "status", "files", "seconds", "files/s",
+           "cta commit/s", "chim commit/s", "bootstrap s", "migration s",
+           "counts s", "rss MB"))
+    for r in results:
+        print("%-10s %6d %9d %9.1f %9.1f %12.1f %12.1f %11.1f %11.1f %11.1f %8.1f" %
+              (r["mode"],
+               r["status"],
+               r["files"],
+               r["duration"],
+               r["files"] / r["duration"],
+               r["commits"]["cta"] / r["duration"],
+               r["commits"]["chimera"] / r["duration"],
+               r["phases"].get("bootstrap", 0),
+               r["phases"].get("migration", 0),
+               r["phases"].get("copy_counts", 0),
+               r["max_rss"] / 1024.))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,7 +1,9 @@
 #!/bin/env python
 from __future__ import print_function
 import argparse
+import contextlib
 import errno
+import json
 import multiprocessing
 import os
 import re
@@ -9,6 +11,7 @@ import socket
 import stat
 import subprocess
 import sys
+import threading
 import time
 import uuid
 import traceback
@@ -23,6 +26,16 @@ try:
 except ModuleNotFoundError:
     import urllib.parse as urlparse
 
+try:
+    import Queue
+except ModuleNotFoundError:
+    import queue as Queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 CONFIG_FILE = os.getenv("MIGRATION_CONFIG")
 if not CONFIG_FILE:
@@ -197,7 +210,7 @@ select distinct storage_group from volume
 #
 
 SELECT_ALL_ENSTORE_VOLUMES = """
-select label from volume
+select label, active_files, active_bytes from volume
   where media_type in ('LTO8', 'M8', 'LTO9')
         and system_inhibit_0 = 'none'
         and library not like 'shelf%'
@@ -208,6 +221,11 @@ select label from volume
         order by label asc
 """
 
+SELECT_ENSTORE_VOLUME_SIZES = """
+select label, active_files, active_bytes from volume
+  where label = any(%s)
+"""
+
 
 SELECT_ENSTORE_FILES_FOR_VOLUME = """
 select f.*, v.storage_group||'.'||v.file_family||'@cta' as storage_class
@@ -305,14 +323,19 @@ def create_connection(uri):
 
 CRC_SWITCH = '2019-08-21 09:54:26'
 
+SWITCH_EPOCH = None
+
 def get_switch_epoch():
     """
-    Timestamp when the change from 0 to 1 based adler checksum happened
+    Timestamp when the change from 0 to 1 based adler checksum happened.
+    It is calculated once
     """
-    time_format = '%Y-%m-%d %H:%M:%S'
-    os.environ['TZ'] = 'America/Chicago'
-    epoch = int(time.mktime(time.strptime(CRC_SWITCH, time_format)))
-    return epoch
+    global SWITCH_EPOCH
+    if SWITCH_EPOCH is None:
+        time_format = '%Y-%m-%d %H:%M:%S'
+        os.environ['TZ'] = 'America/Chicago'
+        SWITCH_EPOCH = int(time.mktime(time.strptime(CRC_SWITCH, time_format)))
+    return SWITCH_EPOCH
 
 
 def convert_0_adler32_to_1_adler32(crc, filesize):
@@ -326,6 +349,40 @@ def convert_0_adler32_to_1_adler32(crc, filesize):
     return new_adler
 
 
+def convert_0_adler32_to_1_adler32_batch(crcs, filesizes, create_times, epoch):
+    """
+    Convert seed 0 adler32 checksums of files created before
+    epoch to seed 1 adler32 checksums. Uses numpy if it is available.
+
+    :param crcs: checksums
+    :type crcs: list
+
+    :param filesizes: file sizes
+    :type filesizes: list
+
+    :param create_times: file creation times
+    :type create_times: list
+
+    :param epoch: files created before epoch have their checksums converted
+    :type epoch: int
+
+    :return: checksums
+    :rtype: list
+    """
+    if numpy is None:
+        return [convert_0_adler32_to_1_adler32(crc, filesize) if create_time < epoch else crc
+                for crc, filesize, create_time in zip(crcs, filesizes, create_times)]
+    BASE = 65521
+    crc = numpy.array(crcs, dtype=numpy.int64)
+    size = numpy.array(filesizes, dtype=numpy.int64) % BASE
+    s1 = ((crc & 0xffff) + 1) % BASE
+    s2 = (size + ((crc >> 16) & 0xffff)) % BASE
+    new_adler = (s2 << 16) + s1
+    return numpy.where(numpy.array(create_times, dtype=numpy.int64) < epoch,
+                       new_adler,
+                       crc).tolist()
+
+
 INSERT_DISK_INSTANCE = """
 insert into disk_instance (
   disk_instance_name,
@@ -645,14 +702,14 @@ insert into archive_file (
   collocation_hint
 ) values (
   (select nextval ('archive_file_id_seq')),
-  (select disk_instance_name from disk_instance where disk_instance_name = %s),
+  %s,
   %s,
   %s,
   %s,
   %s,
   null,
   %s,
-  (select storage_class_id from storage_class where storage_class_name = %s),
+  %s,
   %s,
   %s,
   %s,
@@ -680,7 +737,7 @@ insert into tape_file (
 )
 """
 
-def insert_cta_file(connection, enstore_file, cta_label, config):
+def insert_cta_file(connection, enstore_file, cta_label, config, cache):
     file_create_time = int(enstore_file["bfid"][4:14])
     file_size = enstore_file["size"]
     file_crc = enstore_file["crc"]
@@ -698,7 +755,7 @@ def insert_cta_file(connection, enstore_file, cta_label, config):
                                     enstore_file["gid"],
                                     file_size,
                                     file_crc,
-                                    enstore_file["storage_class"],
+                                    cache.get("storage_class", enstore_file["storage_class"]),
                                     file_create_time,
                                     int(time.time()),
                                     '0'
@@ -731,6 +788,205 @@ def insert_cta_tape_file_copy(connection,
                      file_create_time,
                      archive_file_id))
 
+
+#
+# bulk mode: all archive_file and tape_file rows of a volume
+# are loaded using multi-row inserts in a single transaction
+#
+
+BULK_PAGE_SIZE = 1000
+
+#
+# pipeline mode: number of files per batch and
+# number of batches queued between stages
+#
+PIPELINE_BATCH_SIZE = 10000
+PIPELINE_QUEUE_SIZE = 4
+
+SELECT_ARCHIVE_FILE_IDS = """
+select nextval('archive_file_id_seq') as archive_file_id
+from generate_series(1, %s)
+"""
+
+SELECT_EXISTING_DISK_FILE_IDS = """
+select disk_file_id from archive_file
+  where disk_instance_name = %s
+        and disk_file_id = any(%s)
+"""
+
+INSERT_ARCHIVE_FILES = """
+insert into archive_file (
+  archive_file_id,
+  disk_instance_name,
+  disk_file_id,
+  disk_file_uid,
+  disk_file_gid,
+  size_in_bytes,
+  checksum_blob,
+  checksum_adler32,
+  storage_class_id,
+  creation_time,
+  reconciliation_time,
+  is_deleted,
+  collocation_hint
+) values %s
+"""
+
+ARCHIVE_FILE_TEMPLATE = """(
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  null,
+  %s,
+  %s,
+  %s,
+  %s,
+  %s,
+  null
+)"""
+
+INSERT_TAPE_FILES = """
+insert into tape_file (
+  vid,
+  fseq,
+  block_id,
+  logical_size_in_bytes,
+  copy_nb,
+  creation_time,
+  archive_file_id
+) values %s
+"""
+
+
+def get_archive_file_ids(cursor, count):
+    """
+    Pre-allocate block of archive file ids from archive_file_id_seq
+
+    :param cursor: database cursor
+    :type cursor: Cursor
+
+    :param count: number of ids to allocate
+    :type count: int
+
+    :return: list of archive file ids
+    :rtype: list
+    """
+    cursor.execute(SELECT_ARCHIVE_FILE_IDS, (count,))
+    return [int(row[0]) for row in cursor.fetchall()]
+
+
+def insert_cta_files_bulk(connection, enstore_files, cta_label, config, cache):
+    """
+    Insert archive_file and tape_file records (including
+    copies) for all files on a volume in a single transaction
+
+    :param connection: CTA database connection
+    :type connection: Connection
+
+    :param enstore_files: enstore files on the volume
+    :type enstore_files: list
+
+    :param cta_label: CTA vid
+    :type cta_label: str
+
+    :param config: configuration
+    :type config: dict
+
+    :param cache: CTA ids lookup cache
+    :type cache: LookupCache
+
+    :return: list of (enstore_file, archive_file_id) tuples
+    :rtype: list
+    """
+    disk_instance_name = config.get("disk_instance_name")
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        cursor.execute(SELECT_EXISTING_DISK_FILE_IDS,
+                       (disk_instance_name,
+                        [f["pnfs_id"] for f in enstore_files]))
+        existing = set([row[0] for row in cursor.fetchall()])
+        archive_file_ids = iter(get_archive_file_ids(cursor, len(enstore_files)))
+
+        new_files = []
+        for f in enstore_files:
+            if f["pnfs_id"] in existing:
+                print_error("%s, multiple pnfsid, skipping %s" %
+                            (cta_label, f["pnfs_id"],))
+                continue
+            existing.add(f["pnfs_id"])
+            new_files.append(f)
+
+        create_times = [int(f["bfid"][4:14]) for f in new_files]
+        crcs = [f["crc"] for f in new_files]
+        #
+        # take care of "adler32 seeed 0" nonsense
+        #
+        if HOSTNAME.endswith(".fnal.gov"):
+            crcs = convert_0_adler32_to_1_adler32_batch(crcs,
+                                                        [f["size"] for f in new_files],
+                                                        create_times,
+                                                        get_switch_epoch())
+
+        archive_files = []
+        tape_files = []
+        result = []
+        now = int(time.time())
+        for f, file_create_time, file_crc in zip(new_files, create_times, crcs):
+            archive_file_id = next(archive_file_ids)
+            file_size = f["size"]
+            archive_files.append((archive_file_id,
+                                  disk_instance_name,
+                                  f["pnfs_id"],
+                                  f["uid"],
+                                  f["gid"],
+                                  file_size,
+                                  file_crc,
+                                  cache.get("storage_class", f["storage_class"]),
+                                  file_create_time,
+                                  now,
+                                  '0'))
+            tape_files.append((cta_label,
+                               extract_file_number(f["location_cookie"]),
+                               extract_file_number(f["location_cookie"]),
+                               file_size,
+                               1,
+                               file_create_time,
+                               archive_file_id))
+            if f.get("label") and f["copy_deleted"] == "n":
+                tape_files.append((f["label"][:6],
+                                   extract_file_number(f["copy_location_cookie"]),
+                                   extract_file_number(f["copy_location_cookie"]),
+                                   file_size,
+                                   2, # copy number
+                                   int(f["copy_bfid"][4:14]),
+                                   archive_file_id))
+            result.append((f, archive_file_id))
+
+        psycopg2.extras.execute_values(cursor,
+                                       INSERT_ARCHIVE_FILES,
+                                       archive_files,
+                                       template=ARCHIVE_FILE_TEMPLATE,
+                                       page_size=BULK_PAGE_SIZE)
+        psycopg2.extras.execute_values(cursor,
+                                       INSERT_TAPE_FILES,
+                                       tape_files,
+                                       page_size=BULK_PAGE_SIZE)
+        connection.commit()
+        return result
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
 INSERT_CTA_TAPE = """
 insert into tape (
    vid,  media_type_id, vendor, logical_library_id, tape_pool_id,
@@ -745,10 +1001,10 @@ insert into tape (
    last_update_user_name, last_update_host_name, last_update_time,
    verification_status)
    values (%s,
-           (select media_type_id from media_type where media_type_name = %s),
+           %s,
            'Unknown',
-           (select logical_library_id from logical_library where logical_library_name = %s),
-           (select tape_pool_id from tape_pool where tape_pool_name = %s),
+           %s,
+           %s,
            '',
            %s,
            %s,
@@ -785,7 +1041,7 @@ insert into tape (
    )
 """
 
-def insert_cta_tape(connection, enstore_volume, config):
+def insert_cta_tape(connection, enstore_volume, config, cache):
     vo = enstore_volume["storage_group"]
     library = enstore_volume["library"]
     tape_pool_name = "%s:%s" % (library, vo,) #FIXME
@@ -798,9 +1054,11 @@ def insert_cta_tape(connection, enstore_volume, config):
     res = insert(connection,
                  INSERT_CTA_TAPE,(
                      enstore_volume["label"][:6],
-                     config.get("media_type_map")[enstore_volume["media_type"]],
-                     logical_library_name,
-                     config.get("tape_pool_name",enstore_volume["storage_group"]),  #FIXME
+                     cache.get("media_type",
+                               config.get("media_type_map")[enstore_volume["media_type"]]),
+                     cache.get("logical_library", logical_library_name),
+                     cache.get("tape_pool",
+                               config.get("tape_pool_name",enstore_volume["storage_group"])),  #FIXME
                      enstore_volume["active_bytes"],
                      extract_file_number(enstore_volume["eod_cookie"]) - 1,
                      enstore_volume["active_files"],
@@ -864,6 +1122,62 @@ def insert_chimera_location(connection, enstore_file, location):
     return res
 
 
+CHIMERA_BATCH_SIZE = 10000
+
+SELECT_CHIMERA_INUMBERS = """
+select ipnfsid, inumber from t_inodes where ipnfsid = any(%s)
+"""
+
+INSERT_CHIMERA_LOCATIONS = """
+insert into t_locationinfo (inumber, itype, ipriority, ictime, iatime, istate, ilocation)
+   values %s
+"""
+
+CHIMERA_LOCATION_TEMPLATE = "(%s, 0, 10, now(), now(), 1, %s)"
+
+
+def insert_chimera_locations(connection, locations):
+    """
+    Insert CTA locations of multiple files into chimera
+    in a single transaction
+
+    :param connection: chimera database connection
+    :type connection: Connection
+
+    :param locations: list of (pnfsid, location) tuples
+    :type locations: list
+
+    :return: list of pnfsids not found in chimera
+    :rtype: list
+    """
+    cursor = None
+    try:
+        cursor = connection.cursor()
+        cursor.execute(SELECT_CHIMERA_INUMBERS,
+                       ([pnfsid for pnfsid, location in locations],))
+        inumbers = dict(cursor.fetchall())
+        unresolved = [pnfsid for pnfsid, location in locations
+                      if pnfsid not in inumbers]
+        psycopg2.extras.execute_values(cursor,
+                                       INSERT_CHIMERA_LOCATIONS,
+                                       [(inumbers[pnfsid], location)
+                                        for pnfsid, location in locations
+                                        if pnfsid in inumbers],
+                                       template=CHIMERA_LOCATION_TEMPLATE,
+                                       page_size=BULK_PAGE_SIZE)
+        connection.commit()
+        return unresolved
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
 UPDATE_COPY_COUNTS = """
 update tape
    set nb_copy_nb_1 = t.nb_copy_nb_1,
@@ -882,21 +1196,366 @@ from
     where t.vid = tape.vid
 """
 
-def update_cta_copy_counts(cta_db):
-    res = update(cta_db, UPDATE_COPY_COUNTS)
+UPDATE_COPY_COUNTS_FOR_VIDS = """
+update tape
+   set nb_copy_nb_1 = t.nb_copy_nb_1,
+       copy_nb_1_in_bytes = t.copy_nb_1_in_bytes,
+       nb_copy_nb_gt_1 = t.nb_copy_nb_gt_1,
+       copy_nb_gt_1_in_bytes = t.copy_nb_gt_1_in_bytes
+from
+   (select tf.vid as vid,
+      sum(case when tf.copy_nb > 1 then af.size_in_bytes else 0 end) as copy_nb_gt_1_in_bytes,
+      sum(case when tf.copy_nb = 1 then af.size_in_bytes else 0 end) as copy_nb_1_in_bytes,
+      sum(case when tf.copy_nb > 1 then 1 else 0 end) as nb_copy_nb_gt_1,
+      sum(case when tf.copy_nb = 1 then 1 else 0 end) as nb_copy_nb_1
+    from archive_file af
+       inner join tape_file tf on tf.archive_file_id = af.archive_file_id
+    where tf.vid = any(%s)
+    group by tf.vid) as t
+    where t.vid = tape.vid
+"""
+
+def update_cta_copy_counts(cta_db, vids=None):
+    """
+    Update tape copy counts. If vids are given only
+    these tapes are updated
+    """
+    if vids is None:
+        res = update(cta_db, UPDATE_COPY_COUNTS)
+    else:
+        res = update(cta_db, UPDATE_COPY_COUNTS_FOR_VIDS, (list(vids),))
+    return res
+
+
+#
+# per label migration state, kept in CTA db, used to
+# resume interrupted migration
+#
+
+LABEL_STARTED = "started"
+LABEL_DONE = "done"
+
+CREATE_MIGRATION_STATE = """
+create table if not exists enstore2cta_state (
+  label character varying(100) not null primary key,
+  status character varying(10) not null,
+  nb_files numeric(20,0) default 0 not null,
+  start_time numeric(20,0) not null,
+  end_time numeric(20,0),
+  host_name character varying(100) not null
+)
+"""
+
+SELECT_LABEL_STATE = """
+select * from enstore2cta_state where label = %s
+"""
+
+SELECT_LABEL_STATES = """
+select label, status from enstore2cta_state
+"""
+
+INSERT_LABEL_STARTED = """
+insert into enstore2cta_state (
+  label,
+  status,
+  nb_files,
+  start_time,
+  end_time,
+  host_name
+) values (
+  %s,
+  'started',
+  0,
+  %s,
+  null,
+  %s
+) on conflict (label) do update
+  set status = excluded.status,
+      nb_files = excluded.nb_files,
+      start_time = excluded.start_time,
+      end_time = null,
+      host_name = excluded.host_name
+  where enstore2cta_state.status <> 'done'
+"""
+
+UPDATE_LABEL_DONE = """
+update enstore2cta_state
+   set status = 'done',
+       nb_files = %s,
+       end_time = %s
+   where label = %s
+"""
+
+DELETE_LABEL_STATE = """
+delete from enstore2cta_state where label = %s
+"""
+
+
+def create_migration_state(cta_db):
+    res = insert(cta_db, CREATE_MIGRATION_STATE)
+    return res
+
+
+def get_label_state(cta_db, label):
+    rows = select(cta_db, SELECT_LABEL_STATE, (label,))
+    if rows:
+        return rows[0]["status"]
+    return None
+
+
+def get_label_states(cta_db):
+    rows = select(cta_db, SELECT_LABEL_STATES)
+    return dict((row["label"], row["status"]) for row in rows)
+
+
+def set_label_started(cta_db, label):
+    res = insert(cta_db,
+                 INSERT_LABEL_STARTED,
+                 (label, int(time.time()), HOSTNAME))
     return res
 
 
+def clear_label_state(cta_db, label):
+    res = update(cta_db,
+                 DELETE_LABEL_STATE,
+                 (label,))
+    return res
+
+
+def set_label_done(cta_db, label, number_of_files):
+    res = update(cta_db,
+                 UPDATE_LABEL_DONE,
+                 (number_of_files, int(time.time()), label))
+    return res
+
+
+SELECT_CTA_FILES_FOR_VID = """
+select af.archive_file_id, af.disk_file_id
+from archive_file af
+  inner join tape_file tf on tf.archive_file_id = af.archive_file_id
+  where tf.vid = %s
+        and tf.copy_nb = 1
+"""
+
+SELECT_CTA_TAPE = """
+select vid from tape where vid = %s
+"""
+
+DELETE_CHIMERA_LOCATIONS = """
+delete from t_locationinfo
+  where inumber in (select inumber from t_inodes where ipnfsid = any(%s))
+        and itype = 0
+        and ilocation = any(%s)
+"""
+
+
+def delete_label(cta_db, chimera_db, cta_label):
+    """
+    Remove all records of partially migrated label from CTA
+    and chimera DBs so that label can be migrated again. Tape
+    is kept if other files still reference it
+
+    :param cta_db: CTA database connection
+    :type cta_db: Connection
+
+    :param chimera_db: chimera database connection
+    :type chimera_db: Connection
+
+    :param cta_label: CTA vid
+    :type cta_label: str
+
+    :return: number of deleted archive files
+    :rtype: int
+    """
+    files = select(cta_db, SELECT_CTA_FILES_FOR_VID, (cta_label,))
+    pnfsids = [row["disk_file_id"] for row in files]
+    archive_file_ids = [int(row["archive_file_id"]) for row in files]
+    if chimera_db and pnfsids:
+        locations = ["cta://cta/%s?archiveid=%d" % (row["disk_file_id"],
+                                                    int(row["archive_file_id"]),)
+                     for row in files]
+        res = insert(chimera_db,
+                     DELETE_CHIMERA_LOCATIONS,
+                     (pnfsids, locations))
+    cursor = None
+    try:
+        cursor = cta_db.cursor()
+        cursor.execute("delete from tape_file where archive_file_id = any(%s::numeric[])",
+                       (archive_file_ids,))
+        cursor.execute("delete from archive_file where archive_file_id = any(%s::numeric[])",
+                       (archive_file_ids,))
+        # tape may also hold copy_nb=2 files of other labels
+        # (added as copy volume), keep it then
+        cursor.execute("delete from tape where vid = %s "
+                       "and not exists (select 1 from tape_file where vid = %s)",
+                       (cta_label, cta_label,))
+        cta_db.commit()
+        return len(archive_file_ids)
+    except Exception:
+        cta_db.rollback()
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+
+class Stats(object):
+    """
+    Time spent, number of calls and number of rows processed
+    by migration phase, with histogram of call durations, and
+    error counts by category. Workers send Stats of each label
+    to main process which merges them
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.errors = {}
+
+    @staticmethod
+    def bucket(seconds):
+        """
+        Histogram bucket, upper bound in milliseconds (power of 2)
+        """
+        bucket = 1
+        while bucket < seconds * 1000:
+            bucket <<= 1
+        return bucket
+
+    def add(self, phase, seconds, rows=1):
+        with self.lock:
+            data = self.phases.setdefault(phase, {"calls" : 0,
+                                                  "seconds" : 0.,
+                                                  "rows" : 0,
+                                                  "histogram" : {}})
+            data["calls"] += 1
+            data["seconds"] += seconds
+            data["rows"] += rows
+            bucket = Stats.bucket(seconds)
+            data["histogram"][bucket] = data["histogram"].get(bucket, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, phase, rows=1):
+        """
+        Time block of code. Number of rows can be
+        updated by assigning to "rows" key of yielded dictionary
+        """
+        counter = {"rows" : rows}
+        t0 = time.time()
+        try:
+            yield counter
+        finally:
+            self.add(phase, time.time() - t0, counter["rows"])
+
+    def error(self, category, count=1):
+        with self.lock:
+            self.errors[category] = self.errors.get(category, 0) + count
+
+    def to_dict(self):
+        with self.lock:
+            return {"phases" : self.phases, "errors" : self.errors}
+
+    def merge(self, other):
+        """
+        Merge dictionary produced by to_dict
+        """
+        with self.lock:
+            for phase, data in other["phases"].items():
+                mine = self.phases.setdefault(phase, {"calls" : 0,
+                                                      "seconds" : 0.,
+                                                      "rows" : 0,
+                                                      "histogram" : {}})
+                for key in ("calls", "seconds", "rows"):
+                    mine[key] += data[key]
+                for bucket, count in data["histogram"].items():
+                    mine["histogram"][bucket] = mine["histogram"].get(bucket, 0) + count
+            for category, count in other["errors"].items():
+                self.errors[category] = self.errors.get(category, 0) + count
+
+    def summary(self):
+        """
+        One line summary of time spent and rows/s by phase
+        """
+        with self.lock:
+            total = sum([data["seconds"] for phase, data in self.phases.items()
+                         if phase != "label"])
+            items = []
+            for phase, data in sorted(self.phases.items()):
+                if phase == "label":
+                    continue
+                items.append("%s %.1fs %d%% %d rows/s" %
+                             (phase,
+                              data["seconds"],
+                              int(100. * data["seconds"] / total + 0.5) if total else 0,
+                              int(data["rows"] / data["seconds"]) if data["seconds"] else 0))
+            errors = ", ".join(["%s %d" % (category, count)
+                                for category, count in sorted(self.errors.items())])
+            return "; ".join(items) + (" errors: " + errors if errors else "")
+
+
+SELECT_LOOKUP_IDS = {
+    "media_type" : "select media_type_name as name, media_type_id as id from media_type",
+    "logical_library" : "select logical_library_name as name, logical_library_id as id from logical_library",
+    "tape_pool" : "select tape_pool_name as name, tape_pool_id as id from tape_pool",
+    "storage_class" : "select storage_class_name as name, storage_class_id as id from storage_class",
+}
+
+
+class LookupCache(object):
+    """
+    Cache of CTA media type, logical library, tape pool and
+    storage class ids by name. Cache is re-loaded from CTA db
+    once for each name that is not found
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.ids = {}
+        self.missing = set()
+
+    def load(self):
+        for table, sql in SELECT_LOOKUP_IDS.items():
+            self.ids[table] = dict((row["name"], int(row["id"]))
+                                   for row in select(self.connection, sql))
+
+    def get(self, table, name):
+        """
+        Return id of name in table, raise KeyError if
+        it does not exist in CTA db
+        """
+        try:
+            return self.ids[table][name]
+        except KeyError:
+            if (table, name) in self.missing:
+                raise KeyError("%s %s does not exist" % (table, name,))
+            self.missing.add((table, name))
+            self.load()
+            try:
+                return self.ids[table][name]
+            except KeyError:
+                raise KeyError("%s %s does not exist" % (table, name,))
+
+
 class Worker(multiprocessing.Process):
     """
     Class that processed individual enstore volume
     """
-    def __init__(self, queue, config):
+    def __init__(self, queue, config, progress=None):
         super(Worker, self).__init__()
         self.queue = queue
         self.config = config
+        self.progress = progress
+        # CTA vids which received files of the current label
+        self.touched_vids = set()
+        # timings and errors of the current label, created in run()
+        # as its lock can not be pickled when process is spawned
+        self.stats = None
+        self.cache = None
 
     def run(self):
+        enstore_db, cta_db, chimera_db = None, None, None
+        self.stats = Stats()
         try:
             # enstore db
             enstore_db = create_connection(self.config.get("enstore_db"))
@@ -905,87 +1564,35 @@ class Worker(multiprocessing.Process):
             # chimera_db
             chimera_db = create_connection(self.config.get("chimera_db"))
 
+            self.cache = LookupCache(cta_db)
+            self.cache.load()
+
             added_copy_volumes = set()
             for label in iter(self.queue.get, None):
-                cta_label = label[:6]
-                print_message("Doing label %s" % (label, ))
-                enstore_volumes = select(enstore_db,
-                                         "select * from volume where label=%s",
-                                         (label,))
-                if not enstore_volumes:
-                    print_error("No such volume %s" % (label, ))
-                    continue
-                enstore_volume = enstore_volumes[0]
+                self.stats = Stats()
+                number_of_files = 0
                 try:
-                    res = insert_cta_tape(cta_db, enstore_volume, self.config)
-                except KeyError:
-                    print_error("Failed to insert tape label %s because mapping for libary %s does not exist" % (enstore_volume["label"], enstore_volume["library"],))
-                    continue
+                    with self.stats.timer("label") as counter:
+                        number_of_files = self.process_label(enstore_db,
+                                                             cta_db,
+                                                             chimera_db,
+                                                             label,
+                                                             added_copy_volumes)
+                        counter["rows"] = number_of_files
                 except Exception as e:
-                    print_error("%s already exist, skipping, %s " %
-                                (enstore_volume["label"], str(e)))
-                    continue
-                files = select(enstore_db,
-                               SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
-                               (label, ))
-                for f in files:
-                    try:
-                        archive_file_id = insert_cta_file(cta_db,
-                                                          f,
-                                                          cta_label,
-                                                          self.config)
-                        #
-                        # do we have a copy
-                        #
-                        copy_label = f.get("label")
-                        if copy_label:
-                            if copy_label not in added_copy_volumes:
-                                added_copy_volumes.add(copy_label)
-                                try:
-                                    res = insert_cta_tape(cta_db,
-                                                          f,
-                                                          self.config)
-                                    print_message("%s added label containing "
-                                                  "copies  %s" % (label,
-                                                                  copy_label,))
-                                except Exception as e:
-                                    print_error("%s volume %s already exists, "
-                                                "skipping %s" %
-                                                (label, f["label"], str(e)))
-                                    pass
-                            try:
-                                if f["copy_deleted"] == "n":
-                                    insert_cta_tape_file_copy(cta_db,
-                                                              archive_file_id,
-                                                              f,
-                                                              self.config)
-                            except Exception as e:
-                                print_error("%s Failed to insert tape_file, %s"
-                                            " %s %s %s, skipping %s" %
-                                            (label,
-                                             f["label"],
-                                             f["pnfs_id"],
-                                             f["bfid"],
-                                             f["copy_bfid"],
-                                             str(e)))
-                                pass
-
-                        if not self.config["skip_locations"]:
-
-                            location = "cta://cta/%s?archiveid=%d" % (f["pnfs_id"],
-                                                                      archive_file_id,)
-                            try:
-                                res = insert_chimera_location(chimera_db, f, location)
-                            except Exception as e:
-                                print_error("%s %s failed to insert location into chimera DB %s, %s" %
-                                            (label, f["pnfs_id"], location, str(e),))
-                                pass
-
-                    except Exception as e:
-                        print_error("%s, multiple pnfsid, skipping %s, %s" %
-                                    (enstore_volume["label"], f["pnfs_id"], str(e)))
-                        continue
-                print_message("%s Done, %d files" %(label, len(files),))
+                    print_error("%s failed, %s" % (label, str(e),))
+                    self.stats.error("label_failed")
+                    # clear aborted transaction before next label
+                    for i in (enstore_db, cta_db, chimera_db):
+                        try:
+                            i.rollback()
+                        except Exception:
+                            pass
+                if self.progress:
+                    self.progress.put((label,
+                                       number_of_files,
+                                       self.touched_vids,
+                                       self.stats.to_dict()))
         except Exception as e:
             print_message("Exception %s" % (str(e)))
         finally:
@@ -995,6 +1602,353 @@ class Worker(multiprocessing.Process):
                         i.close()
                     except:
                         pass
+            if self.progress:
+                self.progress.put(None)
+
+    def process_label(self, enstore_db, cta_db, chimera_db, label,
+                      added_copy_volumes):
+        """
+        Migrate single enstore volume. Returns number of files
+        """
+        cta_label = label[:6]
+        self.touched_vids = set()
+        print_message("Doing label %s" % (label, ))
+        with self.stats.timer("enstore_select"):
+            enstore_volumes = select(enstore_db,
+                                     "select * from volume where label=%s",
+                                     (label,))
+        if not enstore_volumes:
+            print_error("No such volume %s" % (label, ))
+            self.stats.error("no_volume")
+            return 0
+        enstore_volume = enstore_volumes[0]
+        state = get_label_state(cta_db, label)
+        if state == LABEL_DONE and self.config.get("resume"):
+            print_message("%s already migrated, skipping" % (label, ))
+            return 0
+        tape_exists = False
+        if state == LABEL_STARTED and self.config.get("resume"):
+            with self.stats.timer("rollback") as counter:
+                count = delete_label(cta_db,
+                                     None if self.config["skip_locations"] else chimera_db,
+                                     cta_label)
+                counter["rows"] = count
+            tape_exists = bool(select(cta_db, SELECT_CTA_TAPE, (cta_label,)))
+            print_message("%s rolled back partially migrated label, "
+                          "%d files" % (label, count,))
+        t0 = time.time()
+        # record state before the tape goes in, so that --resume
+        # rolls back a tape left behind by a failure right after,
+        # a label already done is never set back to started
+        set_label_started(cta_db, label)
+        try:
+            if tape_exists:
+                print_message("%s keeping tape holding copies of other labels" %
+                              (label, ))
+            else:
+                with self.stats.timer("cta_tape"):
+                    res = insert_cta_tape(cta_db, enstore_volume, self.config, self.cache)
+        except KeyError as e:
+            print_error("Failed to insert tape label %s because mapping for libary %s does not exist, %s" % (enstore_volume["label"], enstore_volume["library"], str(e),))
+            self.stats.error("library_mapping")
+            if state is None:
+                clear_label_state(cta_db, label)
+            return 0
+        except Exception as e:
+            print_error("%s already exist, skipping, %s " %
+                        (enstore_volume["label"], str(e)))
+            self.stats.error("tape_exists")
+            # tape was not ours to roll back, do not leave a state
+            # row behind that would make --resume delete it
+            if state is None:
+                clear_label_state(cta_db, label)
+            return 0
+        self.touched_vids.add(cta_label)
+        if self.config.get("pipeline"):
+            try:
+                number_of_files, count = self.process_files_pipelined(enstore_db,
+                                                                      cta_db,
+                                                                      chimera_db,
+                                                                      label,
+                                                                      added_copy_volumes)
+            except Exception as e:
+                print_error("%s failed, leaving label partially migrated, %s" %
+                            (label, str(e),))
+                self.stats.error("label_failed")
+                return 0
+            set_label_done(cta_db, label, count)
+            print_message("%s Done, %d files, took %d seconds" %
+                          (label, number_of_files, int(time.time() - t0 + 0.5),))
+            return number_of_files
+        with self.stats.timer("enstore_select") as counter:
+            files = select(enstore_db,
+                           SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
+                           (label, ))
+            counter["rows"] = len(files)
+        count = None
+        if self.config.get("bulk"):
+            try:
+                count = self.process_files_bulk(cta_db,
+                                                chimera_db,
+                                                label,
+                                                files,
+                                                added_copy_volumes)
+            except Exception as e:
+                print_error("%s bulk load failed, falling back to "
+                            "per file inserts, %s" % (label, str(e),))
+                self.stats.error("bulk_fallback")
+        if count is None:
+            count = 0
+            for f in files:
+                if self.process_file(cta_db,
+                                     chimera_db,
+                                     label,
+                                     f,
+                                     added_copy_volumes):
+                    count += 1
+        set_label_done(cta_db, label, count)
+        print_message("%s Done, %d files, took %d seconds" %
+                      (label, len(files), int(time.time() - t0 + 0.5),))
+        return len(files)
+
+    def insert_copy_tape(self, cta_db, label, f, added_copy_volumes):
+        """
+        Insert tape containing file copies, once per worker
+        """
+        copy_label = f.get("label")
+        self.touched_vids.add(copy_label[:6])
+        if copy_label not in added_copy_volumes:
+            added_copy_volumes.add(copy_label)
+            try:
+                with self.stats.timer("cta_tape"):
+                    res = insert_cta_tape(cta_db,
+                                          f,
+                                          self.config,
+                                          self.cache)
+                print_message("%s added label containing "
+                              "copies  %s" % (label,
+                                              copy_label,))
+            except Exception as e:
+                print_error("%s volume %s already exists, "
+                            "skipping %s" %
+                            (label, f["label"], str(e)))
+                self.stats.error("copy_tape_exists")
+                pass
+
+    def insert_location(self, chimera_db, label, f, archive_file_id):
+        """
+        Insert CTA location of a file into chimera
+        """
+        location = "cta://cta/%s?archiveid=%d" % (f["pnfs_id"],
+                                                  archive_file_id,)
+        try:
+            with self.stats.timer("chimera_location"):
+                res = insert_chimera_location(chimera_db, f, location)
+        except Exception as e:
+            print_error("%s %s failed to insert location into chimera DB %s, %s" %
+                        (label, f["pnfs_id"], location, str(e),))
+            self.stats.error("chimera_location")
+            pass
+
+    def insert_locations(self, chimera_db, label, inserted):
+        """
+        Insert CTA locations of multiple files into chimera in
+        batches, falling back to one file at a time if batch fails
+        """
+        for i in range(0, len(inserted), CHIMERA_BATCH_SIZE):
+            batch = inserted[i:i + CHIMERA_BATCH_SIZE]
+            try:
+                with self.stats.timer("chimera_location", len(batch)):
+                    unresolved = insert_chimera_locations(
+                        chimera_db,
+                        [(f["pnfs_id"],
+                          "cta://cta/%s?archiveid=%d" % (f["pnfs_id"], archive_file_id,))
+                         for f, archive_file_id in batch])
+                if unresolved:
+                    print_error("%s %d files not found in chimera DB, "
+                                "locations not inserted: %s" %
+                                (label, len(unresolved), ",".join(unresolved),))
+                    self.stats.error("chimera_location", len(unresolved))
+            except Exception as e:
+                print_error("%s failed to insert locations into chimera DB, "
+                            "falling back to per file inserts, %s" % (label, str(e),))
+                self.stats.error("chimera_fallback")
+                for f, archive_file_id in batch:
+                    self.insert_location(chimera_db, label, f, archive_file_id)
+
+    def process_file(self, cta_db, chimera_db, label, f, added_copy_volumes):
+        """
+        Insert single enstore file into CTA, one statement at a time.
+        Returns archive file id or None if file was not inserted.
+        Chimera location is not inserted if chimera_db is None
+        """
+        cta_label = label[:6]
+        try:
+            with self.stats.timer("cta_file"):
+                archive_file_id = insert_cta_file(cta_db,
+                                                  f,
+                                                  cta_label,
+                                                  self.config,
+                                                  self.cache)
+            #
+            # do we have a copy
+            #
+            copy_label = f.get("label")
+            if copy_label:
+                self.insert_copy_tape(cta_db, label, f, added_copy_volumes)
+                try:
+                    if f["copy_deleted"] == "n":
+                        with self.stats.timer("cta_copy"):
+                            insert_cta_tape_file_copy(cta_db,
+                                                      archive_file_id,
+                                                      f,
+                                                      self.config)
+                except Exception as e:
+                    self.stats.error("copy_tape_file")
+                    print_error("%s Failed to insert tape_file, %s"
+                                " %s %s %s, skipping %s" %
+                                (label,
+                                 f["label"],
+                                 f["pnfs_id"],
+                                 f["bfid"],
+                                 f["copy_bfid"],
+                                 str(e)))
+                    pass
+
+            if chimera_db and not self.config["skip_locations"]:
+                self.insert_location(chimera_db, label, f, archive_file_id)
+            return archive_file_id
+        except Exception as e:
+            print_error("%s, multiple pnfsid, skipping %s, %s" %
+                        (label, f["pnfs_id"], str(e)))
+            self.stats.error("multiple_pnfsid")
+            return None
+
+    def process_files_bulk(self, cta_db, chimera_db, label, files,
+                           added_copy_volumes):
+        """
+        Insert all files of enstore volume into CTA in one transaction.
+        Returns number of inserted files
+        """
+        #
+        # tapes holding copies have to exist before tape_file
+        # records referring to them are inserted
+        #
+        for f in files:
+            if f.get("label"):
+                self.insert_copy_tape(cta_db, label, f, added_copy_volumes)
+
+        with self.stats.timer("cta_file", len(files)):
+            inserted = insert_cta_files_bulk(cta_db,
+                                             files,
+                                             label[:6],
+                                             self.config,
+                                             self.cache)
+        if len(inserted) < len(files):
+            self.stats.error("multiple_pnfsid", len(files) - len(inserted))
+
+        if not self.config["skip_locations"]:
+            self.insert_locations(chimera_db, label, inserted)
+        return len(inserted)
+
+    def read_files(self, enstore_db, label, files_queue, errors):
+        """
+        Pipeline stage streaming enstore files of a volume
+        in batches using server side cursor
+        """
+        try:
+            t0 = time.time()
+            for files in select_iter(enstore_db,
+                                     SELECT_ENSTORE_FILES_FOR_VOLUME_WITH_COPY,
+                                     (label, ),
+                                     PIPELINE_BATCH_SIZE):
+                self.stats.add("enstore_select", time.time() - t0, len(files))
+                files_queue.put(files)
+                t0 = time.time()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            files_queue.put(None)
+
+    def write_locations(self, chimera_db, label, locations_queue, errors):
+        """
+        Pipeline stage inserting CTA locations into chimera
+        """
+        for inserted in iter(locations_queue.get, None):
+            try:
+                self.insert_locations(chimera_db, label, inserted)
+            except Exception as e:
+                errors.append(e)
+
+    def process_files_pipelined(self, enstore_db, cta_db, chimera_db, label,
+                                added_copy_volumes):
+        """
+        Migrate enstore volume reading enstore files, writing CTA
+        records and writing chimera locations concurrently. Stages
+        are connected by bounded queues so that only a few batches of
+        files are held in memory at any time.
+        Returns number of files read and number of files inserted
+        """
+        errors = []
+        files_queue = Queue.Queue(PIPELINE_QUEUE_SIZE)
+        locations_queue = Queue.Queue(PIPELINE_QUEUE_SIZE)
+        reader = threading.Thread(target=self.read_files,
+                                  args=(enstore_db, label, files_queue, errors))
+        reader.start()
+        chimera_writer = None
+        if not self.config["skip_locations"]:
+            chimera_writer = threading.Thread(target=self.write_locations,
+                                              args=(chimera_db, label, locations_queue, errors))
+            chimera_writer.start()
+
+        number_of_files, count = 0, 0
+        try:
+            for files in iter(files_queue.get, None):
+                number_of_files += len(files)
+                for f in files:
+                    if f.get("label"):
+                        self.insert_copy_tape(cta_db, label, f, added_copy_volumes)
+                try:
+                    with self.stats.timer("cta_file", len(files)):
+                        inserted = insert_cta_files_bulk(cta_db,
+                                                         files,
+                                                         label[:6],
+                                                         self.config,
+                                                         self.cache)
+                    if len(inserted) < len(files):
+                        self.stats.error("multiple_pnfsid", len(files) - len(inserted))
+                except Exception as e:
+                    print_error("%s bulk load failed, falling back to "
+                                "per file inserts, %s" % (label, str(e),))
+                    self.stats.error("bulk_fallback")
+                    inserted = []
+                    for f in files:
+                        archive_file_id = self.process_file(cta_db,
+                                                            None,
+                                                            label,
+                                                            f,
+                                                            added_copy_volumes)
+                        if archive_file_id:
+                            inserted.append((f, archive_file_id))
+                count += len(inserted)
+                if chimera_writer:
+                    locations_queue.put(inserted)
+        finally:
+            #
+            # drain reader so that it does not block on full queue
+            #
+            while reader.is_alive():
+                try:
+                    files_queue.get(timeout=1)
+                except Queue.Empty:
+                    pass
+            reader.join()
+            if chimera_writer:
+                locations_queue.put(None)
+                chimera_writer.join()
+        if errors:
+            raise errors[0]
+        return number_of_files, count
 
 
 
@@ -1122,6 +2076,51 @@ def select(con, sql, pars=None):
                 pass
 
 
+def select_iter(con, sql, pars=None, size=BULK_PAGE_SIZE):
+    """
+    Select database records using server side cursor
+
+    :param con: database connection
+    :type con: Connection
+
+    :param sql: SQL statement
+    :type sql: str
+
+    :param pars: query parameters
+    :type pars: tuple
+
+    :param size: number of records fetched at a time
+    :type size: int
+
+    :return: generator yielding lists of at most size records
+    :rtype: generator
+    """
+    cursor = None
+    try:
+        cursor = con.cursor(name="enstore2cta_%s" % (uuid.uuid4().hex, ),
+                            cursor_factory=psycopg2.extras.RealDictCursor)
+        cursor.itersize = size
+        if pars:
+            cursor.execute(sql, pars)
+        else:
+            cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        try:
+            con.rollback()
+        except Exception:
+            pass
+
+
 def parse_enstore_config(file_name):
     #
     # Parse enstore config
@@ -1133,6 +2132,105 @@ def parse_enstore_config(file_name):
     return configdict
 
 
+def schedule_labels(enstore_db, labels=None):
+    """
+    Order labels so that volumes holding most files are
+    processed first (longest processing time first scheduling)
+
+    :param enstore_db: enstore database connection
+    :type enstore_db: Connection
+
+    :param labels: labels, all enstore volumes if None
+    :type labels: list
+
+    :return: list of (label, active_files, active_bytes) tuples
+    :rtype: list
+    """
+    if labels is None:
+        rows = select(enstore_db, SELECT_ALL_ENSTORE_VOLUMES)
+    else:
+        rows = select(enstore_db, SELECT_ENSTORE_VOLUME_SIZES, (labels,))
+    sizes = dict((row["label"], (row["active_files"], row["active_bytes"]))
+                 for row in rows)
+    if labels is None:
+        labels = [row["label"] for row in rows]
+    scheduled = [(label,) + sizes.get(label, (0, 0)) for label in labels]
+    scheduled.sort(key=lambda x: (x[1] or 0, x[2] or 0), reverse=True)
+    return scheduled
+
+
+def feed_labels(queue, labels, number_of_workers):
+    """
+    Put labels followed by stop markers into work queue
+    """
+    for label in labels:
+        queue.put(label)
+    for i in range(number_of_workers):
+        queue.put(None)
+
+
+STATS_INTERVAL = 300
+
+def print_progress(progress, scheduled, workers, t0, stats):
+    """
+    Print progress and estimated time of completion
+    as workers report completed labels. Merge statistics
+    reported by workers and print summary periodically
+
+    :param progress: queue workers put (label, number_of_files, vids, stats) to
+    :type progress: Queue
+
+    :param scheduled: list of (label, active_files, active_bytes) tuples
+    :type scheduled: list
+
+    :param workers: worker processes
+    :type workers: list
+
+    :param t0: start time
+    :type t0: float
+
+    :param stats: statistics all workers
+    :type stats: Stats
+
+    :return: CTA vids that received files
+    :rtype: set
+    """
+    vids = set()
+    estimates = dict((label, active_files or 0)
+                     for label, active_files, active_bytes in scheduled)
+    total_files = sum(estimates.values())
+    done_labels, done_files = 0, 0
+    finished_workers = 0
+    last_summary = time.time()
+    while finished_workers < len(workers):
+        if time.time() - last_summary > STATS_INTERVAL:
+            print_message("Stats %s" % (stats.summary(),))
+            last_summary = time.time()
+        try:
+            item = progress.get(timeout=60)
+        except Queue.Empty:
+            if not [w for w in workers if w.is_alive()]:
+                break
+            continue
+        if item is None:
+            finished_workers += 1
+            continue
+        label, number_of_files, touched_vids, label_stats = item
+        vids.update(touched_vids)
+        stats.merge(label_stats)
+        done_labels += 1
+        done_files += estimates.get(label, 0)
+        elapsed = time.time() - t0
+        rate = done_files / elapsed if elapsed > 0 else 0
+        eta = int((total_files - done_files) / rate + 0.5) if rate > 0 else 0
+        print_message("Progress %d/%d labels, %d/%d files, %d files/s, ETA %s" %
+                      (done_labels, len(scheduled),
+                       done_files, total_files,
+                       int(rate),
+                       datetime.timedelta(seconds=eta)))
+    return vids
+
+
 def get_enstore_libraries(enstore_db):
     rows = select(enstore_db,
                   SELECT_LIBRARIES)
@@ -1199,6 +2297,24 @@ def main():
         default =  multiprocessing.cpu_count(),
         help="override cpu count - number of simulateously processed labels")
 
+    parser.add_argument(
+        "--resume",
+        help="skip labels already migrated, roll back and redo partially migrated labels",
+        action="store_true")
+
+    parser.add_argument(
+        "--pipeline",
+        help="stream files of a label in batches, reading enstore, writing CTA and writing chimera concurrently",
+        action="store_true")
+
+    parser.add_argument(
+        "--report",
+        help="write JSON report with time spent, rows and call duration histograms by phase and error counts to this file")
+
+    parser.add_argument(
+        "--bulk",
+        help="insert all files of a label using multi-row inserts in a single transaction",
+        action="store_true")
 
     args = parser.parse_args()
 
@@ -1221,6 +2337,9 @@ def main():
         sys.exit(1)
 
     configuration["skip_locations"] = args.skip_locations
+    configuration["bulk"] = args.bulk
+    configuration["resume"] = args.resume
+    configuration["pipeline"] = args.pipeline
     #print (configuration)
 
     if args.label and args.all:
@@ -1265,19 +2384,34 @@ def main():
     if args.label:
         labels = [i.upper() for i in args.label.strip().split(",")]
 
-    if args.all:
-        enstore_db = create_connection(configuration.get("enstore_db"))
-        cursor = enstore_db.cursor()
-        cursor.execute(SELECT_ALL_ENSTORE_VOLUMES)
-        labels = [i[0] for i in cursor.fetchall()]
-        if cursor:
-            cursor.close()
+    scheduled = schedule_labels(enstore_db, labels)
+    labels = [i[0] for i in scheduled]
+
+    #
+    # when resuming, labels have been processed only after
+    # CTA was bootstrapped by previous run
+    #
+    bootstrapped = False
+    try:
+        create_migration_state(cta_db)
+        if args.resume:
+            states = get_label_states(cta_db)
+            bootstrapped = len(states) > 0
+            done_labels = set([label for label, status in states.items()
+                               if status == LABEL_DONE])
+            scheduled = [i for i in scheduled if i[0] not in done_labels]
+            labels = [i[0] for i in scheduled]
+            print_message("**** Resuming, skipping %d migrated labels ****" %
+                          (len(done_labels), ))
+    except Exception as e:
+        print_error("Failed to initialize migration state, quitting %s" % (str(e),))
+        sys.exit(1)
 
     if not labels:
          print_error("**** No labels found, quitting ***")
          sys.exit(1)
 
-    if not args.add:
+    if not args.add and not bootstrapped:
         try:
             insert_cta_media_types(cta_db)
         except:
@@ -1296,29 +2430,37 @@ def main():
     t0 = time.time()
 
     queue = multiprocessing.Queue(10000)
+    progress = multiprocessing.Queue()
     workers = []
     #cpu_count = multiprocessing.cpu_count()
     cpu_count = args.cpu_count
 
     for i in range(cpu_count):
-        worker = Worker(queue, configuration)
+        worker = Worker(queue, configuration, progress)
         workers.append(worker)
         worker.start()
 
-    for label in labels:
-        queue.put(label)
+    #
+    # labels are already ordered biggest first
+    #
+    feeder = threading.Thread(target=feed_labels,
+                              args=(queue, labels, cpu_count))
+    feeder.start()
 
-    for i in range(cpu_count):
-        queue.put(None)
+    stats = Stats()
+    vids = print_progress(progress, scheduled, workers, t0, stats)
 
+    feeder.join()
     for worker in workers:
         worker.join()
 
-    print_message("Finished file migration, bootstrapping tapes copies counts")
+    print_message("Finished file migration, bootstrapping tapes copies counts "
+                  "for %d tapes" % (len(vids),))
 
     try:
         cta_db = create_connection(configuration.get("cta_db"))
-        res = update_cta_copy_counts(cta_db)
+        if vids:
+            res = update_cta_copy_counts(cta_db, vids)
     except:
         print_error("Failed to connect to cta_db, quitting")
         sys.exit(1)
@@ -1326,6 +2468,17 @@ def main():
         if cta_db:
             cta_db.close()
 
+    print_message("Stats %s" % (stats.summary(),))
+    if args.report:
+        report = stats.to_dict()
+        report["labels"] = len(labels)
+        report["seconds"] = time.time() - t0
+        try:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        except (OSError, IOError) as e:
+            print_error("Failed to write report %s, %s" % (args.report, str(e),))
+
     print_message("**** FINISH ****")
     print_message("Took %d seconds" % (int(time.time()-t0+0.5),))
 